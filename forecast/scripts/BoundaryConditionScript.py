@@ -1,5 +1,10 @@
 import os, sys
 import re
+import bisect
+import hashlib
+import json
+from java.lang import System
+from java.util.concurrent import Callable, Executors
 from com.rma.io import DssFileManagerImpl
 from com.rma.model import Project
 
@@ -18,6 +23,8 @@ reload(CVP)
 
 DEBUG = True
 
+tributary_config_relpath = r"forecast\config\tributary_averages.config"
+
 '''Accepts parameters for WTMP forecast runs to form boundary condition data sets.'''
 def build_BC_data_sets(AP_start_time, AP_end_time, BC_F_part, BC_output_DSS_filename, ops_file_name, DSS_map_filename,
 		position_analysis_year=None,
@@ -25,7 +32,11 @@ def build_BC_data_sets(AP_start_time, AP_end_time, BC_F_part, BC_output_DSS_file
 		met_F_part=None,
 		met_output_DSS_filename=None,
 		flow_pattern_config_filename=None,
-		ops_import_F_part=None):
+		ops_import_F_part=None,
+		dss_pool=None,
+		met_max_workers=1,
+		ops_max_workers=1,
+		use_build_cache=True):
 
 	# Postitional (required) args:
 	# AP_start_time (HecTime) start of the simulation group run time
@@ -41,6 +52,24 @@ def build_BC_data_sets(AP_start_time, AP_end_time, BC_F_part, BC_output_DSS_file
 	# met_F_part (str) DSS F part for met data specifically. Defaults to BC_F_part
 	# met_output_DSS_filename (str) Name of separate DSS file for met time series records. Assumed relative to study directory. Defaults to BC_output_DSS_filename
 	# flow_pattern_config_filename (str) Name of file holding list of pattern time series for flow disaggreagtion. Assumed relative to study directory. Defaults to forecast/config/flow_pattern.config
+	# dss_pool (CVP.DSSHandlePool) Open DSS files shared by all reads and writes. Defaults to a pool for this build, closed when it finishes
+	# met_max_workers (int) Number of threads reading and shifting met records. Defaults to 1 (one record at a time)
+	# ops_max_workers (int) Number of threads running the reservoir and tributary stages of the ops data. Defaults to 1 (one stage at a time)
+	# use_build_cache (bool) Skip the build and only rewrite the map file when its inputs and outputs are unchanged since the last build. Defaults to True
+
+	if dss_pool is None:
+		with CVP.DSSHandlePool() as dss_pool:
+			return build_BC_data_sets(AP_start_time, AP_end_time, BC_F_part, BC_output_DSS_filename, ops_file_name, DSS_map_filename,
+				position_analysis_year=position_analysis_year,
+				position_analysis_config_filename=position_analysis_config_filename,
+				met_F_part=met_F_part,
+				met_output_DSS_filename=met_output_DSS_filename,
+				flow_pattern_config_filename=flow_pattern_config_filename,
+				ops_import_F_part=ops_import_F_part,
+				dss_pool=dss_pool,
+				met_max_workers=met_max_workers,
+				ops_max_workers=ops_max_workers,
+				use_build_cache=use_build_cache)
 
 	if not os.path.isabs(BC_output_DSS_filename):
 		BC_output_DSS_filename = os.path.join(Project.getCurrentProject().getWorkspacePath(), BC_output_DSS_filename)
@@ -76,10 +105,35 @@ def build_BC_data_sets(AP_start_time, AP_end_time, BC_F_part, BC_output_DSS_file
 	print "Met data output DSS file: %s"%met_output_DSS_filename
 	print "Location/Path map file: %s"%DSS_map_filename
 
+	# fingerprint everything the build reads; a manifest next to the map file records the last build
+	tributary_config_filename = os.path.join(Project.getCurrentProject().getWorkspacePath(), tributary_config_relpath)
+	manifest_filename = DSS_map_filename + ".build"
+	output_DSS_filenames = [BC_output_DSS_filename, met_output_DSS_filename]
+	fingerprint = build_fingerprint(
+		[AP_start_time.value(), AP_end_time.value(), BC_F_part, met_F_part, ops_import_F_part, position_analysis_year,
+			BC_output_DSS_filename, met_output_DSS_filename, DSS_map_filename],
+		[ops_file_name, position_analysis_config_filename, flow_pattern_config_filename, tributary_config_filename],
+		build_source_DSS_files(position_analysis_config_filename, flow_pattern_config_filename, tributary_config_filename))
+	manifest = read_build_manifest(manifest_filename)
+	if (use_build_cache and manifest and manifest.get("fingerprint") == fingerprint and
+		file_stamps(output_DSS_filenames) == manifest.get("outputs")):
+		print "\nInputs unchanged since the last build (%s); rewriting the map file only."%(fingerprint)
+		with open(DSS_map_filename, "w") as mapfile:
+			mapfile.write("location,parameter,dss file,dss path\n")
+			for line in manifest["lines"]:
+				mapfile.write(line + '\n')
+		print "\nBoundary condition report written to: %s\n"%(DSS_map_filename)
+		return len(manifest["lines"])
+	if os.path.exists(manifest_filename):
+		os.remove(manifest_filename)
+
 	print "\nPreparing Meteorological Data..."
 
+	# met and ops records are written together once both stages succeed
+	bulk_writer = CVP.DSSBulkWriter(dss_pool)
 	met_lines = create_positional_analysis_met_data(AP_start_time.year(), position_analysis_year, AP_start_time, AP_end_time,
-		position_analysis_config_filename, met_output_DSS_filename, met_F_part)
+		position_analysis_config_filename, met_output_DSS_filename, met_F_part, dss_pool=dss_pool,
+		max_workers=met_max_workers, bulk_writer=bulk_writer)
 	with open(os.path.join(Project.getCurrentProject().getWorkspacePath(), DSS_map_filename), "w") as mapfile:
 		mapfile.write("location,parameter,dss file,dss path\n")
 		for line in met_lines:
@@ -89,9 +143,13 @@ def build_BC_data_sets(AP_start_time, AP_end_time, BC_F_part, BC_output_DSS_file
 	print("Met process complete.\n\nPreparing hydro and WC boundary conditions...")
 
 	ops_lines = create_ops_BC_data(ops_file_name, AP_start_time, AP_end_time,
-		BC_output_DSS_filename, BC_F_part, ops_import_F_part, flow_pattern_config_filename, DSS_map_filename)
+		BC_output_DSS_filename, BC_F_part, ops_import_F_part, flow_pattern_config_filename, DSS_map_filename,
+		dss_pool=dss_pool, max_workers=ops_max_workers, bulk_writer=bulk_writer)
 	if not ops_lines:
 		return 0
+	if bulk_writer.flush() is None:
+		print "Boundary condition records were not written."
+		return 0
 
 	with open(os.path.join(Project.getCurrentProject().getWorkspacePath(), DSS_map_filename), "a") as mapfile:
 		for line in ops_lines:
@@ -99,17 +157,97 @@ def build_BC_data_sets(AP_start_time, AP_end_time, BC_F_part, BC_output_DSS_file
 			mapfile.write('\n')
 	print "\nBoundary condition report written to: %s\n"%(DSS_map_filename)
 
+	if not '' in met_lines:
+		write_build_manifest(manifest_filename, fingerprint, met_lines + ops_lines, file_stamps(output_DSS_filenames))
+
 	return len(met_lines) + len(ops_lines)
 
 
+'''
+Fingerprint of a boundary condition build
+parts: build arguments (time window, F parts, file names)
+content_files: files hashed by content (ops spreadsheet and config files)
+stamp_files: files identified by size and modification time (source DSS files)
+'''
+def build_fingerprint(parts, content_files, stamp_files):
+	digest = hashlib.md5()
+	digest.update(repr(parts))
+	for file_name in content_files:
+		digest.update("|%s|"%(os.path.abspath(file_name)))
+		if os.path.exists(file_name):
+			with open(file_name, "rb") as infile:
+				for chunk in iter(lambda: infile.read(1 << 20), ""):
+					digest.update(chunk)
+	digest.update(repr(sorted(file_stamps(stamp_files).items())))
+	return digest.hexdigest()
+
+'''
+Size and modification time of each file (None for missing files), keyed by absolute path
+'''
+def file_stamps(file_names):
+	rv = {}
+	for file_name in file_names:
+		key = os.path.normcase(os.path.abspath(file_name))
+		if os.path.exists(file_name):
+			rv[key] = [os.path.getsize(file_name), os.path.getmtime(file_name)]
+		else:
+			rv[key] = None
+	return rv
+
+'''
+Source DSS files named in the met, flow pattern and tributary average config files
+'''
+def build_source_DSS_files(position_analysis_config_filename, flow_pattern_config_filename, tributary_config_filename):
+	workspace = Project.getCurrentProject().getWorkspacePath()
+	rv = set()
+	for config_filename, column, skip in ((position_analysis_config_filename, 2, 1),
+		(flow_pattern_config_filename, 1, 0), (tributary_config_filename, -2, 0)):
+		if not os.path.exists(config_filename):
+			continue
+		for line in getConfigLines(config_filename)[skip:]:
+			token = line.split(',')
+			# skip malformed lines, as the builders reading these configs do
+			if len(token) <= column or len(token) < -column:
+				continue
+			dss_file_name = token[column].strip().strip('\\')
+			if not os.path.isabs(dss_file_name):
+				dss_file_name = os.path.join(workspace, dss_file_name)
+			rv.add(dss_file_name)
+	return sorted(rv)
+
+def read_build_manifest(manifest_filename):
+	if not os.path.exists(manifest_filename):
+		return None
+	try:
+		with open(manifest_filename) as infile:
+			return json.load(infile)
+	except ValueError:
+		print "Ignoring unreadable build manifest %s"%(manifest_filename)
+		return None
+
+def write_build_manifest(manifest_filename, fingerprint, lines, outputs):
+	with open(manifest_filename, "w") as outfile:
+		json.dump({"fingerprint": fingerprint, "lines": lines, "outputs": outputs}, outfile)
+
+
 '''
 Simple time-shifter for met positional ananlysis data
 
 This function doesn't contain any location-specific data or configuration. All necessary
 location and DSS file/path combinations are provided in a position analysis configuration file.
+
+With max_workers > 1 the records are read and shifted on a pool of threads. Reads and catalogs
+of the same DSS file still take turns on its pooled handle, so only the shifts overlap. The shifted
+records are queued on the bulk writer (written here unless the caller passes its own bulk_writer
+and flushes it), and the returned map lines stay in config file order.
 '''
 def create_positional_analysis_met_data(target_year, source_year, start_time, end_time,
-position_analysis_config_filename, met_output_DSS_filename, met_F_part):
+position_analysis_config_filename, met_output_DSS_filename, met_F_part, dss_pool=None, max_workers=1, bulk_writer=None):
+	if dss_pool is None:
+		with CVP.DSSHandlePool() as dss_pool:
+			return create_positional_analysis_met_data(target_year, source_year, start_time, end_time,
+				position_analysis_config_filename, met_output_DSS_filename, met_F_part, dss_pool=dss_pool,
+				max_workers=max_workers, bulk_writer=bulk_writer)
 	print "Calculating positional met data..."
 	print "Historical Met File: %s"%(fc.ForecastConfigFiles.getHistoricalMetFile())
 	print "Position Analysis Met File: %s"%position_analysis_config_filename
@@ -118,9 +256,64 @@ position_analysis_config_filename, met_output_DSS_filename, met_F_part):
 
 	rv_lines = []
 	met_config_str = ""
+	# records are only queued when the caller flushes them
+	flush_records = bulk_writer is None
+	if flush_records:
+		bulk_writer = CVP.DSSBulkWriter(dss_pool)
 	print "Met output DSS file: %s"%(met_output_DSS_filename)
 	met_config_lines = getConfigLines(position_analysis_config_filename)
-	for line in met_config_lines[1:]:
+	tasks = [MetRecordTask(line, position_analysis_config_filename, diff_years, start_time, end_time, met_F_part, dss_pool)
+		for line in met_config_lines[1:]]
+	if max_workers > 1 and len(tasks) > 1:
+		executor = Executors.newFixedThreadPool(min(max_workers, len(tasks)))
+		try:
+			results = [future.get() for future in executor.invokeAll(tasks)]
+		finally:
+			executor.shutdown()
+	else:
+		results = [task.call() for task in tasks]
+
+	for result in results:
+		if result is None:
+			continue
+		if isinstance(result, str):
+			print result
+			return ['']
+		met_loc, met_param, tsc_shift = result
+		if DEBUG: print "Writing %s to DSS file %s."%(tsc_shift.fullName, met_output_DSS_filename)
+		bulk_writer.add(met_output_DSS_filename, tsc_shift)
+		rv_lines.append("%s,%s,%s,%s"%(met_loc.strip(), met_param.strip().strip('>'),
+		Project.getCurrentProject().getRelativePath(met_output_DSS_filename),
+		tsc_shift.fullName))
+
+	if flush_records and bulk_writer.flush() is None:
+		print "Met records were not written to %s"%(met_output_DSS_filename)
+		return ['']
+	return rv_lines
+
+'''
+Reads and shifts the record of one line of the position analysis configuration file
+call() returns (location, parameter, shifted container), None if the line or record is skipped,
+or an error message if the shift falls outside the source record
+DSS reads take turns on the pool's file lock; only the shift itself runs concurrently between tasks
+'''
+class MetRecordTask(Callable):
+	def __init__(self, line, position_analysis_config_filename, diff_years, start_time, end_time, met_F_part, dss_pool):
+		self.line = line
+		self.position_analysis_config_filename = position_analysis_config_filename
+		self.diff_years = diff_years
+		self.start_time = start_time
+		self.end_time = end_time
+		self.met_F_part = met_F_part
+		self.dss_pool = dss_pool
+
+	def call(self):
+		line = self.line
+		position_analysis_config_filename = self.position_analysis_config_filename
+		diff_years = self.diff_years
+		start_time = self.start_time
+		end_time = self.end_time
+		dss_pool = self.dss_pool
 		token = line.strip().split(',')
 		dest_count = 0
 		try:
@@ -128,15 +321,13 @@ position_analysis_config_filename, met_output_DSS_filename, met_F_part):
 		except:
 			print "File %s line \n\t \"%s\"\nis not a valid ID for a position analysis DSS record."%(position_analysis_config_filename,line)
 			print "Can't read an integer value from \"%s\"."%(token[4])
-			continue
+			return None
 		target_line_length = 5 + 2*dest_count
 		if len(token) != target_line_length:
 			print "File %s line \n\t \"%s\"\nis not a valid ID for a position analysis DSS record."%(position_analysis_config_filename,line)
-			continue
+			return None
 		#source_DSS_file_name = os.path.join(Project.getCurrentProject().getWorkspacePath(), token[0].strip('\\'))
 		source_DSS_file_name = os.path.join(Project.getCurrentProject().getWorkspacePath(), token[2].strip().strip('\\'))
-		ts_read = hec.heclib.dss.HecTimeSeries()
-		ts_read.setDSSFileName(source_DSS_file_name)
 		if DEBUG: print "Reading %s from DSS file %s."%(token[3].strip(), source_DSS_file_name)
 		source_path_parts = token[3].strip().strip('/').split('/', 5)
 		dest_path_parts = token[6].strip().strip('/').split('/', 5)
@@ -147,17 +338,7 @@ position_analysis_config_filename, met_output_DSS_filename, met_F_part):
 			if index == 2:
 				source_path += '/'
 				dest_path += '/'
-		tsc_source = tscont()
-		tsc_source.fullName = source_path
-		status = ts_read.read(tsc_source, False)
-		if status < 0:
-			print "Failed to read meteorologic time series %s \n\tfrom DSS file %s"%(source_path, source_DSS_file_name)
-			ts_read.done()
-			continue
-		tsmath_source = tsmath(tsc_source)
 		time_step_label = token[3].strip().split('/')[5]
-		if DEBUG:  print "\tTime series contains %d values."%(tsmath_source.getContainer().numberValues)
-		if DEBUG:  print "\tShifting time series with shiftInTime(%s)."%("%dMo"%(diff_years*12))
 		# tsmath_shift = tsmath_source.shiftInTime("%dYrar"%(diff_years))
 		padded_end_time = HecTime()
 		padded_end_time.set(end_time.value() + 1440)
@@ -165,46 +346,49 @@ position_analysis_config_filename, met_output_DSS_filename, met_F_part):
 			"%s 0000"%(start_time.date(4)),
 			"%s 2400"%(padded_end_time.date(4)),
 			time_step_label, "0M", 1.0)
+		shift_container = tsmath_shift.getContainer()
 		time_seek = HecTime(tsmath_shift.firstValidDate(), HecTime.MINUTE_INCREMENT)
 		time_seek.setYearMonthDay(time_seek.year() - diff_years, time_seek.month(), time_seek.day(), time_seek.minutesSinceMidnight())
-		if time_seek.getMinutes() < tsmath_source.firstValidDate():
-			print "Met position time shift out of range at source start..."
-			return ['']
+		shift_span = shift_container.times[shift_container.numberValues-1] - shift_container.times[0]
+		# A windowed read always returns the whole window, so the shift is checked against the
+		# first and last valid times of the full source record
+		source_extent = dss_pool.record_extent(source_DSS_file_name, source_path)
+		if source_extent is None:
+			print "Failed to read meteorologic time series %s \n\tfrom DSS file %s"%(source_path, source_DSS_file_name)
+			return None
+		if time_seek.getMinutes() < source_extent[0]:
+			return "Met position time shift out of range at source start..."
+		if time_seek.getMinutes() + shift_span > source_extent[1]:
+			return "Met position time shift out of range at source end..."
+		# Only read the source values under the shifted window (padded a day for leap days)
+		time_seek_end = HecTime()
+		time_seek_end.set(time_seek.value() + shift_span + 1440)
+		tsc_source = dss_pool.read(source_DSS_file_name, source_path,
+			time_window="%s %02d%02d %s %02d%02d"%(time_seek.date(4), time_seek.hour(), time_seek.minute(),
+			time_seek_end.date(4), time_seek_end.hour(), time_seek_end.minute()))
+		if tsc_source is None:
+			print "Failed to read meteorologic time series %s \n\tfrom DSS file %s"%(source_path, source_DSS_file_name)
+			return None
+		tsmath_source = tsmath(tsc_source)
+		if DEBUG:  print "\tTime series contains %d values."%(tsmath_source.getContainer().numberValues)
+		if DEBUG:  print "\tShifting time series with shiftInTime(%s)."%("%dMo"%(diff_years*12))
 		source_container = tsmath_source.getContainer()
-		shift_container = tsmath_shift.getContainer()
-		start_index = 0
-		for i in range(source_container.numberValues):
-			if source_container.times[i] >= time_seek.getMinutes():
-				start_index = i
-				break
-		if start_index == 0:
-			print "Met position time shift out of range at source end..."
-			return ['']
+		start_index = bisect.bisect_left(source_container.times, time_seek.getMinutes(), 0, source_container.numberValues)
+		if start_index + shift_container.numberValues > source_container.numberValues:
+			return "Met position time shift out of range of the values read..."
 		# if this works, it's only because the source and shift TSCs have the same time step.
-		for i in range(shift_container.numberValues):
-			shift_container.values[i] = source_container.values[start_index + i]
+		System.arraycopy(source_container.values, start_index, shift_container.values, 0, shift_container.numberValues)
 		if len(shift_container.values) != shift_container.numberValues:
-			print "You doofus!\nlen(values)=%d\nnumberValues=%d\n"%(len(shift_container.values), shift_container.numberValues)
-			return ['']
+			return "You doofus!\nlen(values)=%d\nnumberValues=%d\n"%(len(shift_container.values), shift_container.numberValues)
 		tsmath_shift.setType(tsmath_source.getType())
 		tsmath_shift.setUnits(tsmath_source.getUnits())
 		tsmath_shift.setPathname(dest_path)
-		tsmath_shift.setVersion(met_F_part)
-		ts_write = hec.heclib.dss.HecTimeSeries()
-		ts_write.setDSSFileName(met_output_DSS_filename)
-		if DEBUG: print "Writing %s to DSS file %s."%(shift_container.fullName, met_output_DSS_filename)
-		ts_write.write(tsmath_shift.getData())
-		ts_write.done()
-		ts_read.done()
+		tsmath_shift.setVersion(self.met_F_part)
 
 		#met_loc, met_param = token[1].strip().split('<', 1)
 		met_loc = token[0]
 		met_param = token[1]
-		rv_lines.append("%s,%s,%s,%s"%(met_loc.strip(), met_param.strip().strip('>'),
-		Project.getCurrentProject().getRelativePath(met_output_DSS_filename),
-		tsmath_shift.getContainer().fullName))
-
-	return rv_lines
+		return (met_loc, met_param, tsmath_shift.getData())
 
 def shift_monthly_averages(source_tsm, AP_start_time, AP_end_time):
 	# source_tsm -- time series math of monthly average values
@@ -262,7 +446,17 @@ def getConfigLines(fileName):
 
 '''Processes the contents of the CVP ops spreadsheet in to flow and water temperature BCs'''
 def create_ops_BC_data(ops_file_name, start_time, end_time, BC_output_DSS_filename,
-	BC_F_part, ops_import_F_part, flow_pattern_config_filename, DSS_map_filename):
+	BC_F_part, ops_import_F_part, flow_pattern_config_filename, DSS_map_filename, dss_pool=None, max_workers=1,
+	bulk_writer=None):
+	if dss_pool is None:
+		with CVP.DSSHandlePool() as dss_pool:
+			return create_ops_BC_data(ops_file_name, start_time, end_time, BC_output_DSS_filename,
+				BC_F_part, ops_import_F_part, flow_pattern_config_filename, DSS_map_filename, dss_pool=dss_pool,
+				max_workers=max_workers, bulk_writer=bulk_writer)
+	# records are only queued when the caller flushes them
+	flush_records = bulk_writer is None
+	if flush_records:
+		bulk_writer = CVP.DSSBulkWriter(dss_pool)
 	print "Processing boundary conditions for upper Sacramento River from ops file:\n\t%s"%(ops_file_name)
 	print "  Forecast time window start: %s"%(start_time.dateAndTime(4))
 	print "  Forecast time window end: %s"%(end_time.dateAndTime(4))
@@ -404,617 +598,590 @@ def create_ops_BC_data(ops_file_name, start_time, end_time, BC_output_DSS_filena
 
 	met_DSS_file_name = ""
 	airtemp_path = ""
-	with open(DSS_map_filename) as infile:
-		for line in infile:
-			if (line.split(',')[0].strip().upper() == "REDDING AIRPORT" and
-				line.split(',')[1].strip().upper() == "AIR TEMPERATURE"):
-				met_DSS_file_name = line.split(',')[2].strip().strip('\\')
-				airtemp_path = line.split(',')[3].strip()
-	if len(met_DSS_file_name) == 0 or len(airtemp_path) == 0:
-		print "Error reading Shasta air temperature data configuration from file\n\t%s"%(DSS_map_filename)
-		print "Air temperature DSS file or path not found."
-		return None
-	if not os.path.isabs(met_DSS_file_name):
-		met_DSS_file_name = os.path.join(Project.getCurrentProject().getWorkspacePath(), met_DSS_file_name)
-
-	tsm_list = []
-	balance_list = []
-	########################
-	# Trinity-Clair Engle and Lewiston
-	# data from CVP spreadsheet
-	########################
-	print "TS Location = %s"%(trinity_tsc_list[0].location.upper())
-	tsmath_acc_dep = tsmath.generateRegularIntervalTimeSeries(
-		"%s 0000"%(ops_start_date.date(4)),
-		"%s 2400"%(end_time.date(4)),
-		"1DAY", "0M", 0.0)
-	tsmath_acc_dep.setUnits("CFS")
-	tsmath_acc_dep.setType("PER-AVER")
-	tsmath_acc_dep.setTimeInterval("1DAY")
-	tsmath_acc_dep.setWatershed("TRINITY RIVER")
-	tsmath_acc_dep.setLocation("TRINITY LAKE")
-	tsmath_acc_dep.setParameterPart("FLOW-ACC-DEP")
-	tsmath_acc_dep.setVersion(BC_F_part)
-	tsmath_bal_trnty = tsmath.generateRegularIntervalTimeSeries(
-		"%s 0000"%(ops_start_date.date(4)),
-		"%s 2400"%(end_time.date(4)),
-		"1MONTH", "0M", 0.0)
-	tsmath_bal_trnty.setUnits("AC-FT")
-	tsmath_bal_trnty.setType("PER-CUM")
-	tsmath_bal_trnty.setTimeInterval("1MONTH")
-	tsmath_bal_trnty.setWatershed("TRINITY RIVER")
-	tsmath_bal_trnty.setLocation("TRINITY LAKE")
-	tsmath_bal_trnty.setParameterPart("VOLUME-BALANCE")
-	tsmath_bal_trnty.setVersion(BC_F_part)
-	for ts in trinity_tsc_list:
-		print "\tTS Parameter = %s"%(ts.parameter.upper())
-		tsm = tsmath(ts)
-		tsm.setWatershed("TRINITY RIVER")
-		tsm.setLocation("TRINITY LAKE")
-		if ts.parameter.upper() == "INFLOW":
-			tsmath_flow_monthly = tsm
-			tsm_list.append(tsmath_flow_monthly)
-			tsmath_bal_trnty = tsmath_bal_trnty.add(tsmath_flow_monthly)
-			print "reading Trinity pattern from file: " + trinity_pattern_DSS_file_name
-			print "\tDSS path:" + trinity_pattern_path
-			ts_read = hec.heclib.dss.HecTimeSeries()
-			ts_read.setDSSFileName(trinity_pattern_DSS_file_name)
-			tsc_pattern = tscont()
-			tsc_pattern.fullName = trinity_pattern_path
-			status = ts_read.read(tsc_pattern, False)
-			if status < 0:
-				print "Failed to read pattern time series %s \n\tfrom DSS file %s"%(tsc_pattern.fullName, trinity_dss_file_name)
-				ts_read.done()
-				continue
-			tsmath_pattern = tsmath(tsc_pattern)
-			ts_read.done()
-			tsmath_trinity_inflow_daily = CVP.weight_transform_monthly_to_daily(
-				tsmath_flow_monthly, tsmath_pattern, start_day_count=days_in_first_month)
-			tsmath_trinity_inflow_daily.setPathname(ts.fullName)
-			tsmath_trinity_inflow_daily.setWatershed("TRINITY RIVER")
-			tsmath_trinity_inflow_daily.setLocation("TRINITY LAKE")
-			tsmath_trinity_inflow_daily.setTimeInterval("1DAY")
-			tsmath_trinity_inflow_daily.setParameterPart("FLOW-IN")
-			tsmath_trinity_inflow_daily.setVersion(BC_F_part)
-			tsm_list.append(tsmath_trinity_inflow_daily)
-		elif "STORAGE" in ts.parameter.upper():
-			tsmath_storage_monthly = tsm
-			tsmath_storage_monthly.setParameterPart("STORAGE")
-			tsmath_storage_monthly.setType("INST-CUM")
-			tsm_storage_change = tsmath_storage_monthly.successiveDifferences()
-			tsmath_storage_monthly.setType("INST-VAL")
-			tsm_list.append(tsmath_storage_monthly)
-			tsm_storage_change.setWatershed("TRINITY RIVER")
-			tsm_storage_change.setLocation("TRINITY LAKE")
-			tsm_storage_change.setParameterPart("STORAGE-CHANGE")
-			tsm_list.append(tsm_storage_change)
-			tsmath_bal_trnty = tsmath_bal_trnty.subtract(tsm_storage_change)
-		elif "EVAP" in ts.parameter.upper():
-			tsmath_evap_monthly = tsm
-			tsmath_evap_monthly.setParameterPart("VOLUME-EST EVAPORATION")
-			tsm_list.append(tsmath_evap_monthly)
-			tsmath_bal_trnty = tsmath_bal_trnty.subtract(tsmath_evap_monthly)
-			tsmath_acc_dep = tsmath_acc_dep.subtract(
-				CVP.uniform_transform_monthly_to_daily(
-				tsmath_evap_monthly, start_day_count=days_in_first_month))
-			tsm_list.append(CVP.uniform_transform_monthly_to_daily(
-				tsmath_evap_monthly, start_day_count=days_in_first_month))
-		elif ts.parameter.upper() == "TOTAL RELEASE":
-			tsmath_trinity_release_monthly = tsm
-			tsmath_trinity_release_monthly.setParameterPart("VOLUME-RELEASE")
-			tsm_list.append(tsmath_trinity_release_monthly)
-			tsmath_trinity_release = CVP.uniform_transform_monthly_to_hourly(
-				tsmath_trinity_release_monthly, start_day_count=days_in_first_month)
-			tsmath_trinity_release.setWatershed("TRINITY RIVER")
-			tsmath_trinity_release.setLocation("TRINITY LAKE")
-			tsmath_trinity_release.setParameterPart("FLOW-RELEASE")
-			tsmath_trinity_release.setTimeInterval("1HOUR")
-			tsmath_trinity_release.setVersion(BC_F_part)
-			tsm_list.append(tsmath_trinity_release)
-		elif "RIVER REL" in ts.parameter.upper() and "CFS" in ts.parameter.upper():
-			tsmath_lewiston_release_flow_monthly = tsm
-			tsmath_lewiston_release_flow_monthly.setLocation("LEWISTON RESERVOIR")
-			tsmath_lewiston_release_flow_monthly.setParameterPart("FLOW-RIVER RELEASE")
-			# tsm_list.append(tsmath_lewiston_release_flow_monthly)
-		elif "RIVER REL" in ts.parameter.upper() and "TAF" in ts.parameter.upper():
-			tsmath_lewiston_release_monthly = tsm
-			tsmath_lewiston_release_monthly.setLocation("LEWISTON RESERVOIR")
-			tsmath_lewiston_release_monthly.setParameterPart("VOLUME-RIVER RELEASE")
-			tsm_list.append(tsmath_lewiston_release_monthly)
-			tsmath_bal_trnty = tsmath_bal_trnty.subtract(tsmath_lewiston_release_monthly)
-			tsmath_lewiston_release = CVP.uniform_transform_monthly_to_daily(
-				tsmath_lewiston_release_monthly, start_day_count=days_in_first_month)
-			tsmath_lewiston_release.setWatershed("TRINITY RIVER")
-			tsmath_lewiston_release.setLocation("LEWISTON RESERVOIR")
-			tsmath_lewiston_release.setParameterPart("FLOW-RIVER RELEASE")
-			tsmath_lewiston_release.setTimeInterval("1DAY")
-			tsmath_lewiston_release.setVersion(BC_F_part)
-			tsm_list.append(tsmath_lewiston_release)
-		elif ts.parameter.upper() == "CARR PP":
-			tsmath_carr_release_monthly = tsm
-			tsmath_carr_release_monthly.setWatershed("TRINITY RIVER")
-			tsmath_carr_release_monthly.setLocation("LEWISTON RESERVOIR")
-			tsmath_carr_release_monthly.setParameterPart("VOLUME-CLEAR CREEK DIVERSION")
-			tsm_list.append(tsmath_carr_release_monthly)
-			tsmath_bal_trnty = tsmath_bal_trnty.subtract(tsmath_carr_release_monthly)
-			tsmath_carr_release = CVP.uniform_transform_monthly_to_hourly(
-				tsm, start_day_count=days_in_first_month)
-			tsmath_carr_release.setWatershed("CLEAR CREEK")
-			tsmath_carr_release.setLocation("CARR POWERHOUSE")
-			tsmath_carr_release.setParameterPart("FLOW-RELEASE")
-			tsmath_carr_release.setTimeInterval("1HOUR")
-			tsmath_carr_release.setVersion(BC_F_part)
-			tsm_list.append(tsmath_carr_release)
-		else:
-			tsm_list.append(tsm)
-
-	# Trinity storage changes due to:
-	#	In:
-	#		Trinity inflow : tsmath_trinity_inflow_daily
-	#	Out:
-	#		Trinity dam releases: tsmath_release_daily
-	#		Net evaporation, leakage, other: tsmath_acc_dep
-
-	tsmath_storage_daily = tsmath.generateRegularIntervalTimeSeries(
-		"%s 0000"%(ops_start_date.date(4)),
-		"%s 2400"%(end_time.date(4)),
-		"1DAY", "0M", 0.0)
-	tsmath_storage_daily.setUnits("AC-FT")
-	tsmath_storage_daily.setType("INST-VAL")
-	tsmath_storage_daily.setTimeInterval("1DAY")
-	tsmath_storage_daily.setWatershed("TRINITY RIVER")
-	tsmath_storage_daily.setLocation("TRINITY LAKE")
-	tsmath_storage_daily.setParameterPart("STORAGE-CVP")
-	tsmath_storage_daily.setVersion(BC_F_part)
-	tsmath_storage_daily.getContainer().values[0] = tsmath_storage_monthly.getContainer().values[0]
-	tsmath_release_daily = CVP.uniform_transform_monthly_to_daily(
-		tsmath_trinity_release_monthly, start_day_count=days_in_first_month)
-
-	j = 1
-	search_time = HecTime()
-	for i in range(1, len(tsmath_storage_daily.getContainer().values)):
-		if tsmath_storage_daily.getContainer().times[i] >= tsmath_storage_monthly.getContainer().times[j]:
-			tsmath_storage_daily.getContainer().values[i] = tsmath_storage_monthly.getContainer().values[j]
-			j += 1
-		else:
-			search_time.set(tsmath_storage_daily.getContainer().times[i])
-			tsmath_storage_daily.getContainer().values[i] = (
-				tsmath_storage_daily.getContainer().values[i-1] + 1.98347*(
-				tsmath_trinity_inflow_daily.getContainer().getValue(search_time)
-				- tsmath_release_daily.getContainer().getValue(search_time)
-				+ tsmath_acc_dep.getContainer().getValue(search_time)))
-	tsm_list.append(tsmath_storage_daily)
-	tsm_list.append(tsmath_acc_dep)
-	tsm_list.append(tsmath_bal_trnty)
-	balance_list.append(tsmath_bal_trnty)
-
-	########################
-	# Disaggregate Trinity Lake Tributary In Flows
-	########################
-
-	# Table of tributary weights by month
-	tributary_weights = {
-		"EF TRINITY":(0.200999652, 0.201001041, 0.200998676, 0.200998663, 0.201001043, 0.200998535, 0.200996912, 0.201009666, 0.200970155, 0.200978909, 0.201003315, 0.201000536),
-		"STUART FORK":(0.119998966, 0.119998249, 0.120001072, 0.120000814, 0.119998453, 0.119997145, 0.120002941, 0.120069866, 0.120091685, 0.120009144, 0.119987691, 0.120004223),
-		"SWIFT CR":(0.114000898, 0.114002108, 0.114000033, 0.114001063, 0.113999875, 0.114002195, 0.114015586, 0.113944013, 0.114068202, 0.114014717, 0.113997178, 0.113996712),
-		"TRINITY RIVER":(0.565000485, 0.564998603, 0.565000218, 0.56499946, 0.56500063, 0.565002124, 0.564984561, 0.564976455, 0.564869961, 0.564997226, 0.565011814, 0.56499853)}
-	names_flows = {}
-	for tsm in CVP.split_time_series_monthly(tsmath_trinity_inflow_daily, tributary_weights, "FLOW-IN"):
-		tsm.setVersion(BC_F_part)
-		tsm_list.append(tsm)
-		names_flows[tsm.getContainer().location] = tsm
-
-	########################
-	# Estimate Trinity Tributary Temperatures
-	########################
-
-	met_DSS_file_name = ""
-	airtemp_path = ""
-
 	for line in DSS_map_lines:
-		# print line
-		if (line.split(',')[0].strip().upper() == "LEWISTON RES" and
+		if (line.split(',')[0].strip().upper() == "REDDING AIRPORT" and
 			line.split(',')[1].strip().upper() == "AIR TEMPERATURE"):
 			met_DSS_file_name = line.split(',')[2].strip().strip('\\')
 			airtemp_path = line.split(',')[3].strip()
-			break
 	if len(met_DSS_file_name) == 0 or len(airtemp_path) == 0:
-		print "Error reading Trinity air temperature data configuration from file\n\t%s"%(DSS_map_filename)
+		print "Error reading Shasta air temperature data configuration from file\n\t%s"%(DSS_map_filename)
 		print "Air temperature DSS file or path not found."
 		return None
 	if not os.path.isabs(met_DSS_file_name):
 		met_DSS_file_name = os.path.join(Project.getCurrentProject().getWorkspacePath(), met_DSS_file_name)
 
-	#River, Intercept (deg C), Flow Coef (cfs), Air Temp Coef (deg C), RMS Error (deg C)
-	tributary_temp_regression_coefficients = {
-		"EF TRINITY": (2.204979, -0.00208361, 0.65876114, 2.117),
-		"STUART FORK": (1.2766113, -0.00304511, 0.60274446, 1.9729857),
-		"SWIFT CR": (1.2773657, -0.00356459,  0.6329333, 2.0825596),
-		"TRINITY RIVER": (1.968627, -0.00075939, 0.6476875, 2.102819)}
-
-	ts_read = hec.heclib.dss.HecTimeSeries()
-	ts_read.setDSSFileName(met_DSS_file_name)
-	tsc_airtemp = tscont()
-	tsc_airtemp.fullName = airtemp_path
-	status = ts_read.read(tsc_airtemp, False)
-	if status < 0:
-		print "Failed to read pattern time series %s \n\tfrom DSS file %s"%(tsc_pattern.fullName, whiskeytown_pattern_DSS_file_name)
-		ts_read.done()
-	tsmath_airtemp = tsmath(tsc_airtemp)
-	ts_read.done()
-	for key in tributary_temp_regression_coefficients.keys():
-		tsm = CVP.evaluate_temp_regression(names_flows[key], tsmath_airtemp, tributary_temp_regression_coefficients[key])
-		tsm.setVersion(BC_F_part)
-		tsm_list.append(tsm)
-
 	########################
-	# Whiskeytown and Clear Creek
-	# data from CVP spreadsheet
+	# Each reservoir block below is a stage of a dependency graph: Whiskeytown needs the Carr
+	# powerhouse diversion from Trinity, and Shasta the Carr and Spring Creek daily flows from
+	# Whiskeytown. The tributary disaggregations, temperature regressions and downstream
+	# tributaries start as soon as their inputs are ready. Each stage returns its own list of
+	# output series; they are combined below in the same order as a sequential build.
 	########################
-	print "TS Location = %s"%(whiskeytown_tsc_list[0].location.upper())
-	tsmath_acc_dep = tsmath.generateRegularIntervalTimeSeries(
-		"%s 0000"%(ops_start_date.date(4)),
-		"%s 2400"%(end_time.date(4)),
-		"1DAY", "0M", 0.0)
-	tsmath_acc_dep.setUnits("CFS")
-	tsmath_acc_dep.setType("PER-AVER")
-	tsmath_acc_dep.setTimeInterval("1DAY")
-	tsmath_acc_dep.setWatershed("CLEAR CREEK")
-	tsmath_acc_dep.setLocation("WHISKEYTOWN LAKE")
-	tsmath_acc_dep.setParameterPart("FLOW-ACC-DEP")
-	tsmath_acc_dep.setVersion(BC_F_part)
-	tsmath_bal_whsky = tsmath.generateRegularIntervalTimeSeries(
-		"%s 0000"%(ops_start_date.date(4)),
-		"%s 2400"%(end_time.date(4)),
-		"1MONTH", "0M", 0.0)
-	tsmath_bal_whsky.setUnits("AC-FT")
-	tsmath_bal_whsky.setType("PER-CUM")
-	tsmath_bal_whsky.setTimeInterval("1MONTH")
-	tsmath_bal_whsky.setWatershed("CLEAR CREEK")
-	tsmath_bal_whsky.setLocation("WHISKEYTOWN LAKE")
-	tsmath_bal_whsky.setParameterPart("VOLUME-BALANCE")
-	tsmath_bal_whsky.setVersion(BC_F_part)
-	tsmath_bal_whsky = tsmath_bal_whsky.add(tsmath_carr_release_monthly)
-	for ts in whiskeytown_tsc_list:
-		print "\tTS Parameter = %s"%(ts.parameter.upper())
-		tsm = tsmath(ts)
-		tsm.setWatershed("CLEAR CREEK")
-		tsm.setLocation("WHISKEYTOWN LAKE")
-		if ts.parameter.upper() == "INFLOW":
-			tsmath_flow_monthly = tsm
-			tsm_list.append(tsmath_flow_monthly)
-			tsmath_bal_whsky = tsmath_bal_whsky.add(tsmath_flow_monthly)
-			print "reading pattern from file: " + whiskeytown_pattern_DSS_file_name
-			print "\t" + whiskeytown_pattern_path
-			ts_read = hec.heclib.dss.HecTimeSeries()
-			ts_read.setDSSFileName(whiskeytown_pattern_DSS_file_name)
-			tsc_pattern = tscont()
-			tsc_pattern.fullName = whiskeytown_pattern_path
-			status = ts_read.read(tsc_pattern, False)
-			if status < 0:
-				print "Failed to read pattern time series %s \n\tfrom DSS file %s"%(tsc_pattern.fullName, whiskeytown_pattern_DSS_file_name)
-				ts_read.done()
-				continue
-			tsmath_pattern = tsmath(tsc_pattern)
-			ts_read.done()
-			tsmath_weighted = CVP.weight_transform_monthly_to_daily(
-				tsmath_flow_monthly, tsmath_pattern, start_day_count=days_in_first_month)
-			tsmath_weighted.setPathname(ts.fullName)
-			tsmath_weighted.setTimeInterval("1DAY")
-			tsmath_weighted.setParameterPart("FLOW-IN")
-			tsmath_weighted.setVersion(BC_F_part)
-			tsm_list.append(tsmath_weighted)
-		elif "STORAGE" in ts.parameter.upper():
-			tsmath_storage_monthly = tsm
-			tsmath_storage_monthly.setParameterPart("STORAGE")
-			tsmath_storage_monthly.setType("INST-CUM")
-			tsm_storage_change = tsmath_storage_monthly.successiveDifferences()
-			tsmath_storage_monthly.setType("INST-VAL")
-			tsm_list.append(tsmath_storage_monthly)
-			tsm_storage_change.setWatershed("CLEAR CREEK")
-			tsm_storage_change.setLocation("WHISKEYTOWN LAKE")
-			tsm_storage_change.setParameterPart("STORAGE-CHANGE")
-			tsm_list.append(tsm_storage_change)
-			tsmath_bal_whsky = tsmath_bal_whsky.subtract(tsm_storage_change)
-		elif "SPRING CR" in ts.parameter.upper():
-			tsmath_sp_cr_monthly = tsm
-			tsm_list.append(tsmath_sp_cr_monthly)
-			tsmath_bal_whsky = tsmath_bal_whsky.subtract(tsmath_sp_cr_monthly)
-			tsmath_sp_cr = CVP.uniform_transform_monthly_to_hourly(
-				tsm, start_day_count=days_in_first_month)
-			tsmath_sp_cr.setPathname(ts.fullName)
-			tsmath_sp_cr.setLocation("SPRING CREEK")
-			tsmath_sp_cr.setTimeInterval("1HOUR")
-			tsmath_sp_cr.setParameterPart("FLOW-PP")
-			tsmath_sp_cr.setVersion(BC_F_part)
-			tsm_list.append(tsmath_sp_cr)
-		elif "EVAP" in ts.parameter.upper():
-			tsmath_evap_monthly = tsm
-			tsmath_evap_monthly.setParameterPart("VOLUME-EST EVAPORATION")
-			tsm_list.append(tsmath_evap_monthly)
-			tsmath_bal_whsky = tsmath_bal_whsky.subtract(tsmath_evap_monthly)
-			tsmath_acc_dep = tsmath_acc_dep.subtract(
-				CVP.uniform_transform_monthly_to_daily(
-				tsmath_evap_monthly, start_day_count=days_in_first_month))
-		elif "CLEAR CREEK" in ts.parameter.upper() and "TAF" in ts.parameter.upper():
-			tsmath_release_monthly = tsm
-			tsmath_release_monthly.setLocation("WHISKEYTOWN DAM")
-			tsm_list.append(tsmath_release_monthly)
-			tsmath_bal_whsky = tsmath_bal_whsky.subtract(tsmath_release_monthly)
-			tsmath_release = CVP.uniform_transform_monthly_to_hourly(
-				tsmath_release_monthly, start_day_count=days_in_first_month)
-			tsmath_release.setPathname(tsmath_release_monthly.getContainer().fullName)
-			tsmath_release.setLocation("WHISKEYTOWN DAM")
-			tsmath_release.setTimeInterval("1HOUR")
-			tsmath_release.setParameterPart("FLOW-RELEASE")
-			tsmath_release.setVersion(BC_F_part)
-			tsm_list.append(tsmath_release)
-		else:
-			tsm_list.append(tsm)
 
-	# Whiskeytown storage changes due to:
-	#	In:
-	#		Clear Creek inflow: tsmath_weighted
-	#		Carr Powerhouse releases: tsmath_carr_release_daily
-	#	Out:
-	#		Whiskeytown dam releases: tsmath_release_daily
-	#		Spring Creek Tunnel releases: tsmath_sp_cr_daily
-	#		Net evaporation, leakage, other: tsmath_acc_dep
-
-	tsmath_storage_daily = tsmath.generateRegularIntervalTimeSeries(
-		"%s 0000"%(ops_start_date.date(4)),
-		"%s 2400"%(end_time.date(4)),
-		"1DAY", "0M", 0.0)
-	tsmath_storage_daily.setUnits("AC-FT")
-	tsmath_storage_daily.setType("INST-VAL")
-	tsmath_storage_daily.setTimeInterval("1DAY")
-	tsmath_storage_daily.setWatershed("CLEAR CREEK")
-	tsmath_storage_daily.setLocation("WHISKEYTOWN LAKE")
-	tsmath_storage_daily.setParameterPart("STORAGE-CVP")
-	tsmath_storage_daily.setVersion(BC_F_part)
-	tsmath_storage_daily.getContainer().values[0] = tsmath_storage_monthly.getContainer().values[0]
-	tsmath_release_daily = CVP.uniform_transform_monthly_to_daily(
-		tsmath_release_monthly, start_day_count=days_in_first_month)
-	tsmath_sp_cr_daily = CVP.uniform_transform_monthly_to_daily(
-		tsmath_sp_cr_monthly, start_day_count=days_in_first_month)
-	tsmath_carr_release_daily = CVP.uniform_transform_monthly_to_daily(
-		tsmath_carr_release_monthly, start_day_count=days_in_first_month)
-
-	j = 1
-	search_time = HecTime()
-	for i in range(1, len(tsmath_storage_daily.getContainer().values)):
-		if tsmath_storage_daily.getContainer().times[i] >= tsmath_storage_monthly.getContainer().times[j]:
-			tsmath_storage_daily.getContainer().values[i] = tsmath_storage_monthly.getContainer().values[j]
-			j += 1
-		else:
-			search_time.set(tsmath_storage_daily.getContainer().times[i])
-			tsmath_storage_daily.getContainer().values[i] = (
-				tsmath_storage_daily.getContainer().values[i-1] + 1.98347*(
-				tsmath_weighted.getContainer().getValue(search_time)
-				+ tsmath_carr_release_daily.getContainer().getValue(search_time)
-				- tsmath_release_daily.getContainer().getValue(search_time)
-				- tsmath_sp_cr_daily.getContainer().getValue(search_time)
-				+ tsmath_acc_dep.getContainer().getValue(search_time)))
-	tsm_list.append(tsmath_storage_daily)
-
-	tsm_list.append(tsmath_acc_dep)
-	tsm_list.append(tsmath_bal_whsky)
-	balance_list.append(tsmath_bal_whsky)
-
-
-	########################
-	# Shasta/Keswick & main-stem Sacramento data from CVP spreadsheet
-	########################
-	print "TS Location = %s"%(shasta_tsc_list[0].location.upper())
-	tsmath_acc_dep = tsmath.generateRegularIntervalTimeSeries(
-		"%s 0000"%(ops_start_date.date(4)),
-		"%s 2400"%(end_time.date(4)),
-		"1DAY", "0M", 0.0)
-	tsmath_acc_dep.setUnits("CFS")
-	tsmath_acc_dep.setType("PER-AVER")
-	tsmath_acc_dep.setTimeInterval("1DAY")
-	tsmath_acc_dep.setWatershed("SACRAMENTO RIVER")
-	tsmath_acc_dep.setLocation("SHASTA LAKE")
-	tsmath_acc_dep.setParameterPart("FLOW-ACC-DEP")
-	tsmath_acc_dep.setVersion(BC_F_part)
-	tsmath_bal_shasta = tsmath.generateRegularIntervalTimeSeries(
-		"%s 0000"%(ops_start_date.date(4)),
-		"%s 2400"%(end_time.date(4)),
-		"1MONTH", "0M", 0.0)
-	tsmath_bal_shasta.setUnits("AC-FT")
-	tsmath_bal_shasta.setType("PER-CUM")
-	tsmath_bal_shasta.setTimeInterval("1MONTH")
-	tsmath_bal_shasta.setWatershed("SACRAMENTO RIVER")
-	tsmath_bal_shasta.setLocation("SHASTA LAKE")
-	tsmath_bal_shasta.setParameterPart("VOLUME-BALANCE")
-	tsmath_bal_shasta.setVersion(BC_F_part)
-	for ts in shasta_tsc_list:
-		print "\tTS Parameter = %s"%(ts.parameter.upper())
-		tsm = tsmath(ts)
-		tsm.setWatershed("SACRAMENTO RIVER")
-		tsm.setLocation("SHASTA LAKE")
-		if "INFLOW" in ts.parameter.upper():
-			tsmath_flow_monthly = tsm
-			tsm_list.append(tsmath_flow_monthly)
-			tsmath_bal_shasta = tsmath_bal_shasta.add(tsmath_flow_monthly)
-			print "\treading pattern from file: " + shasta_pattern_DSS_file_name
-			print "\t\t" + shasta_pattern_path
-			ts_read = hec.heclib.dss.HecTimeSeries()
-			ts_read.setDSSFileName(shasta_pattern_DSS_file_name)
-			tsc_pattern = tscont()
-			tsc_pattern.fullName = shasta_pattern_path
-			status = ts_read.read(tsc_pattern, False)
-			if status < 0:
-				print "Failed to read pattern time series %s \n\tfrom DSS file %s"%(tsc_pattern.fullName, shasta_pattern_DSS_file_name)
-				ts_read.done()
-				continue
-			tsmath_pattern = tsmath(tsc_pattern)
-			ts_read.done()
-			tsmath_weighted = CVP.weight_transform_monthly_to_daily(
-				tsmath_flow_monthly, tsmath_pattern, start_day_count=days_in_first_month)
-			tsmath_weighted.setPathname(ts.fullName)
-			tsmath_weighted.setTimeInterval("1DAY")
-			tsmath_weighted.setParameterPart("FLOW-IN")
-			tsmath_weighted.setVersion(BC_F_part)
-			tsm_list.append(tsmath_weighted)
-		elif "STORAGE" in ts.parameter.upper():
-			tsmath_storage_monthly = tsm
-			tsmath_storage_monthly.setParameterPart("STORAGE")
-			tsmath_storage_monthly.setType("INST-CUM")
-			tsm_storage_change = tsmath_storage_monthly.successiveDifferences()
-			tsmath_storage_monthly.setType("INST-VAL")
-			tsm_list.append(tsmath_storage_monthly)
-			tsm_storage_change.setWatershed("SACRAMENTO RIVER")
-			tsm_storage_change.setLocation("SHASTA LAKE")
-			tsm_storage_change.setParameterPart("STORAGE-CHANGE")
-			tsm_list.append(tsm_storage_change)
-			tsmath_bal_shasta = tsmath_bal_shasta.subtract(tsm_storage_change)
-		elif "EVAP" in ts.parameter.upper():
-			tsmath_evap_monthly = tsm
-			tsmath_evap_monthly.setParameterPart("VOLUME-EST EVAPORATION")
-			tsm_list.append(tsmath_evap_monthly)
-			tsmath_bal_shasta = tsmath_bal_shasta.subtract(tsmath_evap_monthly)
-			tsmath_acc_dep = tsmath_acc_dep.subtract(
-				CVP.uniform_transform_monthly_to_daily(
+	def trinity_stage():
+		tsm_list = []
+		########################
+		# Trinity-Clair Engle and Lewiston
+		# data from CVP spreadsheet
+		########################
+		print "TS Location = %s"%(trinity_tsc_list[0].location.upper())
+		tsmath_acc_dep = tsmath.generateRegularIntervalTimeSeries(
+			"%s 0000"%(ops_start_date.date(4)),
+			"%s 2400"%(end_time.date(4)),
+			"1DAY", "0M", 0.0)
+		tsmath_acc_dep.setUnits("CFS")
+		tsmath_acc_dep.setType("PER-AVER")
+		tsmath_acc_dep.setTimeInterval("1DAY")
+		tsmath_acc_dep.setWatershed("TRINITY RIVER")
+		tsmath_acc_dep.setLocation("TRINITY LAKE")
+		tsmath_acc_dep.setParameterPart("FLOW-ACC-DEP")
+		tsmath_acc_dep.setVersion(BC_F_part)
+		tsmath_bal_trnty = tsmath.generateRegularIntervalTimeSeries(
+			"%s 0000"%(ops_start_date.date(4)),
+			"%s 2400"%(end_time.date(4)),
+			"1MONTH", "0M", 0.0)
+		tsmath_bal_trnty.setUnits("AC-FT")
+		tsmath_bal_trnty.setType("PER-CUM")
+		tsmath_bal_trnty.setTimeInterval("1MONTH")
+		tsmath_bal_trnty.setWatershed("TRINITY RIVER")
+		tsmath_bal_trnty.setLocation("TRINITY LAKE")
+		tsmath_bal_trnty.setParameterPart("VOLUME-BALANCE")
+		tsmath_bal_trnty.setVersion(BC_F_part)
+		for ts in trinity_tsc_list:
+			print "\tTS Parameter = %s"%(ts.parameter.upper())
+			tsm = tsmath(ts)
+			tsm.setWatershed("TRINITY RIVER")
+			tsm.setLocation("TRINITY LAKE")
+			if ts.parameter.upper() == "INFLOW":
+				tsmath_flow_monthly = tsm
+				tsm_list.append(tsmath_flow_monthly)
+				tsmath_bal_trnty = tsmath_bal_trnty.add(tsmath_flow_monthly)
+				print "reading Trinity pattern from file: " + trinity_pattern_DSS_file_name
+				print "\tDSS path:" + trinity_pattern_path
+				tsc_pattern = dss_pool.read(trinity_pattern_DSS_file_name, trinity_pattern_path)
+				if tsc_pattern is None:
+					print "Failed to read pattern time series %s \n\tfrom DSS file %s"%(trinity_pattern_path, trinity_pattern_DSS_file_name)
+					continue
+				tsmath_pattern = tsmath(tsc_pattern)
+				tsmath_trinity_inflow_daily = CVP.weight_transform_monthly_to_daily(
+					tsmath_flow_monthly, tsmath_pattern, start_day_count=days_in_first_month)
+				tsmath_trinity_inflow_daily.setPathname(ts.fullName)
+				tsmath_trinity_inflow_daily.setWatershed("TRINITY RIVER")
+				tsmath_trinity_inflow_daily.setLocation("TRINITY LAKE")
+				tsmath_trinity_inflow_daily.setTimeInterval("1DAY")
+				tsmath_trinity_inflow_daily.setParameterPart("FLOW-IN")
+				tsmath_trinity_inflow_daily.setVersion(BC_F_part)
+				tsm_list.append(tsmath_trinity_inflow_daily)
+			elif "STORAGE" in ts.parameter.upper():
+				tsmath_storage_monthly = tsm
+				tsmath_storage_monthly.setParameterPart("STORAGE")
+				tsmath_storage_monthly.setType("INST-CUM")
+				tsm_storage_change = tsmath_storage_monthly.successiveDifferences()
+				tsmath_storage_monthly.setType("INST-VAL")
+				tsm_list.append(tsmath_storage_monthly)
+				tsm_storage_change.setWatershed("TRINITY RIVER")
+				tsm_storage_change.setLocation("TRINITY LAKE")
+				tsm_storage_change.setParameterPart("STORAGE-CHANGE")
+				tsm_list.append(tsm_storage_change)
+				tsmath_bal_trnty = tsmath_bal_trnty.subtract(tsm_storage_change)
+			elif "EVAP" in ts.parameter.upper():
+				tsmath_evap_monthly = tsm
+				tsmath_evap_monthly.setParameterPart("VOLUME-EST EVAPORATION")
+				tsm_list.append(tsmath_evap_monthly)
+				tsmath_bal_trnty = tsmath_bal_trnty.subtract(tsmath_evap_monthly)
+				tsmath_acc_dep = tsmath_acc_dep.subtract(
+					CVP.uniform_transform_monthly_to_daily(
 					tsmath_evap_monthly, start_day_count=days_in_first_month))
-		elif ts.parameter.upper() == "TOTAL SHASTA RELEASE":
-			tsmath_release_monthly = tsm
-			tsm_list.append(tsmath_release_monthly)
-			tsmath_bal_shasta = tsmath_bal_shasta.subtract(tsmath_release_monthly)
-			tsmath_release = CVP.uniform_transform_monthly_to_hourly(
-				tsmath_release_monthly, start_day_count=days_in_first_month)
-			tsmath_release.setPathname(ts.fullName)
-			tsmath_release.setTimeInterval("1HOUR")
-			tsmath_release.setParameterPart("FLOW-RELEASE")
-			tsmath_release.setVersion(BC_F_part)
-			tsm_list.append(tsmath_release)
-		elif ts.parameter.upper() == "FLOW-KESWICK-CFS":
-			tsmath_release_monthly = tsm
-			tsm_list.append(tsmath_release_monthly)
-			tsmath_release = CVP.uniform_transform_monthly_to_hourly(
-				tsmath_release_monthly, start_day_count=days_in_first_month)
-			tsmath_release.setPathname(ts.fullName)
-			tsmath_release.setTimeInterval("1HOUR")
-			tsmath_release.setParameterPart("FLOW-RELEASE-KESWICK-CFS")
-			tsmath_release.setVersion(BC_F_part)
-			tsm_list.append(tsmath_release)
-		else:
+				tsm_list.append(CVP.uniform_transform_monthly_to_daily(
+					tsmath_evap_monthly, start_day_count=days_in_first_month))
+			elif ts.parameter.upper() == "TOTAL RELEASE":
+				tsmath_trinity_release_monthly = tsm
+				tsmath_trinity_release_monthly.setParameterPart("VOLUME-RELEASE")
+				tsm_list.append(tsmath_trinity_release_monthly)
+				tsmath_trinity_release = CVP.uniform_transform_monthly_to_hourly(
+					tsmath_trinity_release_monthly, start_day_count=days_in_first_month)
+				tsmath_trinity_release.setWatershed("TRINITY RIVER")
+				tsmath_trinity_release.setLocation("TRINITY LAKE")
+				tsmath_trinity_release.setParameterPart("FLOW-RELEASE")
+				tsmath_trinity_release.setTimeInterval("1HOUR")
+				tsmath_trinity_release.setVersion(BC_F_part)
+				tsm_list.append(tsmath_trinity_release)
+			elif "RIVER REL" in ts.parameter.upper() and "CFS" in ts.parameter.upper():
+				tsmath_lewiston_release_flow_monthly = tsm
+				tsmath_lewiston_release_flow_monthly.setLocation("LEWISTON RESERVOIR")
+				tsmath_lewiston_release_flow_monthly.setParameterPart("FLOW-RIVER RELEASE")
+				# tsm_list.append(tsmath_lewiston_release_flow_monthly)
+			elif "RIVER REL" in ts.parameter.upper() and "TAF" in ts.parameter.upper():
+				tsmath_lewiston_release_monthly = tsm
+				tsmath_lewiston_release_monthly.setLocation("LEWISTON RESERVOIR")
+				tsmath_lewiston_release_monthly.setParameterPart("VOLUME-RIVER RELEASE")
+				tsm_list.append(tsmath_lewiston_release_monthly)
+				tsmath_bal_trnty = tsmath_bal_trnty.subtract(tsmath_lewiston_release_monthly)
+				tsmath_lewiston_release = CVP.uniform_transform_monthly_to_daily(
+					tsmath_lewiston_release_monthly, start_day_count=days_in_first_month)
+				tsmath_lewiston_release.setWatershed("TRINITY RIVER")
+				tsmath_lewiston_release.setLocation("LEWISTON RESERVOIR")
+				tsmath_lewiston_release.setParameterPart("FLOW-RIVER RELEASE")
+				tsmath_lewiston_release.setTimeInterval("1DAY")
+				tsmath_lewiston_release.setVersion(BC_F_part)
+				tsm_list.append(tsmath_lewiston_release)
+			elif ts.parameter.upper() == "CARR PP":
+				tsmath_carr_release_monthly = tsm
+				tsmath_carr_release_monthly.setWatershed("TRINITY RIVER")
+				tsmath_carr_release_monthly.setLocation("LEWISTON RESERVOIR")
+				tsmath_carr_release_monthly.setParameterPart("VOLUME-CLEAR CREEK DIVERSION")
+				tsm_list.append(tsmath_carr_release_monthly)
+				tsmath_bal_trnty = tsmath_bal_trnty.subtract(tsmath_carr_release_monthly)
+				tsmath_carr_release = CVP.uniform_transform_monthly_to_hourly(
+					tsm, start_day_count=days_in_first_month)
+				tsmath_carr_release.setWatershed("CLEAR CREEK")
+				tsmath_carr_release.setLocation("CARR POWERHOUSE")
+				tsmath_carr_release.setParameterPart("FLOW-RELEASE")
+				tsmath_carr_release.setTimeInterval("1HOUR")
+				tsmath_carr_release.setVersion(BC_F_part)
+				tsm_list.append(tsmath_carr_release)
+			else:
+				tsm_list.append(tsm)
+
+		# Trinity storage changes due to:
+		#	In:
+		#		Trinity inflow : tsmath_trinity_inflow_daily
+		#	Out:
+		#		Trinity dam releases: tsmath_release_daily
+		#		Net evaporation, leakage, other: tsmath_acc_dep
+
+		tsmath_storage_daily = tsmath.generateRegularIntervalTimeSeries(
+			"%s 0000"%(ops_start_date.date(4)),
+			"%s 2400"%(end_time.date(4)),
+			"1DAY", "0M", 0.0)
+		tsmath_storage_daily.setUnits("AC-FT")
+		tsmath_storage_daily.setType("INST-VAL")
+		tsmath_storage_daily.setTimeInterval("1DAY")
+		tsmath_storage_daily.setWatershed("TRINITY RIVER")
+		tsmath_storage_daily.setLocation("TRINITY LAKE")
+		tsmath_storage_daily.setParameterPart("STORAGE-CVP")
+		tsmath_storage_daily.setVersion(BC_F_part)
+		tsmath_release_daily = CVP.uniform_transform_monthly_to_daily(
+			tsmath_trinity_release_monthly, start_day_count=days_in_first_month)
+
+		storage_residual = CVP.daily_storage_balance(tsmath_storage_daily, tsmath_storage_monthly, [
+			(1, tsmath_trinity_inflow_daily), (-1, tsmath_release_daily), (1, tsmath_acc_dep)])
+		if DEBUG: print "Trinity storage closure: largest monthly reset %.1f ac-ft"%(max([abs(r) for r in storage_residual]))
+		tsm_list.append(tsmath_storage_daily)
+		tsm_list.append(tsmath_acc_dep)
+		tsm_list.append(tsmath_bal_trnty)
+		return {'tsm_list': tsm_list, 'balance': tsmath_bal_trnty,
+			'carr_release_monthly': tsmath_carr_release_monthly, 'inflow_daily': tsmath_trinity_inflow_daily}
+
+	def lewiston_airtemp_stage():
+		met_DSS_file_name = ""
+		airtemp_path = ""
+
+		for line in DSS_map_lines:
+			# print line
+			if (line.split(',')[0].strip().upper() == "LEWISTON RES" and
+				line.split(',')[1].strip().upper() == "AIR TEMPERATURE"):
+				met_DSS_file_name = line.split(',')[2].strip().strip('\\')
+				airtemp_path = line.split(',')[3].strip()
+				break
+		if len(met_DSS_file_name) == 0 or len(airtemp_path) == 0:
+			raise CVP.StageError("Error reading Trinity air temperature data configuration from file\n\t%s\n"%(DSS_map_filename) +
+				"Air temperature DSS file or path not found.")
+		if not os.path.isabs(met_DSS_file_name):
+			met_DSS_file_name = os.path.join(Project.getCurrentProject().getWorkspacePath(), met_DSS_file_name)
+
+		# met records queued in the same bulk write are not in the file yet
+		tsc_airtemp = bulk_writer.pending_record(met_DSS_file_name, airtemp_path)
+		if tsc_airtemp is None:
+			tsc_airtemp = dss_pool.read(met_DSS_file_name, airtemp_path)
+		if tsc_airtemp is None:
+			raise CVP.StageError("Failed to read air temperature time series %s \n\tfrom DSS file %s"%(airtemp_path, met_DSS_file_name))
+		# daily 7-day average in deg C, shared by the Trinity and Shasta tributary regressions
+		return CVP.prepare_regression_airtemp(tsmath(tsc_airtemp))
+
+	def trinity_tributary_stage(trinity, tsmath_airtemp_avg):
+		tsm_list = []
+		tsmath_trinity_inflow_daily = trinity['inflow_daily']
+		########################
+		# Disaggregate Trinity Lake Tributary In Flows
+		########################
+
+		# Table of tributary weights by month
+		tributary_weights = {
+			"EF TRINITY":(0.200999652, 0.201001041, 0.200998676, 0.200998663, 0.201001043, 0.200998535, 0.200996912, 0.201009666, 0.200970155, 0.200978909, 0.201003315, 0.201000536),
+			"STUART FORK":(0.119998966, 0.119998249, 0.120001072, 0.120000814, 0.119998453, 0.119997145, 0.120002941, 0.120069866, 0.120091685, 0.120009144, 0.119987691, 0.120004223),
+			"SWIFT CR":(0.114000898, 0.114002108, 0.114000033, 0.114001063, 0.113999875, 0.114002195, 0.114015586, 0.113944013, 0.114068202, 0.114014717, 0.113997178, 0.113996712),
+			"TRINITY RIVER":(0.565000485, 0.564998603, 0.565000218, 0.56499946, 0.56500063, 0.565002124, 0.564984561, 0.564976455, 0.564869961, 0.564997226, 0.565011814, 0.56499853)}
+		names_flows = {}
+		for tsm in CVP.split_time_series_monthly(tsmath_trinity_inflow_daily, tributary_weights, "FLOW-IN"):
+			tsm.setVersion(BC_F_part)
 			tsm_list.append(tsm)
+			names_flows[tsm.getContainer().location] = tsm
 
-	# Shasta storage changes due to:
-	#	In:
-	#		Shasta inflow: tsmath_weighted
-	#		Carr Powerhouse releases: tsmath_carr_release_daily
-	#	Out:
-	#		Shasta dam releases: tsmath_release_daily
-	#		Net evaporation, leakage, other: tsmath_acc_dep
-
-	tsmath_storage_daily = tsmath.generateRegularIntervalTimeSeries(
-		"%s 0000"%(ops_start_date.date(4)),
-		"%s 2400"%(end_time.date(4)),
-		"1DAY", "0M", 0.0)
-	tsmath_storage_daily.setUnits("AC-FT")
-	tsmath_storage_daily.setType("INST-VAL")
-	tsmath_storage_daily.setTimeInterval("1DAY")
-	tsmath_storage_daily.setWatershed("SACRAMENTO RIVER")
-	tsmath_storage_daily.setLocation("SHASTA LAKE")
-	tsmath_storage_daily.setParameterPart("STORAGE-CVP")
-	tsmath_storage_daily.setVersion(BC_F_part)
-	tsmath_storage_daily.getContainer().values[0] = tsmath_storage_monthly.getContainer().values[0]
-	tsmath_release_daily = CVP.uniform_transform_monthly_to_daily(
-		tsmath_release_monthly, start_day_count=days_in_first_month)
-
-	j = 1
-	search_time = HecTime()
-	for i in range(1, len(tsmath_storage_daily.getContainer().values)):
-		if tsmath_storage_daily.getContainer().times[i] >= tsmath_storage_monthly.getContainer().times[j]:
-			tsmath_storage_daily.getContainer().values[i] = tsmath_storage_monthly.getContainer().values[j]
-			j += 1
-		else:
-			search_time.set(tsmath_storage_daily.getContainer().times[i])
-			tsmath_storage_daily.getContainer().values[i] = (
-				tsmath_storage_daily.getContainer().values[i-1] + 1.98347*(
-				tsmath_weighted.getContainer().getValue(search_time)
-				+ tsmath_carr_release_daily.getContainer().getValue(search_time)
-				- tsmath_release_daily.getContainer().getValue(search_time)
-				- tsmath_sp_cr_daily.getContainer().getValue(search_time)
-				+ tsmath_acc_dep.getContainer().getValue(search_time)))
-	tsm_list.append(tsmath_storage_daily)
-
+		########################
+		# Estimate Trinity Tributary Temperatures
+		########################
 
-	tsm_list.append(tsmath_acc_dep)
-	tsm_list.append(tsmath_bal_shasta)
-	balance_list.append(tsmath_bal_shasta)
+		#River, Intercept (deg C), Flow Coef (cfs), Air Temp Coef (deg C), RMS Error (deg C)
+		tributary_temp_regression_coefficients = {
+			"EF TRINITY": (2.204979, -0.00208361, 0.65876114, 2.117),
+			"STUART FORK": (1.2766113, -0.00304511, 0.60274446, 1.9729857),
+			"SWIFT CR": (1.2773657, -0.00356459,  0.6329333, 2.0825596),
+			"TRINITY RIVER": (1.968627, -0.00075939, 0.6476875, 2.102819)}
 
-	########################
-	# Disaggregate Shasta Tributary In Flows
-	########################
-
-	tributary_weights = {
-		"Shasta-Sac-in":(0.212770745, 0.224327192, 0.221179858, 0.231031865, 0.22998096, 0.174508497, 0.096498474, 0.074162081, 0.066134982, 0.085930713, 0.110001981, 0.208573952),
-		"Shasta-McCloud-in":(0.138567582, 0.157547951, 0.139190927, 0.129798785, 0.107066929, 0.097430013, 0.099133208, 0.094616182, 0.097972639, 0.111942455, 0.109353393, 0.151801944),
-		"Shasta-Sulanharas-in":(0.037029058, 0.042679679, 0.040961806, 0.039603204, 0.037053932, 0.024035906, 0.01008518, 0.006934946, 0.006026154, 0.009676144, 0.013545787, 0.038994156),
-		"Shasta-Pit-in":(0.611632586, 0.575445235, 0.598667383, 0.599566102, 0.625898182, 0.704025567, 0.794283211, 0.824286819, 0.82986623, 0.792450666, 0.767098904, 0.600629926)}
-	names_flows = {}
-	for tsm in CVP.split_time_series_monthly(tsmath_weighted, tributary_weights, "FLOW-IN"):
-		tsm.setVersion(BC_F_part)
-		tsm_list.append(tsm)
-		names_flows[tsm.getContainer().location] = tsm
-
-	########################
-	# Estimate Shasta Tributary Temperatures
-	########################
-
-	#River, Intercept (deg C), Flow Coef (cfs), Air Temp Coef (deg C), RMS Error (deg C)
-	tributary_temp_regression_coefficients = {
-		"Shasta-Sac-in": (1.1597557, -2.5038779e-04, 0.62590134, 1.6474143),
-		"Shasta-Pit-in": (3.2822256, -1.541817e-04, 0.55336446, 1.4528962),
-		"Shasta-McCloud-in": (1.735364, 2.1436048e-04, 0.48995328, 1.1855532)}
-	ts_read = hec.heclib.dss.HecTimeSeries()
-	ts_read.setDSSFileName(met_DSS_file_name)
-	tsc_airtemp = tscont()
-	tsc_airtemp.fullName = airtemp_path
-	status = ts_read.read(tsc_airtemp, False)
-	if status < 0:
-		print "Failed to read pattern time series %s \n\tfrom DSS file %s"%(tsc_pattern.fullName, whiskeytown_pattern_DSS_file_name)
-		ts_read.done()
-	tsmath_airtemp = tsmath(tsc_airtemp)
-	ts_read.done()
-	for key in tributary_temp_regression_coefficients.keys():
-		tsm = CVP.evaluate_temp_regression(names_flows[key], tsmath_airtemp, tributary_temp_regression_coefficients[key])
-		tsm.setVersion(BC_F_part)
-		tsm_list.append(tsm)
-
-	########################
-	# Get flows and temperatures for downstream tributaries
-	# from monthly average data sets
-	########################
+		for tsm in CVP.evaluate_temp_regressions(names_flows, tsmath_airtemp_avg, tributary_temp_regression_coefficients):
+			tsm.setVersion(BC_F_part)
+			tsm_list.append(tsm)
+		return tsm_list
+
+	def whiskeytown_stage(trinity):
+		tsm_list = []
+		tsmath_carr_release_monthly = trinity['carr_release_monthly']
+		########################
+		# Whiskeytown and Clear Creek
+		# data from CVP spreadsheet
+		########################
+		print "TS Location = %s"%(whiskeytown_tsc_list[0].location.upper())
+		tsmath_acc_dep = tsmath.generateRegularIntervalTimeSeries(
+			"%s 0000"%(ops_start_date.date(4)),
+			"%s 2400"%(end_time.date(4)),
+			"1DAY", "0M", 0.0)
+		tsmath_acc_dep.setUnits("CFS")
+		tsmath_acc_dep.setType("PER-AVER")
+		tsmath_acc_dep.setTimeInterval("1DAY")
+		tsmath_acc_dep.setWatershed("CLEAR CREEK")
+		tsmath_acc_dep.setLocation("WHISKEYTOWN LAKE")
+		tsmath_acc_dep.setParameterPart("FLOW-ACC-DEP")
+		tsmath_acc_dep.setVersion(BC_F_part)
+		tsmath_bal_whsky = tsmath.generateRegularIntervalTimeSeries(
+			"%s 0000"%(ops_start_date.date(4)),
+			"%s 2400"%(end_time.date(4)),
+			"1MONTH", "0M", 0.0)
+		tsmath_bal_whsky.setUnits("AC-FT")
+		tsmath_bal_whsky.setType("PER-CUM")
+		tsmath_bal_whsky.setTimeInterval("1MONTH")
+		tsmath_bal_whsky.setWatershed("CLEAR CREEK")
+		tsmath_bal_whsky.setLocation("WHISKEYTOWN LAKE")
+		tsmath_bal_whsky.setParameterPart("VOLUME-BALANCE")
+		tsmath_bal_whsky.setVersion(BC_F_part)
+		tsmath_bal_whsky = tsmath_bal_whsky.add(tsmath_carr_release_monthly)
+		for ts in whiskeytown_tsc_list:
+			print "\tTS Parameter = %s"%(ts.parameter.upper())
+			tsm = tsmath(ts)
+			tsm.setWatershed("CLEAR CREEK")
+			tsm.setLocation("WHISKEYTOWN LAKE")
+			if ts.parameter.upper() == "INFLOW":
+				tsmath_flow_monthly = tsm
+				tsm_list.append(tsmath_flow_monthly)
+				tsmath_bal_whsky = tsmath_bal_whsky.add(tsmath_flow_monthly)
+				print "reading pattern from file: " + whiskeytown_pattern_DSS_file_name
+				print "\t" + whiskeytown_pattern_path
+				tsc_pattern = dss_pool.read(whiskeytown_pattern_DSS_file_name, whiskeytown_pattern_path)
+				if tsc_pattern is None:
+					print "Failed to read pattern time series %s \n\tfrom DSS file %s"%(whiskeytown_pattern_path, whiskeytown_pattern_DSS_file_name)
+					continue
+				tsmath_pattern = tsmath(tsc_pattern)
+				tsmath_weighted = CVP.weight_transform_monthly_to_daily(
+					tsmath_flow_monthly, tsmath_pattern, start_day_count=days_in_first_month)
+				tsmath_weighted.setPathname(ts.fullName)
+				tsmath_weighted.setTimeInterval("1DAY")
+				tsmath_weighted.setParameterPart("FLOW-IN")
+				tsmath_weighted.setVersion(BC_F_part)
+				tsm_list.append(tsmath_weighted)
+			elif "STORAGE" in ts.parameter.upper():
+				tsmath_storage_monthly = tsm
+				tsmath_storage_monthly.setParameterPart("STORAGE")
+				tsmath_storage_monthly.setType("INST-CUM")
+				tsm_storage_change = tsmath_storage_monthly.successiveDifferences()
+				tsmath_storage_monthly.setType("INST-VAL")
+				tsm_list.append(tsmath_storage_monthly)
+				tsm_storage_change.setWatershed("CLEAR CREEK")
+				tsm_storage_change.setLocation("WHISKEYTOWN LAKE")
+				tsm_storage_change.setParameterPart("STORAGE-CHANGE")
+				tsm_list.append(tsm_storage_change)
+				tsmath_bal_whsky = tsmath_bal_whsky.subtract(tsm_storage_change)
+			elif "SPRING CR" in ts.parameter.upper():
+				tsmath_sp_cr_monthly = tsm
+				tsm_list.append(tsmath_sp_cr_monthly)
+				tsmath_bal_whsky = tsmath_bal_whsky.subtract(tsmath_sp_cr_monthly)
+				tsmath_sp_cr = CVP.uniform_transform_monthly_to_hourly(
+					tsm, start_day_count=days_in_first_month)
+				tsmath_sp_cr.setPathname(ts.fullName)
+				tsmath_sp_cr.setLocation("SPRING CREEK")
+				tsmath_sp_cr.setTimeInterval("1HOUR")
+				tsmath_sp_cr.setParameterPart("FLOW-PP")
+				tsmath_sp_cr.setVersion(BC_F_part)
+				tsm_list.append(tsmath_sp_cr)
+			elif "EVAP" in ts.parameter.upper():
+				tsmath_evap_monthly = tsm
+				tsmath_evap_monthly.setParameterPart("VOLUME-EST EVAPORATION")
+				tsm_list.append(tsmath_evap_monthly)
+				tsmath_bal_whsky = tsmath_bal_whsky.subtract(tsmath_evap_monthly)
+				tsmath_acc_dep = tsmath_acc_dep.subtract(
+					CVP.uniform_transform_monthly_to_daily(
+					tsmath_evap_monthly, start_day_count=days_in_first_month))
+			elif "CLEAR CREEK" in ts.parameter.upper() and "TAF" in ts.parameter.upper():
+				tsmath_release_monthly = tsm
+				tsmath_release_monthly.setLocation("WHISKEYTOWN DAM")
+				tsm_list.append(tsmath_release_monthly)
+				tsmath_bal_whsky = tsmath_bal_whsky.subtract(tsmath_release_monthly)
+				tsmath_release = CVP.uniform_transform_monthly_to_hourly(
+					tsmath_release_monthly, start_day_count=days_in_first_month)
+				tsmath_release.setPathname(tsmath_release_monthly.getContainer().fullName)
+				tsmath_release.setLocation("WHISKEYTOWN DAM")
+				tsmath_release.setTimeInterval("1HOUR")
+				tsmath_release.setParameterPart("FLOW-RELEASE")
+				tsmath_release.setVersion(BC_F_part)
+				tsm_list.append(tsmath_release)
+			else:
+				tsm_list.append(tsm)
+
+		# Whiskeytown storage changes due to:
+		#	In:
+		#		Clear Creek inflow: tsmath_weighted
+		#		Carr Powerhouse releases: tsmath_carr_release_daily
+		#	Out:
+		#		Whiskeytown dam releases: tsmath_release_daily
+		#		Spring Creek Tunnel releases: tsmath_sp_cr_daily
+		#		Net evaporation, leakage, other: tsmath_acc_dep
+
+		tsmath_storage_daily = tsmath.generateRegularIntervalTimeSeries(
+			"%s 0000"%(ops_start_date.date(4)),
+			"%s 2400"%(end_time.date(4)),
+			"1DAY", "0M", 0.0)
+		tsmath_storage_daily.setUnits("AC-FT")
+		tsmath_storage_daily.setType("INST-VAL")
+		tsmath_storage_daily.setTimeInterval("1DAY")
+		tsmath_storage_daily.setWatershed("CLEAR CREEK")
+		tsmath_storage_daily.setLocation("WHISKEYTOWN LAKE")
+		tsmath_storage_daily.setParameterPart("STORAGE-CVP")
+		tsmath_storage_daily.setVersion(BC_F_part)
+		tsmath_release_daily = CVP.uniform_transform_monthly_to_daily(
+			tsmath_release_monthly, start_day_count=days_in_first_month)
+		tsmath_sp_cr_daily = CVP.uniform_transform_monthly_to_daily(
+			tsmath_sp_cr_monthly, start_day_count=days_in_first_month)
+		tsmath_carr_release_daily = CVP.uniform_transform_monthly_to_daily(
+			tsmath_carr_release_monthly, start_day_count=days_in_first_month)
+
+		storage_residual = CVP.daily_storage_balance(tsmath_storage_daily, tsmath_storage_monthly, [
+			(1, tsmath_weighted), (1, tsmath_carr_release_daily), (-1, tsmath_release_daily),
+			(-1, tsmath_sp_cr_daily), (1, tsmath_acc_dep)])
+		if DEBUG: print "Whiskeytown storage closure: largest monthly reset %.1f ac-ft"%(max([abs(r) for r in storage_residual]))
+		tsm_list.append(tsmath_storage_daily)
+
+		tsm_list.append(tsmath_acc_dep)
+		tsm_list.append(tsmath_bal_whsky)
+		return {'tsm_list': tsm_list, 'balance': tsmath_bal_whsky,
+			'carr_release_daily': tsmath_carr_release_daily, 'sp_cr_daily': tsmath_sp_cr_daily}
+
+	def shasta_stage(whiskeytown):
+		tsm_list = []
+		tsmath_carr_release_daily = whiskeytown['carr_release_daily']
+		tsmath_sp_cr_daily = whiskeytown['sp_cr_daily']
+		########################
+		# Shasta/Keswick & main-stem Sacramento data from CVP spreadsheet
+		########################
+		print "TS Location = %s"%(shasta_tsc_list[0].location.upper())
+		tsmath_acc_dep = tsmath.generateRegularIntervalTimeSeries(
+			"%s 0000"%(ops_start_date.date(4)),
+			"%s 2400"%(end_time.date(4)),
+			"1DAY", "0M", 0.0)
+		tsmath_acc_dep.setUnits("CFS")
+		tsmath_acc_dep.setType("PER-AVER")
+		tsmath_acc_dep.setTimeInterval("1DAY")
+		tsmath_acc_dep.setWatershed("SACRAMENTO RIVER")
+		tsmath_acc_dep.setLocation("SHASTA LAKE")
+		tsmath_acc_dep.setParameterPart("FLOW-ACC-DEP")
+		tsmath_acc_dep.setVersion(BC_F_part)
+		tsmath_bal_shasta = tsmath.generateRegularIntervalTimeSeries(
+			"%s 0000"%(ops_start_date.date(4)),
+			"%s 2400"%(end_time.date(4)),
+			"1MONTH", "0M", 0.0)
+		tsmath_bal_shasta.setUnits("AC-FT")
+		tsmath_bal_shasta.setType("PER-CUM")
+		tsmath_bal_shasta.setTimeInterval("1MONTH")
+		tsmath_bal_shasta.setWatershed("SACRAMENTO RIVER")
+		tsmath_bal_shasta.setLocation("SHASTA LAKE")
+		tsmath_bal_shasta.setParameterPart("VOLUME-BALANCE")
+		tsmath_bal_shasta.setVersion(BC_F_part)
+		for ts in shasta_tsc_list:
+			print "\tTS Parameter = %s"%(ts.parameter.upper())
+			tsm = tsmath(ts)
+			tsm.setWatershed("SACRAMENTO RIVER")
+			tsm.setLocation("SHASTA LAKE")
+			if "INFLOW" in ts.parameter.upper():
+				tsmath_flow_monthly = tsm
+				tsm_list.append(tsmath_flow_monthly)
+				tsmath_bal_shasta = tsmath_bal_shasta.add(tsmath_flow_monthly)
+				print "\treading pattern from file: " + shasta_pattern_DSS_file_name
+				print "\t\t" + shasta_pattern_path
+				tsc_pattern = dss_pool.read(shasta_pattern_DSS_file_name, shasta_pattern_path)
+				if tsc_pattern is None:
+					print "Failed to read pattern time series %s \n\tfrom DSS file %s"%(shasta_pattern_path, shasta_pattern_DSS_file_name)
+					continue
+				tsmath_pattern = tsmath(tsc_pattern)
+				tsmath_weighted = CVP.weight_transform_monthly_to_daily(
+					tsmath_flow_monthly, tsmath_pattern, start_day_count=days_in_first_month)
+				tsmath_weighted.setPathname(ts.fullName)
+				tsmath_weighted.setTimeInterval("1DAY")
+				tsmath_weighted.setParameterPart("FLOW-IN")
+				tsmath_weighted.setVersion(BC_F_part)
+				tsm_list.append(tsmath_weighted)
+			elif "STORAGE" in ts.parameter.upper():
+				tsmath_storage_monthly = tsm
+				tsmath_storage_monthly.setParameterPart("STORAGE")
+				tsmath_storage_monthly.setType("INST-CUM")
+				tsm_storage_change = tsmath_storage_monthly.successiveDifferences()
+				tsmath_storage_monthly.setType("INST-VAL")
+				tsm_list.append(tsmath_storage_monthly)
+				tsm_storage_change.setWatershed("SACRAMENTO RIVER")
+				tsm_storage_change.setLocation("SHASTA LAKE")
+				tsm_storage_change.setParameterPart("STORAGE-CHANGE")
+				tsm_list.append(tsm_storage_change)
+				tsmath_bal_shasta = tsmath_bal_shasta.subtract(tsm_storage_change)
+			elif "EVAP" in ts.parameter.upper():
+				tsmath_evap_monthly = tsm
+				tsmath_evap_monthly.setParameterPart("VOLUME-EST EVAPORATION")
+				tsm_list.append(tsmath_evap_monthly)
+				tsmath_bal_shasta = tsmath_bal_shasta.subtract(tsmath_evap_monthly)
+				tsmath_acc_dep = tsmath_acc_dep.subtract(
+					CVP.uniform_transform_monthly_to_daily(
+						tsmath_evap_monthly, start_day_count=days_in_first_month))
+			elif ts.parameter.upper() == "TOTAL SHASTA RELEASE":
+				tsmath_release_monthly = tsm
+				tsm_list.append(tsmath_release_monthly)
+				tsmath_bal_shasta = tsmath_bal_shasta.subtract(tsmath_release_monthly)
+				tsmath_release = CVP.uniform_transform_monthly_to_hourly(
+					tsmath_release_monthly, start_day_count=days_in_first_month)
+				tsmath_release.setPathname(ts.fullName)
+				tsmath_release.setTimeInterval("1HOUR")
+				tsmath_release.setParameterPart("FLOW-RELEASE")
+				tsmath_release.setVersion(BC_F_part)
+				tsm_list.append(tsmath_release)
+			elif ts.parameter.upper() == "FLOW-KESWICK-CFS":
+				tsmath_release_monthly = tsm
+				tsm_list.append(tsmath_release_monthly)
+				tsmath_release = CVP.uniform_transform_monthly_to_hourly(
+					tsmath_release_monthly, start_day_count=days_in_first_month)
+				tsmath_release.setPathname(ts.fullName)
+				tsmath_release.setTimeInterval("1HOUR")
+				tsmath_release.setParameterPart("FLOW-RELEASE-KESWICK-CFS")
+				tsmath_release.setVersion(BC_F_part)
+				tsm_list.append(tsmath_release)
+			else:
+				tsm_list.append(tsm)
+
+		# Shasta storage changes due to:
+		#	In:
+		#		Shasta inflow: tsmath_weighted
+		#		Carr Powerhouse releases: tsmath_carr_release_daily
+		#	Out:
+		#		Shasta dam releases: tsmath_release_daily
+		#		Net evaporation, leakage, other: tsmath_acc_dep
+
+		tsmath_storage_daily = tsmath.generateRegularIntervalTimeSeries(
+			"%s 0000"%(ops_start_date.date(4)),
+			"%s 2400"%(end_time.date(4)),
+			"1DAY", "0M", 0.0)
+		tsmath_storage_daily.setUnits("AC-FT")
+		tsmath_storage_daily.setType("INST-VAL")
+		tsmath_storage_daily.setTimeInterval("1DAY")
+		tsmath_storage_daily.setWatershed("SACRAMENTO RIVER")
+		tsmath_storage_daily.setLocation("SHASTA LAKE")
+		tsmath_storage_daily.setParameterPart("STORAGE-CVP")
+		tsmath_storage_daily.setVersion(BC_F_part)
+		tsmath_release_daily = CVP.uniform_transform_monthly_to_daily(
+			tsmath_release_monthly, start_day_count=days_in_first_month)
+
+		storage_residual = CVP.daily_storage_balance(tsmath_storage_daily, tsmath_storage_monthly, [
+			(1, tsmath_weighted), (1, tsmath_carr_release_daily), (-1, tsmath_release_daily),
+			(-1, tsmath_sp_cr_daily), (1, tsmath_acc_dep)])
+		if DEBUG: print "Shasta storage closure: largest monthly reset %.1f ac-ft"%(max([abs(r) for r in storage_residual]))
+		tsm_list.append(tsmath_storage_daily)
+
+
+		tsm_list.append(tsmath_acc_dep)
+		tsm_list.append(tsmath_bal_shasta)
+		return {'tsm_list': tsm_list, 'balance': tsmath_bal_shasta, 'inflow_daily': tsmath_weighted}
+
+	def shasta_tributary_stage(shasta, tsmath_airtemp_avg):
+		tsm_list = []
+		tsmath_weighted = shasta['inflow_daily']
+		########################
+		# Disaggregate Shasta Tributary In Flows
+		########################
+
+		tributary_weights = {
+			"Shasta-Sac-in":(0.212770745, 0.224327192, 0.221179858, 0.231031865, 0.22998096, 0.174508497, 0.096498474, 0.074162081, 0.066134982, 0.085930713, 0.110001981, 0.208573952),
+			"Shasta-McCloud-in":(0.138567582, 0.157547951, 0.139190927, 0.129798785, 0.107066929, 0.097430013, 0.099133208, 0.094616182, 0.097972639, 0.111942455, 0.109353393, 0.151801944),
+			"Shasta-Sulanharas-in":(0.037029058, 0.042679679, 0.040961806, 0.039603204, 0.037053932, 0.024035906, 0.01008518, 0.006934946, 0.006026154, 0.009676144, 0.013545787, 0.038994156),
+			"Shasta-Pit-in":(0.611632586, 0.575445235, 0.598667383, 0.599566102, 0.625898182, 0.704025567, 0.794283211, 0.824286819, 0.82986623, 0.792450666, 0.767098904, 0.600629926)}
+		names_flows = {}
+		for tsm in CVP.split_time_series_monthly(tsmath_weighted, tributary_weights, "FLOW-IN"):
+			tsm.setVersion(BC_F_part)
+			tsm_list.append(tsm)
+			names_flows[tsm.getContainer().location] = tsm
+
+		########################
+		# Estimate Shasta Tributary Temperatures
+		########################
+
+		#River, Intercept (deg C), Flow Coef (cfs), Air Temp Coef (deg C), RMS Error (deg C)
+		tributary_temp_regression_coefficients = {
+			"Shasta-Sac-in": (1.1597557, -2.5038779e-04, 0.62590134, 1.6474143),
+			"Shasta-Pit-in": (3.2822256, -1.541817e-04, 0.55336446, 1.4528962),
+			"Shasta-McCloud-in": (1.735364, 2.1436048e-04, 0.48995328, 1.1855532)}
+		# Lewiston air temperature, as the sequential script used for Shasta; the Redding Airport
+		# record is only checked for in the map file
+		for tsm in CVP.evaluate_temp_regressions(names_flows, tsmath_airtemp_avg, tributary_temp_regression_coefficients):
+			tsm.setVersion(BC_F_part)
+			tsm_list.append(tsm)
+		return tsm_list
+
+	def downstream_tributary_stage():
+		tsm_list = []
+		########################
+		# Get flows and temperatures for downstream tributaries
+		# from monthly average data sets
+		########################
+
+		tributary_config_filename = os.path.join(Project.getCurrentProject().getWorkspacePath(), tributary_config_relpath)
+		for line in getConfigLines(tributary_config_filename):
+			token = line.split(',')
+			dss_file_name = token[-2].strip()
+			if not os.path.isabs(dss_file_name):
+				dss_file_name = os.path.join(Project.getCurrentProject().getWorkspacePath(), dss_file_name)
+			tsc_avg = dss_pool.read(dss_file_name, token[-1].strip())
+			if tsc_avg is None:
+				print "Failed to read temperature time series %s \n\tfrom DSS file %s"%(token[-1].strip(), dss_file_name)
+				continue
+			tsmath_avg = tsmath(tsc_avg)
+			tsmath_shift = shift_monthly_averages(tsmath_avg, start_time, end_time)
+			shift_path = token[-1].strip().split('/')
+			shift_path[6] = BC_F_part
+			tsmath_shift.getContainer().fullName = '/'.join(shift_path)
+			tsm_list.append(CVP.uniform_transform_monthly_to_daily(
+				tsmath_shift, start_day_count=days_in_first_month))
+		return tsm_list
+
+	stages = CVP.StageGraph()
+	stages.add("trinity", trinity_stage)
+	stages.add("lewiston airtemp", lewiston_airtemp_stage)
+	stages.add("trinity tributaries", trinity_tributary_stage, ("trinity", "lewiston airtemp"))
+	stages.add("whiskeytown", whiskeytown_stage, ("trinity",))
+	stages.add("shasta", shasta_stage, ("whiskeytown",))
+	stages.add("shasta tributaries", shasta_tributary_stage, ("shasta", "lewiston airtemp"))
+	stages.add("downstream tributaries", downstream_tributary_stage)
+	try:
+		stage_results = stages.run(max_workers)
+	except CVP.StageError as e:
+		print str(e)
+		return None
 
-	tributary_config_filename = os.path.join(Project.getCurrentProject().getWorkspacePath(), r"forecast\config\tributary_averages.config")
-	trib_DSS_files = {}
-	for line in getConfigLines(tributary_config_filename):
-		token = line.split(',')
-		dss_file_name = token[-2].strip()
-		if not os.path.isabs(dss_file_name):
-			dss_file_name = os.path.join(Project.getCurrentProject().getWorkspacePath(), dss_file_name)
-		ts_read = hec.heclib.dss.HecTimeSeries()
-		ts_read.setDSSFileName(dss_file_name)
-		tsc_avg = tscont()
-		tsc_avg.fullName = token[-1].strip()
-		status = ts_read.read(tsc_avg, False)
-		if status < 0:
-			print "Failed to read temperature time series %s \n\tfrom DSS file %s"%(tsc_avg.fullName, dss_file_name)
-			ts_read.done()
-			continue
-		tsmath_avg = tsmath(tsc_avg)
-		tsmath_shift = shift_monthly_averages(tsmath_avg, start_time, end_time)
-		shift_path = token[-1].strip().split('/')
-		shift_path[6] = BC_F_part
-		tsmath_shift.getContainer().fullName = '/'.join(shift_path)
-		tsm_list.append(CVP.uniform_transform_monthly_to_daily(
-			tsmath_shift, start_day_count=days_in_first_month))
-	for fname in trib_DSS_files:
-		trib_DSS_files[fname].done()
+	tsm_list = (stage_results["trinity"]['tsm_list'] + stage_results["trinity tributaries"] +
+		stage_results["whiskeytown"]['tsm_list'] + stage_results["shasta"]['tsm_list'] +
+		stage_results["shasta tributaries"] + stage_results["downstream tributaries"])
+	balance_list = [stage_results[name]['balance'] for name in ("trinity", "whiskeytown", "shasta")]
 
 	########################
 	# Check balances
@@ -1047,101 +1214,40 @@ def create_ops_BC_data(ops_file_name, start_time, end_time, BC_output_DSS_filena
 	# Zero-Flow Time Series
 	########################
 
-	tsmath_zero_flow_day = tsmath.generateRegularIntervalTimeSeries(
-		"%s 0000"%(ops_start_date.date(4)),
-		"%s 2400"%(end_time.date(4)),
-		"1DAY", "0M", 0.0)
-	tsmath_zero_flow_day.setUnits("CFS")
-	tsmath_zero_flow_day.setType("PER-AVER")
-	tsmath_zero_flow_day.setTimeInterval("1DAY")
-	tsmath_zero_flow_day.setLocation("ZERO-BY-DAY")
-	tsmath_zero_flow_day.setParameterPart("FLOW-ZERO")
-	tsmath_zero_flow_day.setVersion(BC_F_part)
-	tsm_list.append(tsmath_zero_flow_day)
-
-	tsmath_zero_flow_hour = tsmath.generateRegularIntervalTimeSeries(
-		"%s 0000"%(ops_start_date.date(4)),
-		"%s 2400"%(end_time.date(4)),
-		"1HOUR", "0M", 0.0)
-	tsmath_zero_flow_hour.setUnits("CFS")
-	tsmath_zero_flow_hour.setType("PER-AVER")
-	tsmath_zero_flow_hour.setTimeInterval("1Hour")
-	tsmath_zero_flow_hour.setLocation("ZERO-BY-HOUR")
-	tsmath_zero_flow_hour.setParameterPart("FLOW-ZERO")
-	tsmath_zero_flow_hour.setVersion(BC_F_part)
-	tsm_list.append(tsmath_zero_flow_hour)
-
-	tsmath_zero_gates_hour = tsmath.generateRegularIntervalTimeSeries(
-		"%s 0000"%(ops_start_date.date(4)),
-		"%s 2400"%(end_time.date(4)),
-		"1HOUR", "0M", 0.0)
-	tsmath_zero_gates_hour.setUnits("Count")
-	tsmath_zero_gates_hour.setType("INST-VAL")
-	tsmath_zero_gates_hour.setTimeInterval("1Hour")
-	tsmath_zero_gates_hour.setLocation("ZERO-BY-HOUR")
-	tsmath_zero_gates_hour.setParameterPart("GATES-ZERO")
-	tsmath_zero_gates_hour.setVersion(BC_F_part)
-	tsm_list.append(tsmath_zero_gates_hour)
-
-	tsmath_one_gate_hour = tsmath.generateRegularIntervalTimeSeries(
-		"%s 0000"%(ops_start_date.date(4)),
-		"%s 2400"%(end_time.date(4)),
-		"1HOUR", "0M", 1.0)
-	tsmath_one_gate_hour.setUnits("Count")
-	tsmath_one_gate_hour.setType("INST-VAL")
-	tsmath_one_gate_hour.setTimeInterval("1Hour")
-	tsmath_one_gate_hour.setLocation("ONE-BY-HOUR")
-	tsmath_one_gate_hour.setParameterPart("GATES-ONE")
-	tsmath_one_gate_hour.setVersion(BC_F_part)
-	tsm_list.append(tsmath_one_gate_hour)
-
-	tsmath_three_gate_hour = tsmath.generateRegularIntervalTimeSeries(
-		"%s 0000"%(ops_start_date.date(4)),
-		"%s 2400"%(end_time.date(4)),
-		"1HOUR", "0M", 3.0)
-	tsmath_three_gate_hour.setUnits("Count")
-	tsmath_three_gate_hour.setType("INST-VAL")
-	tsmath_three_gate_hour.setTimeInterval("1Hour")
-	tsmath_three_gate_hour.setLocation("THREE-BY-HOUR")
-	tsmath_three_gate_hour.setParameterPart("GATES-3")
-	tsmath_three_gate_hour.setVersion(BC_F_part)
-	tsm_list.append(tsmath_three_gate_hour)
-
-	tsmath_two_gate_hour = tsmath.generateRegularIntervalTimeSeries(
-		"%s 0000"%(ops_start_date.date(4)),
-		"%s 2400"%(end_time.date(4)),
-		"1HOUR", "0M", 2.0)
-	tsmath_two_gate_hour.setUnits("Count")
-	tsmath_two_gate_hour.setType("INST-VAL")
-	tsmath_two_gate_hour.setTimeInterval("1Hour")
-	tsmath_two_gate_hour.setLocation("TWO-BY-HOUR")
-	tsmath_two_gate_hour.setParameterPart("GATES-2")
-	tsmath_two_gate_hour.setVersion(BC_F_part)
-	tsm_list.append(tsmath_two_gate_hour)
-
-	tsmath_five_gates_hour = tsmath.generateRegularIntervalTimeSeries(
-		"%s 0000"%(ops_start_date.date(4)),
-		"%s 2400"%(end_time.date(4)),
-		"1HOUR", "0M", 5.0)
-	tsmath_five_gates_hour.setUnits("Count")
-	tsmath_five_gates_hour.setType("INST-VAL")
-	tsmath_five_gates_hour.setTimeInterval("1Hour")
-	tsmath_five_gates_hour.setLocation("FIVE-BY-HOUR")
-	tsmath_five_gates_hour.setParameterPart("GATES-FIVE")
-	tsmath_five_gates_hour.setVersion(BC_F_part)
-	tsm_list.append(tsmath_five_gates_hour)
-
+	# constant series share one buffer per interval, value and window; see CVP.ConstantSeriesFactory
+	constant_start = "%s 0000"%(ops_start_date.date(4))
+	constant_end = "%s 2400"%(end_time.date(4))
+	constant_list = [
+		CVP.constant_series.series(constant_start, constant_end, "1DAY", 0.0, "CFS", "PER-AVER", "ZERO-BY-DAY", "FLOW-ZERO", BC_F_part),
+		CVP.constant_series.series(constant_start, constant_end, "1HOUR", 0.0, "CFS", "PER-AVER", "ZERO-BY-HOUR", "FLOW-ZERO", BC_F_part),
+		CVP.constant_series.series(constant_start, constant_end, "1HOUR", 0.0, "Count", "INST-VAL", "ZERO-BY-HOUR", "GATES-ZERO", BC_F_part),
+		CVP.constant_series.series(constant_start, constant_end, "1HOUR", 1.0, "Count", "INST-VAL", "ONE-BY-HOUR", "GATES-ONE", BC_F_part),
+		CVP.constant_series.series(constant_start, constant_end, "1HOUR", 3.0, "Count", "INST-VAL", "THREE-BY-HOUR", "GATES-3", BC_F_part),
+		CVP.constant_series.series(constant_start, constant_end, "1HOUR", 2.0, "Count", "INST-VAL", "TWO-BY-HOUR", "GATES-2", BC_F_part),
+		CVP.constant_series.series(constant_start, constant_end, "1HOUR", 5.0, "Count", "INST-VAL", "FIVE-BY-HOUR", "GATES-FIVE", BC_F_part)]
+
+	if DEBUG: print "Transform cache: %d hits, %d misses"%(CVP.transform_cache.hits, CVP.transform_cache.misses)
+	if DEBUG: print "DSS record cache: %d hits, %d misses"%(CVP.dss_record_cache.hits, CVP.dss_record_cache.misses)
 	for tsmath_item in tsm_list:
-		ts_write = hec.heclib.dss.HecTimeSeries()
-		ts_write.setDSSFileName(BC_output_DSS_filename)
 		tsc = tsmath_item.getData()
 		rv_lines.append("%s,%s,%s,%s"%(
 			tsc.location, tsc.parameter,
 			Project.getCurrentProject().getRelativePath(BC_output_DSS_filename),
 			tsc.fullName))
 		if DEBUG: print "\t%s"%rv_lines[-1]
-		ts_write.write(tsc)
-		ts_write.done()
+		bulk_writer.add(BC_output_DSS_filename, tsc)
+	for tsc in constant_list:
+		rv_lines.append("%s,%s,%s,%s"%(
+			tsc.location, tsc.parameter,
+			Project.getCurrentProject().getRelativePath(BC_output_DSS_filename),
+			tsc.fullName))
+		if DEBUG: print "\t%s"%rv_lines[-1]
+		# unchanged constant records are left as they are
+		if not CVP.constant_series.is_written(dss_pool, BC_output_DSS_filename, tsc, constant_start, constant_end):
+			bulk_writer.add(BC_output_DSS_filename, tsc)
+	if flush_records and bulk_writer.flush() is None:
+		print "Boundary condition records were not written to %s"%(BC_output_DSS_filename)
+		return None
 
 	return rv_lines
 
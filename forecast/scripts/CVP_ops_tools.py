@@ -4,14 +4,28 @@ CVP_ops_tools
 stuff to process time series data out of Central Valley Progect operations spreadsheets
 '''
 
+import bisect
+import os
+import sys
+import threading
+from collections import OrderedDict
+import time
+import uuid
+
+import hec.heclib.dss
 import hec.heclib.util.HecTime as HecTime
 import hec.io.TimeSeriesContainer as tscont
 import hec.hecmath.TimeSeriesMath as tsmath
 import hec.lang.Const
 
+from jarray import zeros
+
 import java.lang
 import java.io.File
 import java.io.FileInputStream
+from java.util import Arrays
+from java.util.concurrent import Callable, Executors, ExecutorCompletionService
+from java.nio.file import Files, StandardCopyOption, AtomicMoveNotSupportedException
 
 from org.apache.poi.xssf.usermodel import XSSFWorkbook
 from org.apache.poi.hssf.usermodel import HSSFWorkbook
@@ -351,6 +365,110 @@ def make_ops_tsc(location_name, start_year, start_month, ts_line, data_type=None
 
 	return rv_tsc
 
+'''
+Least recently used cache of transformed time series
+Keys are built from the content of the input series (path, units, type, interval, times and
+values), the transform and its arguments, so a hit always matches what the transform would
+compute. Results are stored and returned as copies, so callers can change them freely.
+'''
+class TransformCache(object):
+	def __init__(self, max_entries=64):
+		self.max_entries = max_entries
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	# Identity of a TimeSeriesMath's contents; the values and times are kept to confirm a hash match
+	def series_key(self, tsm):
+		tsc = tsm.getContainer()
+		return (tsc.fullName, tsc.units, tsc.type, tsc.interval, tsc.numberValues,
+			Arrays.hashCode(tsc.times), Arrays.hashCode(tsc.values))
+
+	def same_series(self, tsm, saved):
+		tsc = tsm.getContainer()
+		return Arrays.equals(tsc.times, saved[0]) and Arrays.equals(tsc.values, saved[1])
+
+	def get(self, key, inputs):
+		self.lock.acquire()
+		try:
+			entry = self.entries.get(key)
+			if entry is not None and all([self.same_series(tsm, saved) for tsm, saved in zip(inputs, entry[0])]):
+				del self.entries[key]
+				self.entries[key] = entry
+				self.hits += 1
+				return tsmath(entry[1].getData())
+			self.misses += 1
+			return None
+		finally:
+			self.lock.release()
+
+	def put(self, key, inputs, result):
+		saved = [(tsm.getData().times, tsm.getData().values) for tsm in inputs]
+		self.lock.acquire()
+		try:
+			self.entries.pop(key, None)
+			self.entries[key] = (saved, tsmath(result.getData()))
+			while len(self.entries) > self.max_entries:
+				self.entries.popitem(last=False)
+		finally:
+			self.lock.release()
+
+	def clear(self):
+		self.lock.acquire()
+		try:
+			self.entries.clear()
+		finally:
+			self.lock.release()
+
+	# Wrap a transform taking one or more TimeSeriesMath inputs then a start_day_count
+	def wrap(self, transform, num_inputs=1):
+		def cached_transform(*args, **kwargs):
+			inputs = args[:num_inputs]
+			start_day_count = kwargs.get("start_day_count", args[num_inputs] if len(args) > num_inputs else None)
+			key = (transform.__name__, start_day_count) + tuple([self.series_key(tsm) for tsm in inputs])
+			result = self.get(key, inputs)
+			if result is None:
+				result = transform(*args, **kwargs)
+				self.put(key, inputs, result)
+			return result
+		cached_transform.__name__ = transform.__name__
+		cached_transform.__doc__ = transform.__doc__
+		return cached_transform
+
+transform_cache = TransformCache()
+
+'''
+Fill the output of a uniform monthly transform one month at a time
+Steps up to the first monthly time take the first value spread over start_day_count days; each
+later month's rate is looked up once and filled over the run of output steps ending at that
+month's last day (2400), whatever the output interval.
+'''
+def fill_uniform_months(tsc_result, tsc_months, start_day_count, input_is_acrefeet):
+	times = tsc_result.times
+	n = tsc_result.numberValues
+	first_month_time = tsc_months.times[0]
+	post_time = HecTime()
+	search_time = HecTime()
+
+	cfs_conversion = 1.
+	if input_is_acrefeet:
+		cfs_conversion = 0.50417/start_day_count
+	i = bisect.bisect_right(times, first_month_time, 0, n)
+	if i > 0:
+		Arrays.fill(tsc_result.values, 0, i, tsc_months.values[0]*cfs_conversion)
+
+	while i < n:
+		post_time.setMinutes(times[i])
+		month_days = get_days_in_month(post_time.month(), post_time.year())
+		search_time.setYearMonthDay(post_time.year(), post_time.month(), month_days, 1440)
+		cfs_conversion = 1.
+		if input_is_acrefeet:
+			cfs_conversion = 0.50417/month_days
+		j = max(i + 1, bisect.bisect_right(times, search_time.getMinutes(), i, n))
+		Arrays.fill(tsc_result.values, i, j, tsc_months.getValue(search_time)*cfs_conversion)
+		i = j
+
 '''
 turn monthly volumes into uniform daily average flows
   optional key-word argument specifies the number of days represented by a partial month at the
@@ -401,10 +519,6 @@ def uniform_transform_monthly_to_daily(tsmath_months, start_day_count=None, curr
 		print "Input time series starting at %s"%(str(start_time_in))
 		print "Output time series starting at %s"%(str(start_time_out))
 
-	# create HecTime objects for indexing the pattern and output time series
-	search_time = HecTime()
-	post_time = HecTime()
-
 	tsc_result = tsmath.generateRegularIntervalTimeSeries(start_time_out.date(8), end_time_in.date(8), "1DAY", "0M", 1.0).getData()
 	path_parts = tsc_months.fullName.split('/')
 	path_parts[5] = "1DAY"
@@ -420,28 +534,10 @@ def uniform_transform_monthly_to_daily(tsmath_months, start_day_count=None, curr
 		tsc_result.type = tsc_months.type
 		tsc_result.parameter = tsc_months.parameter
 
-	i = 0
-	for tm in tsc_result.times:
-		post_time.setMinutes(tm)
-		# print "post_time = " + post_time.date(4) + ' ' + str(post_time.minutesSinceMidnight())
-
-		cfs_conversion = 1.
-		if input_is_acrefeet:
-			if tm <= tsc_months.times[0]:
-				cfs_conversion = 0.50417/start_day_count
-			else:
-				cfs_conversion = 0.50417/get_days_in_month(post_time.month(), post_time.year())
-
-		if tm <= tsc_months.times[0]:
-			tsc_result.values[i] = tsc_months.values[0]*cfs_conversion
-		else:
-			search_time.setYearMonthDay(post_time.year(), post_time.month(),
-				get_days_in_month(post_time.month(), post_time.year()), 1440)
-			tsc_result.values[i] = tsc_months.getValue(search_time)*cfs_conversion
-
-		i += 1
+	fill_uniform_months(tsc_result, tsc_months, start_day_count, input_is_acrefeet)
 
 	return tsmath(tsc_result)
+uniform_transform_monthly_to_daily = transform_cache.wrap(uniform_transform_monthly_to_daily)
 
 '''
 turn monthly volumes into uniform hourly average flows
@@ -490,10 +586,6 @@ def uniform_transform_monthly_to_hourly(tsmath_months, start_day_count=None, cur
 		print "Input time series starting at %s"%(str(start_time_in))
 		print "Output time series starting at %s"%(str(start_time_out))
 
-	# create HecTime objects for indexing the pattern and output time series
-	search_time = HecTime()
-	post_time = HecTime()
-
 	tsc_result = tsmath.generateRegularIntervalTimeSeries(start_time_out.date(8), end_time_in.date(8), "1HOUR", "0M", 1.0).getData()
 	path_parts = tsc_months.fullName.split('/')
 	path_parts[5] = "1HOUR"
@@ -509,41 +601,101 @@ def uniform_transform_monthly_to_hourly(tsmath_months, start_day_count=None, cur
 		tsc_result.type = tsc_months.type
 		tsc_result.parameter = tsc_months.parameter
 
-	i = 0
-	for tm in tsc_result.times:
-		post_time.setMinutes(tm)
-		# print "post_time = " + post_time.date(4) + ' ' + str(post_time.minutesSinceMidnight())
+	fill_uniform_months(tsc_result, tsc_months, start_day_count, input_is_acrefeet)
 
-		cfs_conversion = 1.
-		if input_is_acrefeet:
-			if tm <= tsc_months.times[0]:
-				cfs_conversion = 0.50417/start_day_count
-			else:
-				cfs_conversion = 0.50417/get_days_in_month(post_time.month(), post_time.year())
-
-		if tm <= tsc_months.times[0]:
-			tsc_result.values[i] = tsc_months.values[0]*cfs_conversion
-		else:
-			search_time.setYearMonthDay(post_time.year(), post_time.month(),
-				get_days_in_month(post_time.month(), post_time.year()), 1440)
-			tsc_result.values[i] = tsc_months.getValue(search_time)*cfs_conversion
+	return tsmath(tsc_result)
+uniform_transform_monthly_to_hourly = transform_cache.wrap(uniform_transform_monthly_to_hourly)
 
-		i += 1
+'''
+Daily flow pattern for one calendar year, compiled to a day-of-year table
+Days are indexed on a leap-year calendar (29 Feb = 59). A pattern from a non-leap year (year
+3000 is OK) uses its 28 Feb value for 29 Feb, so a leap output year gets a full February.
+Running sums of the table and the 12 monthly sums and means for common and leap years are
+computed once, when the table is built.
+'''
+class PatternTable(object):
+	month_offsets = [0, 0, 31, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335]
+
+	def __init__(self, tsmath_pattern):
+		tsc = tsmath_pattern.getContainer()
+		self.fullName = tsc.fullName
+		self.day_values = [hec.lang.Const.UNDEFINED_DOUBLE] * 366
+		pattern_time = HecTime(HecTime.MINUTE_INCREMENT)
+		has_leap_day = False
+		for i in range(tsc.numberValues):
+			pattern_time.set(tsc.times[i])
+			self.day_values[self.day_index(pattern_time.month(), pattern_time.day())] = tsc.values[i]
+			if pattern_time.month() == 2 and pattern_time.day() == 29:
+				has_leap_day = True
+		if not has_leap_day:
+			self.day_values[self.day_index(2, 29)] = self.day_values[self.day_index(2, 28)]
+
+		# running_sums[i] is the sum of the first i days of the table
+		self.running_sums = [0.0] * 367
+		for i in range(366):
+			self.running_sums[i+1] = self.running_sums[i] + self.day_values[i]
+
+		# indexed [leap][month], month 1 = January
+		self.month_sums = [[0.0] * 13, [0.0] * 13]
+		self.month_means = [[0.0] * 13, [0.0] * 13]
+		for leap in (0, 1):
+			for month in range(1, 13):
+				self.month_sums[leap][month] = self.days_sum(month, leap, 1)
+				self.month_means[leap][month] = self.month_sums[leap][month]/self.month_length(month, leap)
+
+	def day_index(self, month, day):
+		return PatternTable.month_offsets[month] + day - 1
+
+	def month_length(self, month, leap):
+		if month == 2 and leap:
+			return 29
+		return days_in_month[month]
+
+	def days_sum(self, month, leap, first_day):
+		return (self.running_sums[self.day_index(month, self.month_length(month, leap)) + 1] -
+			self.running_sums[self.day_index(month, first_day)])
+
+	# Sum of the pattern from day first_day to the end of the month
+	def month_sum(self, month, leap, first_day=1):
+		if first_day == 1:
+			return self.month_sums[int(bool(leap))][month]
+		return self.days_sum(month, leap, first_day)
+
+	# Average daily pattern flow over the month as it falls in a leap or common year
+	def month_mean(self, month, leap):
+		return self.month_means[int(bool(leap))][month]
+
+pattern_tables = {}
+pattern_tables_lock = threading.Lock()
 
-	return tsmath(tsc_result)
+'''
+Compiled table for a pattern, built once per pattern pathname and rebuilt if the record changes
+'''
+def get_pattern_table(tsmath_pattern):
+	key = tsmath_pattern.getContainer().fullName
+	content_key = transform_cache.series_key(tsmath_pattern)
+	pattern_tables_lock.acquire()
+	try:
+		entry = pattern_tables.get(key)
+		if entry is None or entry[0] != content_key:
+			entry = (content_key, PatternTable(tsmath_pattern))
+			pattern_tables[key] = entry
+		return entry[1]
+	finally:
+		pattern_tables_lock.release()
 
 '''
 turn monthly volumes into daily average flows according to an annual pattern
 Assumptions:
 	pattern time series covers a calendar year
-	pattern time series year is not a leap year (year 3000 is OK)
 	pattern time and output time series are daily average flows in CFS
 	input time series is either a monthly average of daily flows or a monthly volume in acre-feet
+In leap years, 29 Feb takes the pattern's 29 Feb value, or its 28 Feb value if the pattern year
+is not a leap year, and February is scaled over 29 days.
 '''
 def weight_transform_monthly_to_daily(tsmath_months, tsmath_pattern, start_day_count=None, currentAlternative=None):
 	start_time_in = HecTime(tsmath_months.firstValidDate(), HecTime.MINUTE_INCREMENT)
 	end_time_in = HecTime(tsmath_months.lastValidDate(), HecTime.MINUTE_INCREMENT)
-	start_time_pattern = HecTime(tsmath_pattern.firstValidDate(), HecTime.MINUTE_INCREMENT)
 
 	if not start_day_count:
 		start_day_count = start_time_in.day()
@@ -562,13 +714,11 @@ def weight_transform_monthly_to_daily(tsmath_months, tsmath_pattern, start_day_c
 	elif tsmath_months.getUnits().upper().startswith("CFS"):
 		input_is_acrefeet = False
 
-	# calculate monthly average daily flows from the daily flow pattern time series
-	tsmath_pattern_ave = tsmath_pattern.transformTimeSeries("1MON", "", "AVE")
+	# daily pattern and monthly average daily flows, compiled once per pattern record
+	pattern = get_pattern_table(tsmath_pattern)
 
 	# get the date and time value lists from the TimeSeriesMath objects
 	tsc_months = tsmath_months.getData()
-	tsc_pattern = tsmath_pattern.getData()
-	tsc_pattern_ave = tsmath_pattern_ave.getData()
 
 	if currentAlternative:
 		currentAlternative.addComputeMessage("Calculating weighted time series for %s at %s"%(tsc_months.parameter, tsc_months.location))
@@ -579,43 +729,31 @@ def weight_transform_monthly_to_daily(tsmath_months, tsmath_pattern, start_day_c
 		print "Input time series starting at %s"%(str(start_time_in))
 		print "Output time series starting at %s"%(str(start_time_out))
 
-	# create HecTime objects for indexing the pattern and output time series
-	search_time = HecTime()
-	post_time = HecTime()
-
 	# Make a dictionary of volume ratios by month (i.e. this month's volume/pattern year volume for month)
 	scale_lookup = {}
 	in_time = HecTime( HecTime.MINUTE_INCREMENT)
-	for time_int in tsc_months.times:
-		in_time.set(time_int)
-		print "Input date: %d %s %d (%d)"%(in_time.day(), month_TLA[in_time.month()], in_time.year(), time_int)
-		search_time.setYearMonthDay(start_time_pattern.year(), in_time.month(), days_in_month[in_time.month()], 1440)
+	for i in range(tsc_months.numberValues):
+		in_time.set(tsc_months.times[i])
+		print "Input date: %d %s %d (%d)"%(in_time.day(), month_TLA[in_time.month()], in_time.year(), tsc_months.times[i])
+		leap = HecTime.isLeap(in_time.year())
 
 		key = in_time.year()*100+in_time.month()
 
 		if input_is_acrefeet:
-			scale_lookup[key] = tsc_months.getValue(in_time)*0.50417/days_in_month[in_time.month()]/tsc_pattern_ave.getValue(search_time)
+			scale_lookup[key] = (tsc_months.values[i]*0.50417/get_days_in_month(in_time.month(), in_time.year())/
+				pattern.month_mean(in_time.month(), leap))
 		else:
-			scale_lookup[key] = tsc_month.getValue(in_time)/tsc_pattern_ave.getValue(search_time)
+			scale_lookup[key] = tsc_months.values[i]/pattern.month_mean(in_time.month(), leap)
 
 		if currentAlternative:
-			currentAlternative.addComputeMessage("scale for %s %d = %f"%(month_TLA[in_time.month()], in_time.year(), scale_lookup[in_time.month()]))
+			currentAlternative.addComputeMessage("scale for %s %d = %f"%(month_TLA[in_time.month()], in_time.year(), scale_lookup[key]))
 		elif DEBUG:
 			print "scale for %s %d = %f"%(month_TLA[in_time.month()], in_time.year(), scale_lookup[key])
 
 	# if we're starting mid-month, recalculate acre-feet scale factor for the first month
 	if input_is_acrefeet and start_day_of_month > 1:
 		first_month_key = start_time_in.year()*100 + start_time_in.month()
-		sum_flows = 0.0
-		i = 0
-		search_time.setYearMonthDay(start_time_pattern.year(), start_time_in.month(), start_day_of_month, 1440)
-		first_month = search_time.month()
-		if DEBUG: print "Starting pattern time series at %s"%search_time.date(4)
-		while search_time.month() == first_month:
-			sum_flows += tsc_pattern.getValue(search_time)
-			i += 1
-			print "index = %d"%(i)
-			search_time.addDays(1)
+		sum_flows = pattern.month_sum(start_time_in.month(), HecTime.isLeap(start_time_in.year()), start_day_of_month)
 		scale_lookup[first_month_key] = tsc_months.values[0]*0.50417 / sum_flows
 		if DEBUG: print "{}AF/{}cfs-day = {}".format(tsc_months.values[0], sum_flows, scale_lookup[first_month_key])
 
@@ -634,17 +772,28 @@ def weight_transform_monthly_to_daily(tsmath_months, tsmath_pattern, start_day_c
 	tsc_result.units = "CFS"
 	tsc_result.type = "PER-AVER"
 
+	# one month at a time: consecutive days index consecutive pattern days
+	times = tsc_result.times
+	n = tsc_result.numberValues
+	out_vals = [0.0] * n
+	post_time = HecTime()
 	i = 0
-	for time_min in tsc_result.times:
-		post_time.setMinutes(time_min)
-		search_time.setYearMonthDay(start_time_pattern.year(), post_time.month(), post_time.day(), 1440)
-		scale = scale_lookup[post_time.month()+100*post_time.year()]
-		tsc_result.values[i] = scale * tsc_pattern.getValue(search_time)
-		i += 1
+	while i < n:
+		post_time.setMinutes(times[i])
+		month = post_time.month()
+		month_days = get_days_in_month(month, post_time.year())
+		scale = scale_lookup[month+100*post_time.year()]
+		start = pattern.day_index(month, post_time.day())
+		count = min(n - i, month_days - post_time.day() + 1)
+		for k in range(count):
+			out_vals[i + k] = scale * pattern.day_values[start + k]
+		i += count
+	tsc_result.values = out_vals
 	tsm_result = tsmath(tsc_result)
 	tsm_result.setVersion("WEIGHTED")
 	print "Weight disaggregation of %s complete."%(tsc_result.fullName)
 	return tsm_result
+weight_transform_monthly_to_daily = transform_cache.wrap(weight_transform_monthly_to_daily, num_inputs=2)
 
 '''
 returns a list of TimeSeriesMath objects.
@@ -666,69 +815,168 @@ def split_time_series_static(tsmath_in, names_weights, out_param_name):
 
 	return rv_tsmath_list
 
+'''
+Month (0 = January) of each time in a sorted list of HecTime minutes
+Midnight belongs to the day it ends, as HecTime reports it, so daily and hourly steps
+share the month of the day they fall in; HecTime is consulted once per day.
+'''
+def month_of_times(times):
+	rv = [0] * len(times)
+	hec_time = HecTime(HecTime.MINUTE_INCREMENT)
+	last_day = None
+	month = 0
+	for i in range(len(times)):
+		day = (times[i] - 1) // 1440
+		if day != last_day:
+			hec_time.set(times[i])
+			month = hec_time.month() - 1
+			last_day = day
+		rv[i] = month
+	return rv
+
 '''
 returns a list of TimeSeriesMath objects.
 names_weights is a python dictionary of "location name":(tuple of 12 weights-by-month Jan-Dec)
 weights are normalized at compute time
+input may be daily or hourly; each step takes the weight of its month
 '''
 def split_time_series_monthly(tsmath_in, names_weights, out_param_name):
 	rv_tsmath_list = []
+	undefined = hec.lang.Const.UNDEFINED_DOUBLE
 
-	total_weight = []
+	# 12 x k table of weights normalized by each month's total
+	names = names_weights.keys()
+	weight_table = []
 	for i in range(12):
 		month_sum = 0
-		for key in names_weights.keys():
+		for key in names:
 			month_sum += names_weights[key][i]
-		total_weight.append(month_sum)
+		weight_table.append([names_weights[key][i]/month_sum for key in names])
 
-	time_start = HecTime(tsmath_in.firstValidDate(), HecTime.MINUTE_INCREMENT)
-	time_end = HecTime(tsmath_in.lastValidDate(), HecTime.MINUTE_INCREMENT)
-	weight_container = tsmath.generateRegularIntervalTimeSeries(
-		time_start.date(8), time_end.date(8), "1DAY", "0M", 1.0).getData()
+	in_tsc = tsmath_in.getContainer()
+	in_vals = in_tsc.values
+	months = month_of_times(in_tsc.times)
 
-	for key in names_weights.keys():
-		for i in range(weight_container.numberValues):
-			time_end.set(weight_container.times[i])
-			weight_container.values[i] = names_weights[key][time_end.month() - 1]/total_weight[time_end.month() - 1]
-		weight_math = tsmath(weight_container)
-		tsmath_product = tsmath_in.multiply(weight_math)
+	out_vals = [[undefined] * in_tsc.numberValues for key in names]
+	for i in range(in_tsc.numberValues):
+		val = in_vals[i]
+		if val == undefined:
+			continue
+		weights = weight_table[months[i]]
+		for j in range(len(names)):
+			out_vals[j][i] = val * weights[j]
+
+	for j in range(len(names)):
+		rv_tsc = tsmath_in.getData()
+		rv_tsc.values = out_vals[j]
+		tsmath_product = tsmath(rv_tsc)
 		tsmath_product.setParameterPart(out_param_name)
-		tsmath_product.setLocation(key)
+		tsmath_product.setLocation(names[j])
 		rv_tsmath_list.append(tsmath_product)
 	return rv_tsmath_list
 
+'''
+Rolling-window averages over a list or array of values, each O(n)
+Prefix sums of the valid values, of their counts and of their index-weighted values are built
+once; any window is then a difference of two prefix entries, so several window lengths over the
+same values cost one pass each. UNDEFINED values are skipped and each window is averaged over
+the values it actually holds; a window with fewer than min_count valid values is UNDEFINED.
+Windows are cut short at the ends of the series. Results are new double arrays.
+'''
+class RollingWindow(object):
+	def __init__(self, values, min_count=1):
+		undefined = hec.lang.Const.UNDEFINED_DOUBLE
+		self.n = len(values)
+		self.min_count = min_count
+		self.sums = zeros(self.n + 1, 'd')
+		self.counts = zeros(self.n + 1, 'i')
+		self.index_sums = zeros(self.n + 1, 'd')
+		self.index_counts = zeros(self.n + 1, 'd')
+		for i in range(self.n):
+			val = values[i]
+			if val == undefined:
+				self.sums[i+1] = self.sums[i]
+				self.counts[i+1] = self.counts[i]
+				self.index_sums[i+1] = self.index_sums[i]
+				self.index_counts[i+1] = self.index_counts[i]
+			else:
+				self.sums[i+1] = self.sums[i] + val
+				self.counts[i+1] = self.counts[i] + 1
+				self.index_sums[i+1] = self.index_sums[i] + i*val
+				self.index_counts[i+1] = self.index_counts[i] + i
+
+	# average of values[i - before] .. values[i + after] for every i
+	def window(self, before, after):
+		undefined = hec.lang.Const.UNDEFINED_DOUBLE
+		rv = zeros(self.n, 'd')
+		sums = self.sums
+		counts = self.counts
+		for i in range(self.n):
+			lo = max(0, i - before)
+			hi = min(self.n, i + after + 1)
+			count = counts[hi] - counts[lo]
+			if count < self.min_count:
+				rv[i] = undefined
+			else:
+				rv[i] = (sums[hi] - sums[lo])/count
+		return rv
+
+	def backward(self, num_periods):
+		return self.window(num_periods - 1, 0)
+
+	# even lengths take the extra value from before i
+	def centered(self, num_periods):
+		after = (num_periods - 1)//2
+		return self.window(num_periods - 1 - after, after)
+
+	# backward window with weights 1 .. num_periods, the latest value weighted most
+	def linear_weighted(self, num_periods):
+		undefined = hec.lang.Const.UNDEFINED_DOUBLE
+		rv = zeros(self.n, 'd')
+		for i in range(self.n):
+			lo = max(0, i - num_periods + 1)
+			hi = i + 1
+			if self.counts[hi] - self.counts[lo] < self.min_count:
+				rv[i] = undefined
+				continue
+			# weight of values[j] is j - (i - num_periods)
+			offset = i - num_periods
+			weighted_sum = (self.index_sums[hi] - self.index_sums[lo]) - offset*(self.sums[hi] - self.sums[lo])
+			weight_total = (self.index_counts[hi] - self.index_counts[lo]) - offset*(self.counts[hi] - self.counts[lo])
+			rv[i] = weighted_sum/weight_total
+		return rv
+
+	# dictionary of window length:averages for a list of window lengths
+	def averages(self, lengths, kind="backward"):
+		kernel = getattr(self, kind)
+		rv = {}
+		for num_periods in lengths:
+			rv[num_periods] = kernel(num_periods)
+		return rv
+
+'''
+TimeSeriesMath copy of tsmath_in with its values averaged over a rolling window
+kind is "backward", "centered" or "linear_weighted"
+'''
+def rolling_average(tsmath_in, num_periods, kind="backward"):
+	rv_tsc = tsmath_in.getData()
+	rv_tsc.values = getattr(RollingWindow(tsmath_in.getContainer().values), kind)(num_periods)
+	return tsmath(rv_tsc)
+
 '''
 Backward moving average
 Because DSSMath doesn't have a function for this...
 '''
 def backwardsMovingAverage(tsmath_in, num_periods):
-	rv_tsc = tsmath_in.getData() # getData() returns a copy of the tsMath's time-series container
-	rv_parts = rv_tsc.fullName.strip('/').split('/')
-	i = 0; j = 0
-	in_vals = tsmath_in.getContainer().values # getContainer() returns access to the time-series container in place
 	if DEBUG:
 		print "Input TSMath for moving average contains %d values."%(tsmath_in.getContainer().numberValues)
-	out_vals =[]
-	for val in in_vals:
-		j += 1
-		k = j - num_periods
-		moving_sum = 0.
-		moving_count = 0.
-		if k < 0: k = 0
-		for addend in in_vals[k:j]:
-			if addend == hec.lang.Const.UNDEFINED_DOUBLE:
-				continue
-			else:
-				moving_sum += addend
-				moving_count += 1.0
-		out_vals.append(moving_sum/moving_count)
-		i += 1
-
+	tsmath_avg = rolling_average(tsmath_in, num_periods, "backward")
+	rv_tsc = tsmath_avg.getContainer()
+	rv_parts = rv_tsc.fullName.strip('/').split('/')
 	if DEBUG:
-		print "Result TSMath for moving average contains %d values."%(len(out_vals))
-	rv_tsc.values = out_vals
+		print "Result TSMath for moving average contains %d values."%(rv_tsc.numberValues)
 	rv_tsc.fullName = "//test/flow-avg//" + rv_parts[-2] + "/moving/"
-	return tsmath(rv_tsc)
+	return tsmath_avg
 
 
 '''
@@ -743,43 +991,125 @@ Steve's notes on the regression:
 	Air temp is in deg C
 	Resulting water temp is in deg C
 '''
-def evaluate_temp_regression(tsmath_flow, tsmath_airtemp, temp_regression_coefficients, currentAlternative = None):
-	if currentAlternative: currentAlternative.addComputeMessage("Calculating water temperatures at %s..."%(tsmath_flow.getContainer().location))
-	if tsmath_flow.isMetric():
-		if currentAlternative: currentAlternative.addComputeMessage("Flow units were \"%s\.\""%(tsmath_flow.getUnits()))
-		tsmath_flow = tsmath_flow.convertToEnglishUnits()
-		if currentAlternative: currentAlternative.addComputeMessage("Flow units converted to \"%s\.\""%(tsmath_flow.getUnits()))
+'''
+Daily 7-day centered average air temperature in deg C, the air term of the tributary regressions
+Prepare once and pass to evaluate_temp_regressions for every tributary sharing the record
+'''
+def prepare_regression_airtemp(tsmath_airtemp, currentAlternative = None):
 	if tsmath_airtemp.isEnglish():
 		if currentAlternative: currentAlternative.addComputeMessage("Temperature units were \"%s\.\""%(tsmath_airtemp.getUnits()))
 		tsmath_airtemp = tsmath_airtemp.convertToMetricUnits()
 		if currentAlternative: currentAlternative.addComputeMessage("Temperature units converted to \"%s\.\""%(tsmath_airtemp.getUnits()))
 
-	if DEBUG: print "Calculating temperatures at %s"%(tsmath_flow.getContainer().location)
+	if DEBUG: print "Preparing regression air temperatures from %s"%(tsmath_airtemp.getContainer().fullName)
 	tsmath_airtemp = tsmath_airtemp.transformTimeSeries("1DAY", "", "AVE")
 	if "F" in tsmath_airtemp.getUnits().upper():
-		if DEBUG: print "Converting temperatures at %s to Celsius."%(tsmath_flow.getContainer().location)
+		if DEBUG: print "Converting air temperatures to Celsius."
 		tsmath_airtemp.setUnits("deg F")
 		tsmath_airtemp = tsmath_airtemp.convertToMetricUnits()
 	if "C" in tsmath_airtemp.getUnits().upper():
 		tsmath_airtemp.setUnits("deg C")
-	if DEBUG: print "\tApplying flows..."
-	tsmath_watertemp = tsmath_flow.centeredMovingAverage(7, False, True).multiply(temp_regression_coefficients[1])
-	tsmath_watertemp.setUnits("deg C")
-	if DEBUG: print "\tApplying air temperature..."
-	tsmath_watertemp = tsmath_watertemp.add(tsmath_airtemp.centeredMovingAverage(7, False, True).multiply(temp_regression_coefficients[2]))
-	if DEBUG: print "\tApplying constant..."
-	tsmath_watertemp = tsmath_watertemp.add(temp_regression_coefficients[0])
-	start_time = HecTime(tsmath_airtemp.firstValidDate(), HecTime.MINUTE_INCREMENT)
+	tsmath_airtemp_avg = rolling_average(tsmath_airtemp, 7, "centered")
+	tsmath_airtemp_avg.setUnits("deg C")
+	return tsmath_airtemp_avg
+
+'''
+Hourly water temperatures for several tributaries from one prepared air temperature series
+names_flows: python dictionary of "location name":daily flow TimeSeriesMath
+tsmath_airtemp_avg: output of prepare_regression_airtemp
+names_coefficients: python dictionary of "location name":(intercept, flow coef, air temp coef, RMS error)
+Each flow's 7-day centered average is aligned to the air temperature days, the regressions are
+evaluated for all tributaries day by day, and one walk over the hourly grid interpolates every
+output. Period data hold the value of the day containing the hour; instantaneous data are
+interpolated linearly between days. Returns a list of TimeSeriesMath in names_coefficients order.
+'''
+def evaluate_temp_regressions(names_flows, tsmath_airtemp_avg, names_coefficients, currentAlternative = None):
+	undefined = hec.lang.Const.UNDEFINED_DOUBLE
+	air_tsc = tsmath_airtemp_avg.getContainer()
+	days = air_tsc.times
+	num_days = air_tsc.numberValues
+	air_values = air_tsc.values
+
+	names = names_coefficients.keys()
+	flow_tscs = []
+	day_values = []
+	for name in names:
+		tsmath_flow = names_flows[name]
+		if currentAlternative: currentAlternative.addComputeMessage("Calculating water temperatures at %s..."%(tsmath_flow.getContainer().location))
+		if tsmath_flow.isMetric():
+			if currentAlternative: currentAlternative.addComputeMessage("Flow units were \"%s\.\""%(tsmath_flow.getUnits()))
+			tsmath_flow = tsmath_flow.convertToEnglishUnits()
+			if currentAlternative: currentAlternative.addComputeMessage("Flow units converted to \"%s\.\""%(tsmath_flow.getUnits()))
+		if DEBUG: print "Calculating temperatures at %s"%(tsmath_flow.getContainer().location)
+		flow_tsc = rolling_average(tsmath_flow, 7, "centered").getContainer()
+		flow_tscs.append(flow_tsc)
+		day_values.append(align_to_times(flow_tsc, days))
+
+	# regression for every tributary on the shared daily axis
+	for j in range(len(names)):
+		intercept, flow_coef, air_coef = names_coefficients[names[j]][:3]
+		row = day_values[j]
+		for i in range(num_days):
+			if row[i] == undefined or air_values[i] == undefined:
+				row[i] = undefined
+			else:
+				row[i] = intercept + flow_coef*row[i] + air_coef*air_values[i]
+
+	start_time = HecTime(tsmath_airtemp_avg.firstValidDate(), HecTime.MINUTE_INCREMENT)
 	start_time.setTime("0000")
-	end_time = HecTime(tsmath_airtemp.lastValidDate(), HecTime.MINUTE_INCREMENT)
-	# print "Starts at " + start_time.dateAndTime(4)
-	# print "Ends at " + end_time.dateAndTime(4)
-	tsmath_out = tsmath.generateRegularIntervalTimeSeries(start_time.dateAndTime(4), end_time.dateAndTime(4), "1HOUR", "", 0.0)
-	tsmath_out.setUnits("deg C")
-	tsmath_out = tsmath_watertemp.transformTimeSeries(tsmath_out, "INT")
-	tsmath_out.setParameterPart("TEMP-WATER")
+	end_time = HecTime(tsmath_airtemp_avg.lastValidDate(), HecTime.MINUTE_INCREMENT)
+	hour_template = tsmath.generateRegularIntervalTimeSeries(start_time.dateAndTime(4), end_time.dateAndTime(4), "1HOUR", "", 0.0)
+	hours = hour_template.getContainer().times
+	num_hours = hour_template.getContainer().numberValues
+
+	out_tscs = []
+	out_values = []
+	is_period = []
+	for j in range(len(names)):
+		out_tsc = hour_template.getData()
+		# keep the empty A and D parts: /A/B/C/D/E/F/
+		path_parts = flow_tscs[j].fullName.split('/')
+		path_parts[3] = "TEMP-WATER"
+		path_parts[5] = "1HOUR"
+		out_tsc.fullName = '/'.join(path_parts)
+		out_tsc.location = flow_tscs[j].location
+		out_tsc.parameter = "TEMP-WATER"
+		out_tsc.version = flow_tscs[j].version
+		out_tsc.units = "deg C"
+		out_tsc.type = flow_tscs[j].type
+		out_tscs.append(out_tsc)
+		out_values.append([undefined] * num_hours)
+		is_period.append(str(flow_tscs[j].type).upper().startswith("PER"))
+
+	# one pass over the hourly grid; k is the first day at or after the hour
+	k = 0
+	for h in range(num_hours):
+		t = hours[h]
+		while k < num_days and days[k] < t:
+			k += 1
+		if k >= num_days:
+			break
+		for j in range(len(names)):
+			row = day_values[j]
+			if days[k] == t or is_period[j]:
+				out_values[j][h] = row[k]
+			elif k > 0 and row[k] != undefined and row[k-1] != undefined:
+				fraction = float(t - days[k-1])/(days[k] - days[k-1])
+				out_values[j][h] = row[k-1] + fraction*(row[k] - row[k-1])
+
+	rv_tsmath_list = []
+	for j in range(len(names)):
+		out_tscs[j].values = out_values[j]
+		tsm = tsmath(out_tscs[j])
+		tsm.setParameterPart("TEMP-WATER")
+		rv_tsmath_list.append(tsm)
+	return rv_tsmath_list
 
-	return tsmath_out
+def evaluate_temp_regression(tsmath_flow, tsmath_airtemp, temp_regression_coefficients, currentAlternative = None):
+	location = tsmath_flow.getContainer().location
+	tsmath_airtemp_avg = prepare_regression_airtemp(tsmath_airtemp, currentAlternative)
+	return evaluate_temp_regressions({location: tsmath_flow}, tsmath_airtemp_avg,
+		{location: temp_regression_coefficients}, currentAlternative)[0]
 
 def leapYearTest(currentAlternative):
 	test = HecTime(HecTime.MINUTE_INCREMENT)
@@ -790,3 +1120,601 @@ def leapYearTest(currentAlternative):
 	test.setYearMonthDay(3000, 3, 1, 1440)
 	currentAlternative.addComputeMessage("HecTime 1 Mar 3000 = %d"%(test.getMinutes()))
 	return
+
+
+'''
+Values of a time series at each of a sorted list of times, in one merge pass
+Times without a value get UNDEFINED, as TimeSeriesContainer.getValue would return
+'''
+def align_to_times(tsc, times):
+	rv = [hec.lang.Const.UNDEFINED_DOUBLE] * len(times)
+	src_times = tsc.times
+	src_values = tsc.values
+	n = tsc.numberValues
+	k = 0
+	for i in range(len(times)):
+		while k < n and src_times[k] < times[i]:
+			k += 1
+		if k < n and src_times[k] == times[i]:
+			rv[i] = src_values[k]
+	return rv
+
+'''
+Daily reservoir storage from monthly observed storages and daily flows
+tsmath_storage_daily: daily series to fill in place (its times set the daily index)
+tsmath_storage_monthly: observed storages; the daily storage is reset to the observation at the
+	first day on or after each observation time
+signed_terms: list of (sign, daily flow TimeSeriesMath) e.g. [(1, inflow), (-1, release)]
+factor: flow to storage units per day (cfs to ac-ft by default)
+Each term is aligned to the daily index once, the net flow summed per day, and the storage
+accumulated in one pass. Returns the daily closure residual: at each day where the storage is
+reset, the observed storage minus the storage carried forward by the balance; zero elsewhere.
+'''
+def daily_storage_balance(tsmath_storage_daily, tsmath_storage_monthly, signed_terms, factor=1.98347):
+	daily_tsc = tsmath_storage_daily.getContainer()
+	monthly_tsc = tsmath_storage_monthly.getContainer()
+	times = daily_tsc.times
+	n = len(daily_tsc.values)
+	net_flow = [0.] * n
+	for sign, tsmath_term in signed_terms:
+		term_values = align_to_times(tsmath_term.getContainer(), times[:n])
+		for i in range(n):
+			net_flow[i] += sign * term_values[i]
+	storage = daily_tsc.values
+	residual = [0.] * n
+	monthly_times = monthly_tsc.times
+	monthly_values = monthly_tsc.values
+	num_monthly = monthly_tsc.numberValues
+	storage[0] = monthly_values[0]
+	j = 1
+	for i in range(1, n):
+		carried = storage[i-1] + factor * net_flow[i]
+		if j < num_monthly and times[i] >= monthly_times[j]:
+			storage[i] = monthly_values[j]
+			residual[i] = monthly_values[j] - carried
+			j += 1
+		else:
+			storage[i] = carried
+	return residual
+
+
+'''
+Read-through cache of DSS time series records for the whole session
+Records are keyed by (file, pathname, time window) and remembered with the file's modification
+time; a record is read again once its file has changed, or after invalidate() for the file.
+The cache holds at most max_bytes (8 bytes per value plus 4 per time) of records, evicting the
+least recently used. Containers are stored and returned as copies.
+'''
+class DSSRecordCache(object):
+	def __init__(self, max_bytes=64*1024*1024):
+		self.max_bytes = max_bytes
+		self.entries = OrderedDict()
+		self.num_bytes = 0
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def key(self, dss_file_name, path, time_window=None):
+		return (os.path.normcase(os.path.abspath(dss_file_name)), path.upper(), time_window)
+
+	def get(self, dss_file_name, path, time_window=None):
+		key = self.key(dss_file_name, path, time_window)
+		try:
+			mtime = os.path.getmtime(dss_file_name)
+		except OSError:
+			mtime = None
+		self.lock.acquire()
+		try:
+			entry = self.entries.get(key)
+			if entry is None or entry[0] != mtime:
+				if entry is not None:
+					self.remove(key)
+				self.misses += 1
+				return None
+			del self.entries[key]
+			self.entries[key] = entry
+			self.hits += 1
+			tsc = entry[1]
+		finally:
+			self.lock.release()
+		return tsmath(tsc).getData()
+
+	# mtime: modification time of the file when the record was read
+	def put(self, dss_file_name, path, time_window, tsc, mtime):
+		key = self.key(dss_file_name, path, time_window)
+		size = 12 * tsc.numberValues
+		if size > self.max_bytes:
+			return
+		tsc = tsmath(tsc).getData()
+		self.lock.acquire()
+		try:
+			if key in self.entries:
+				self.remove(key)
+			self.entries[key] = (mtime, tsc, size)
+			self.num_bytes += size
+			while self.num_bytes > self.max_bytes:
+				self.remove(self.entries.keys()[0])
+		finally:
+			self.lock.release()
+
+	def remove(self, key):
+		entry = self.entries.pop(key)
+		self.num_bytes -= entry[2]
+
+	# Forget every record of a DSS file, e.g. after writing to it
+	def invalidate(self, dss_file_name):
+		file_key = os.path.normcase(os.path.abspath(dss_file_name))
+		self.lock.acquire()
+		try:
+			for key in [key for key in self.entries.keys() if key[0] == file_key]:
+				self.remove(key)
+		finally:
+			self.lock.release()
+
+	def clear(self):
+		self.lock.acquire()
+		try:
+			self.entries.clear()
+			self.num_bytes = 0
+		finally:
+			self.lock.release()
+
+dss_record_cache = DSSRecordCache()
+
+
+'''
+Pool of open DSS files for one boundary condition build
+One HecTimeSeries handle is opened per DSS file on first use and shared by every reader and writer
+in the build, instead of opening and closing the file around each record. acquire/release keep a
+reference count per file; close() (or leaving a with block) closes every handle, warning about any
+still referenced. Each file has its own lock, held around every read and write of its handle, so
+the pool can be shared between threads. Reads go through record_cache (the session cache by
+default, None to always read the file) and writes invalidate the file's cached records.
+'''
+class DSSHandlePool(object):
+	def __init__(self, record_cache=dss_record_cache):
+		self.record_cache = record_cache
+		self.handles = {}
+		self.refcounts = {}
+		self.locks = {}
+		self.extents = {}
+		self.blocks = {}
+		self.pool_lock = threading.Lock()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		self.close()
+		return False
+
+	def key(self, dss_file_name):
+		return os.path.normcase(os.path.abspath(dss_file_name))
+
+	# Open handle for a DSS file (opened on first use); pair every acquire with a release
+	def acquire(self, dss_file_name):
+		key = self.key(dss_file_name)
+		self.pool_lock.acquire()
+		try:
+			if not key in self.handles:
+				handle = hec.heclib.dss.HecTimeSeries()
+				handle.setDSSFileName(dss_file_name)
+				self.handles[key] = handle
+				self.refcounts[key] = 0
+			if not key in self.locks:
+				self.locks[key] = threading.RLock()
+			self.refcounts[key] += 1
+			return self.handles[key]
+		finally:
+			self.pool_lock.release()
+
+	def release(self, dss_file_name):
+		key = self.key(dss_file_name)
+		self.pool_lock.acquire()
+		try:
+			if self.refcounts.get(key, 0) > 0:
+				self.refcounts[key] -= 1
+		finally:
+			self.pool_lock.release()
+
+	# Lock serializing access to one DSS file
+	def lock(self, dss_file_name):
+		key = self.key(dss_file_name)
+		self.pool_lock.acquire()
+		try:
+			return self.locks.setdefault(key, threading.RLock())
+		finally:
+			self.pool_lock.release()
+
+	# Read a time series record. time_window (e.g. "01JAN2001 0000 31DEC2001 2400") limits the read.
+	# Returns the container, or None if the record can't be read.
+	def read(self, dss_file_name, path, time_window=None):
+		if self.record_cache is not None:
+			tsc = self.record_cache.get(dss_file_name, path, time_window)
+			if tsc is not None:
+				return tsc
+			try:
+				mtime = os.path.getmtime(dss_file_name)
+			except OSError:
+				mtime = None
+		handle = self.acquire(dss_file_name)
+		file_lock = self.locks[self.key(dss_file_name)]
+		file_lock.acquire()
+		try:
+			status, tsc = self.read_handle(handle, path, time_window)
+		finally:
+			file_lock.release()
+			self.release(dss_file_name)
+		if status < 0:
+			return None
+		if self.record_cache is not None:
+			self.record_cache.put(dss_file_name, path, time_window, tsc, mtime)
+		return tsc
+
+	def read_handle(self, handle, path, time_window):
+		if time_window:
+			handle.setTimeWindow(time_window)
+		tsc = tscont()
+		tsc.fullName = path
+		try:
+			status = handle.read(tsc, False)
+		finally:
+			if time_window:
+				handle.setTimeWindow()
+		return status, tsc
+
+	# Block start times (minutes) of every record in a DSS file, keyed by pathname without its
+	# D part. The file is cataloged once per pool; writes through the pool drop the catalog.
+	def record_blocks(self, dss_file_name):
+		key = self.key(dss_file_name)
+		file_lock = self.lock(dss_file_name)
+		file_lock.acquire()
+		try:
+			if key in self.blocks:
+				return self.blocks[key]
+			dss = hec.heclib.dss.HecDss.open(dss_file_name, True)
+			try:
+				catalog = dss.getCatalogedPathnames(True)
+			finally:
+				dss.done()
+			blocks = {}
+			block_time = HecTime()
+			for cataloged in catalog:
+				parts = str(cataloged).upper().split('/')
+				if len(parts) < 6:
+					continue
+				block_time.set(parts[4], "0000")
+				if block_time.isDefined():
+					blocks.setdefault('/'.join(parts[:4] + parts[5:]), []).append(block_time.value())
+			for block_starts in blocks.values():
+				block_starts.sort()
+			self.blocks[key] = blocks
+			return blocks
+		finally:
+			file_lock.release()
+
+	# First and last valid times (minutes) of a record, or None if the record isn't in the file
+	# The catalog lists the record's blocks (D parts); blocks are read from each end until a valid
+	# value is found. Extents are kept for the life of the pool.
+	def record_extent(self, dss_file_name, path):
+		key = (self.key(dss_file_name), path.upper())
+		if key in self.extents:
+			return self.extents[key]
+		# block start times of the record, whatever its D part
+		path_parts = path.upper().split('/')
+		block_starts = self.record_blocks(dss_file_name).get('/'.join(path_parts[:4] + path_parts[5:]), [])
+
+		# each block is read up to the next block's start, the last one for up to a year
+		windows = []
+		for i in range(len(block_starts)):
+			if i + 1 < len(block_starts):
+				windows.append((block_starts[i], block_starts[i+1]))
+			else:
+				windows.append((block_starts[i], block_starts[i] + 366*1440))
+		first_time = None
+		for window in windows:
+			first_time = self.valid_time(dss_file_name, path, window, False)
+			if first_time is not None:
+				break
+		last_time = None
+		for window in reversed(windows):
+			last_time = self.valid_time(dss_file_name, path, window, True)
+			if last_time is not None:
+				break
+		extent = None
+		if first_time is not None and last_time is not None:
+			extent = (first_time, last_time)
+		self.extents[key] = extent
+		return extent
+
+	# Time of the first (or last) valid value of a record between two times, None if there is none
+	def valid_time(self, dss_file_name, path, window, last):
+		start_time = HecTime()
+		start_time.set(window[0])
+		end_time = HecTime()
+		end_time.set(window[1])
+		tsc = self.read(dss_file_name, path, time_window="%s %02d%02d %s %02d%02d"%(
+			start_time.date(4), start_time.hour(), start_time.minute(),
+			end_time.date(4), end_time.hour(), end_time.minute()))
+		if tsc is None:
+			return None
+		indices = range(tsc.numberValues)
+		if last:
+			indices.reverse()
+		for i in indices:
+			if tsc.values[i] != hec.lang.Const.UNDEFINED_DOUBLE:
+				return tsc.times[i]
+		return None
+
+	# Write a time series container; returns the HecTimeSeries status
+	def write(self, dss_file_name, tsc):
+		handle = self.acquire(dss_file_name)
+		file_lock = self.locks[self.key(dss_file_name)]
+		file_lock.acquire()
+		try:
+			return handle.write(tsc)
+		finally:
+			if self.record_cache is not None:
+				self.record_cache.invalidate(dss_file_name)
+			self.blocks.pop(self.key(dss_file_name), None)
+			file_lock.release()
+			self.release(dss_file_name)
+
+	# Close the handle of one DSS file, e.g. before the file is replaced
+	def close_file(self, dss_file_name):
+		key = self.key(dss_file_name)
+		self.pool_lock.acquire()
+		try:
+			self.blocks.pop(key, None)
+			if not key in self.handles:
+				return
+			if self.refcounts[key] > 0:
+				print "Closing DSS file %s with %d open references."%(key, self.refcounts[key])
+			self.handles[key].done()
+			del self.handles[key]
+			del self.refcounts[key]
+		finally:
+			self.pool_lock.release()
+
+	# Close every handle (safe to call more than once)
+	def close(self):
+		self.pool_lock.acquire()
+		try:
+			for key in self.handles.keys():
+				if self.refcounts[key] > 0:
+					print "Closing DSS file %s with %d open references."%(key, self.refcounts[key])
+				try:
+					self.handles[key].done()
+				except Exception as e:
+					print "Failed to close DSS file %s\n\t%s"%(key, str(e))
+			self.handles = {}
+			self.refcounts = {}
+			self.locks = {}
+		finally:
+			self.pool_lock.release()
+
+
+'''
+Bulk writer for the output records of a build
+Containers are collected with add() and written by flush(), one DSS file at a time with records
+in pathname order. Each file is written in one session to a temporary copy of the destination,
+which is then moved over the destination, so a build that fails part way never leaves a file
+with a mix of old and new records. If the move can't be done (e.g. the destination is held open
+by another program) the records are written to the destination directly.
+flush() returns a list of (file name, records written, values written, seconds) for each file,
+or None if any record failed to write (destinations with failures are left unchanged).
+pending_record() returns a queued container by file and pathname, for stages that read records
+added earlier in the same build.
+'''
+class DSSBulkWriter(object):
+	def __init__(self, dss_pool=None):
+		self.dss_pool = dss_pool
+		self.pending = {}
+
+	def add(self, dss_file_name, tsc):
+		self.pending.setdefault(os.path.abspath(dss_file_name), []).append(tsc)
+
+	def pending_record(self, dss_file_name, path):
+		for tsc in self.pending.get(os.path.abspath(dss_file_name), []):
+			if tsc.fullName == path:
+				return tsc
+		return None
+
+	def flush(self):
+		rv = []
+		failed = False
+		for dss_file_name in sorted(self.pending.keys()):
+			tsc_list = sorted(self.pending[dss_file_name], key=lambda tsc: tsc.fullName)
+			stats = self.write_file(dss_file_name, tsc_list)
+			if stats is None:
+				failed = True
+				continue
+			rv.append(stats)
+			if stats[3] > 0:
+				print "Wrote %d records (%d values) to %s in %.2f s (%.1f records/s)."%(
+					stats[1], stats[2], dss_file_name, stats[3], stats[1]/stats[3])
+		self.pending = {}
+		if failed:
+			return None
+		return rv
+
+	def write_file(self, dss_file_name, tsc_list):
+		start = time.time()
+		if self.dss_pool is not None and self.dss_pool.record_cache is not None:
+			self.dss_pool.record_cache.invalidate(dss_file_name)
+		if self.dss_pool is not None:
+			file_lock = self.dss_pool.lock(dss_file_name)
+			file_lock.acquire()
+		try:
+			if self.dss_pool is not None:
+				self.dss_pool.close_file(dss_file_name)
+			tmp_file_name = "%s.%s.tmp.dss"%(os.path.splitext(dss_file_name)[0], uuid.uuid4().hex)
+			target = java.io.File(dss_file_name).toPath()
+			source = java.io.File(tmp_file_name).toPath()
+			if os.path.exists(dss_file_name):
+				Files.copy(target, source)
+			num_values = self.write_records(tmp_file_name, tsc_list)
+			if num_values is None:
+				os.remove(tmp_file_name)
+				return None
+			try:
+				try:
+					Files.move(source, target, StandardCopyOption.REPLACE_EXISTING, StandardCopyOption.ATOMIC_MOVE)
+				except AtomicMoveNotSupportedException:
+					Files.move(source, target, StandardCopyOption.REPLACE_EXISTING)
+			except java.io.IOException as e:
+				print "Unable to replace DSS file %s (%s), writing records in place."%(dss_file_name, str(e))
+				os.remove(tmp_file_name)
+				num_values = self.write_records(dss_file_name, tsc_list)
+				if num_values is None:
+					return None
+		finally:
+			if self.dss_pool is not None:
+				file_lock.release()
+		return (dss_file_name, len(tsc_list), num_values, time.time() - start)
+
+	# Write records in one session; returns the number of values written, or None on a failure
+	def write_records(self, dss_file_name, tsc_list):
+		num_values = 0
+		ts_write = hec.heclib.dss.HecTimeSeries()
+		ts_write.setDSSFileName(dss_file_name)
+		try:
+			for tsc in tsc_list:
+				if ts_write.write(tsc) < 0:
+					print "Failed to write time series %s \n\tto DSS file %s"%(tsc.fullName, dss_file_name)
+					return None
+				num_values += tsc.numberValues
+		finally:
+			ts_write.done()
+		return num_values
+
+
+'''
+Regular series holding one constant value, e.g. zero flows and gate counts
+One set of times and values is generated per (interval, value, window) and shared by every series
+made from it, so the containers returned by series() must be treated as read-only. start and end
+are HecTime date and time strings ("01Jan2024 0000") and interval a DSS E part ("1HOUR").
+'''
+class ConstantSeriesFactory(object):
+	def __init__(self):
+		self.buffers = {}
+		self.lock = threading.Lock()
+
+	def buffer(self, start, end, interval, value):
+		key = (interval.upper(), float(value), start, end)
+		self.lock.acquire()
+		try:
+			if not key in self.buffers:
+				self.buffers[key] = tsmath.generateRegularIntervalTimeSeries(start, end, interval, "0M", value).getContainer()
+			return self.buffers[key]
+		finally:
+			self.lock.release()
+
+	def series(self, start, end, interval, value, units, data_type, location, parameter, version):
+		template = self.buffer(start, end, interval, value)
+		rv_tsc = tscont()
+		rv_tsc.type = data_type
+		rv_tsc.units = units
+		rv_tsc.numberValues = template.numberValues
+		rv_tsc.values = template.values
+		rv_tsc.times = template.times
+		rv_tsc.startTime = template.startTime
+		rv_tsc.endTime = template.endTime
+		rv_tsc.interval = template.interval
+		rv_tsc.location = location
+		rv_tsc.parameter = parameter
+		rv_tsc.version = version
+		rv_tsc.fullName = "//%s/%s//%s/%s/"%(location, parameter, interval.upper(), version)
+		return rv_tsc
+
+	# True when the DSS file already holds tsc's record with the same units, type, times and values
+	def is_written(self, dss_pool, dss_file_name, tsc, start, end):
+		if not os.path.exists(dss_file_name):
+			return False
+		existing = dss_pool.read(dss_file_name, tsc.fullName, time_window="%s %s"%(start, end))
+		if existing is None or existing.numberValues != tsc.numberValues:
+			return False
+		if (str(existing.units).upper() != str(tsc.units).upper() or
+			str(existing.type).upper() != str(tsc.type).upper()):
+			return False
+		return Arrays.equals(existing.times, tsc.times) and Arrays.equals(existing.values, tsc.values)
+
+constant_series = ConstantSeriesFactory()
+
+
+'''
+Raised by a stage to stop a build; the message says why
+'''
+class StageError(Exception):
+	pass
+
+'''
+Small dependency graph of build stages
+add(name, function, inputs) registers a stage; function is called with the results of the named
+input stages, in order, and its return value is the stage's result. run() starts each stage as
+soon as all of its inputs are done, on a pool of max_workers threads (in the order the stages
+were added when max_workers is 1), and returns a dictionary of results by stage name.
+An exception in a stage stops new stages from starting and is raised again by run() once the
+running stages finish.
+'''
+class StageGraph(object):
+	def __init__(self):
+		self.names = []
+		self.functions = {}
+		self.inputs = {}
+
+	def add(self, name, function, inputs=()):
+		for input_name in inputs:
+			if not input_name in self.functions:
+				raise ValueError("Stage %s needs stage %s, which has to be added first."%(name, input_name))
+		self.names.append(name)
+		self.functions[name] = function
+		self.inputs[name] = tuple(inputs)
+
+	def run(self, max_workers=1):
+		results = {}
+		if max_workers <= 1:
+			for name in self.names:
+				results[name] = self.call(name, results)
+			return results
+		executor = Executors.newFixedThreadPool(min(max_workers, len(self.names)))
+		completion = ExecutorCompletionService(executor)
+		try:
+			waiting = list(self.names)
+			num_running = 0
+			error = None
+			while True:
+				if error is None:
+					for name in [name for name in waiting if all([i in results for i in self.inputs[name]])]:
+						waiting.remove(name)
+						completion.submit(StageTask(self, name, results))
+						num_running += 1
+				if num_running == 0:
+					break
+				name, result, stage_error = completion.take().get()
+				num_running -= 1
+				if stage_error is not None:
+					if error is None:
+						error = stage_error
+				else:
+					results[name] = result
+			if error is not None:
+				raise error[0], error[1], error[2]
+		finally:
+			executor.shutdown()
+		return results
+
+	def call(self, name, results):
+		return self.functions[name](*[results[input_name] for input_name in self.inputs[name]])
+
+class StageTask(Callable):
+	def __init__(self, graph, name, results):
+		self.graph = graph
+		self.name = name
+		self.results = results
+
+	def call(self):
+		try:
+			return (self.name, self.graph.call(self.name, self.results), None)
+		except:
+			return (self.name, None, sys.exc_info())
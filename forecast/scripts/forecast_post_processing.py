@@ -1,12 +1,25 @@
 from ncsa.hdf.hdf5lib import H5, HDF5Constants
-from jarray import zeros
+from jarray import zeros, array
+from java.lang import System
 from java.lang.reflect import Array
 import java
 import datetime as dt
+import bisect
+import hashlib
+import json
 import os
+import threading
 import time
+import uuid
+from java.nio import ByteOrder
+from java.nio.channels import FileChannel
+from java.nio.file import Files, StandardCopyOption, AtomicMoveNotSupportedException, FileAlreadyExistsException
+from java.util import Arrays
+from java.util.concurrent import Callable, Executors
 from com.rma.model import Project
 from hec.heclib.dss import HecDss
+from hec.io import TimeSeriesContainer
+from hec.lang import Const
 
 def str2datetime(dtstr):
     try:
@@ -30,258 +43,1023 @@ def hecTime2datetime(hecTime):
         tout = dt.datetime(hecTime.year(), hecTime.month(), hecTime.day(), hecTime.hour(), hecTime.minute())
     return tout
 
+# HecTime counts minutes from 31 Dec 1899 00:00
+hecEpoch = dt.datetime(1899, 12, 31)
 
-# Process hdf5 file to get cold water pool volume at the end of September
-# And process DSS gate records to get dates of first side gate usage
-def runIteration(modelAlternative, currentIteration, maxIteration):
+def datetime2minutes(tin):
+    delta = tin - hecEpoch
+    return delta.days * 1440 + delta.seconds // 60
+
+def minutes2datetime(minutes):
+    return hecEpoch + dt.timedelta(minutes=minutes)
+
+# Index of the entry in a sorted sequence of times (minutes) closest to the target time
+# Binary search, so it works for irregular time steps and for DSS container times
+def nearestTimeIndex(times, target):
+    n = len(times)
+    idx = bisect.bisect_left(times, target)
+    if idx >= n:
+        return n-1
+    if idx > 0 and (target - times[idx-1]) <= (times[idx] - target):
+        return idx-1
+    return idx
+
+
+# Pre-parsed time axis of an RSS HDF5 output file
+# minutes: output times in HecTime minutes, one per row of the Subdomains datasets
+# deltaMinutes: the first time step; isRegular is False if any step differs from it
+class TimeAxis(object):
+    def __init__(self, minutes):
+        self.minutes = minutes
+        self.nt = len(minutes)
+        self.deltaMinutes = 0
+        self.isRegular = True
+        if self.nt > 1:
+            self.deltaMinutes = minutes[1] - minutes[0]
+            for i in range(2, self.nt):
+                if minutes[i] - minutes[i-1] != self.deltaMinutes:
+                    self.isRegular = False
+                    break
+
+    def startTime(self):
+        return minutes2datetime(self.minutes[0])
+
+    def endTime(self):
+        return minutes2datetime(self.minutes[-1])
+
+    def datetimeAt(self, idx):
+        return minutes2datetime(self.minutes[idx])
+
+    # Row closest to a datetime, clipped to the first and last rows
+    def nearestIndex(self, when):
+        return nearestTimeIndex(self.minutes, datetime2minutes(when))
+
+# Timings and I/O volume of one iteration's post-processing
+# Seconds are accumulated per phase (a phase entered more than once adds up), bytes per
+# HDF5 dataset or DSS record read.
+class IterationMetrics(object):
+    def __init__(self, iteration):
+        self.iteration = iteration
+        self.phaseSeconds = {}
+        self.bytesRead = {}
+        self.reused = False
     
-    scriptStartTime = time.time()
+    def addTime(self, name, seconds):
+        self.phaseSeconds[name] = self.phaseSeconds.get(name, 0.) + seconds
     
-    print("Current iteration", currentIteration)
-    print("Model Alternative", modelAlternative.getName())
-    print("Simulation Name", modelAlternative.getSimulationName())
-    print("Program", modelAlternative.getProgram())
-    print("DSS Filename", modelAlternative.getDssFilename())
-    print("Fpart", modelAlternative.getFpart())
-    print("Variant Name", modelAlternative.getVariantName())
-    print("Run directory", modelAlternative.getRunDirectory())
+    def addBytes(self, path, nbytes):
+        self.bytesRead[path] = self.bytesRead.get(path, 0) + nbytes
     
-    simulationName = modelAlternative.getSimulationName().encode('ascii', 'ignore')
-    rssRunName = modelAlternative.getFpart().encode('ascii', 'ignore')
+    # Time the body of a with statement as the named phase
+    def phase(self, name):
+        return PhaseTimer(self, name)
     
-    workspace = Project.getCurrentProject().getWorkspacePath()
-    print(workspace)
-    simDrct = os.path.join(workspace, "runs", simulationName)
-    hdfFilename = rssRunName.replace(":", "_") + ".h5"
-    FpartBaseName = rssRunName.upper()
+    def record(self):
+        return {'iteration': self.iteration, 'reused': self.reused, 'phaseSeconds': self.phaseSeconds,
+                'bytesRead': self.bytesRead, 'totalBytesRead': sum(self.bytesRead.values())}
+
+class PhaseTimer(object):
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
     
-    dssFilename = "iterationResults.dss"
-    coldWaterPoolCutoffF = 56.  # in deg F
-    outputFilename = 'SRTTG_reporting.csv'
+    def __enter__(self):
+        self.t0 = System.nanoTime()
+        return self
     
-    # Script assumes English units for watershed (ft3 volume output)
-    
-    if currentIteration == 1:
-        # Create new file
-        with open(os.path.join(simDrct, outputFilename), 'w') as outFid:
-            outFid.write('Iteration,EOS CWP Stor (ac-ft),EOS Total Pool Stor (ac-ft),Date First Side Gate Use,Date First Exclusive Side Gate Use\n')
+    def __exit__(self, excType, excValue, tb):
+        self.metrics.addTime(self.name, (System.nanoTime() - self.t0) / 1e9)
+        return False
 
-    # Open hdf file
-    hdfFilenameFull = os.path.join(simDrct, 'rss', hdfFilename)
-    fid = H5.H5Fopen(hdfFilenameFull, HDF5Constants.H5F_ACC_RDONLY, HDF5Constants.H5P_DEFAULT)
-    if fid < 0:
-        return ("Error: Unable to open Water Quality Output file: " + hdfFilenameFull)
-    print("File id", fid)
-    
-    # Open time dataset
+# Time axes already parsed in this session, keyed by (file path, nt, file mtime)
+timeAxisCache = {}
+
+# Read strings at selected rows of a 1D string dataset (e.g. the Time Date Stamp record)
+def readStringRows(fid, path, rowIndices, metrics=None):
+    dsId = H5.H5Dopen(fid, path, HDF5Constants.H5P_DEFAULT)
+    strings = []
+    try:
+        typeId = H5.H5Dget_type(dsId)
+        spaceId = H5.H5Dget_space(dsId)
+        memoryType = H5.H5Tcopy(HDF5Constants.H5T_FORTRAN_S1)
+        try:
+            stringSize = H5.H5Tget_size(typeId)
+            H5.H5Tset_size(memoryType, stringSize)
+            memDims = zeros(1, 'l')
+            memDims[0] = 1
+            memspaceId = H5.H5Screate_simple(1, memDims, memDims)
+            try:
+                start = zeros(1, 'l')
+                count = zeros(1, 'l')
+                count[0] = 1
+                buf = Array.newInstance(java.lang.String, 1)
+                for rowIdx in rowIndices:
+                    start[0] = rowIdx
+                    H5.H5Sselect_hyperslab(spaceId, HDF5Constants.H5S_SELECT_SET, start, None, count, None)
+                    H5.H5Dread_string(dsId, memoryType, memspaceId, spaceId, HDF5Constants.H5P_DEFAULT, buf)
+                    strings.append(buf[0])
+                    if metrics is not None:
+                        metrics.addBytes(path, stringSize)
+            finally:
+                H5.H5Sclose(memspaceId)
+        finally:
+            H5.H5Tclose(memoryType)
+            H5.H5Sclose(spaceId)
+            H5.H5Tclose(typeId)
+    finally:
+        H5.H5Dclose(dsId)
+    return strings
+
+# Get the time axis of an RSS HDF5 output file, parsing it only if the file has changed
+# The numeric Time dataset (days) gives the offsets of every row, so only the first
+# date stamp needs to be decoded. This also handles irregular output intervals.
+def readTimeAxis(fid, hdfFilenameFull, metrics=None):
     path = "/Results/Subdomains/Time"
+    dsId = H5.H5Dopen(fid, path, HDF5Constants.H5P_DEFAULT)
     try:
-        dsId = H5.H5Dopen(fid, path, HDF5Constants.H5P_DEFAULT)
-    except Exception as e:
-        H5.H5Fclose(fid)
-        return ("Error: Unable to open dataset at path: " + path + ", File: " + hdfFilenameFull)
-    print("Dataset id", dsId)
-    # Get dimensions
-    spaceId = H5.H5Dget_space(dsId)
-    print("Dataspace id", spaceId)
-    dsDims1 = zeros(1, 'l')
-    maxDims1 = zeros(1, 'l')
-    H5.H5Sget_simple_extent_dims(spaceId, dsDims1, maxDims1)
-    nt = dsDims1[0]
-    print("Number of output times", nt)
-    times = zeros(nt, 'd')
-    # Read data
+        spaceId = H5.H5Dget_space(dsId)
+        try:
+            dsDims1 = zeros(1, 'l')
+            maxDims1 = zeros(1, 'l')
+            H5.H5Sget_simple_extent_dims(spaceId, dsDims1, maxDims1)
+            nt = dsDims1[0]
+            fullPath = os.path.abspath(hdfFilenameFull)
+            key = (fullPath, nt, os.path.getmtime(hdfFilenameFull))
+            timeAxis = timeAxisCache.get(key)
+            if timeAxis is not None:
+                return timeAxis
+            times = zeros(nt, 'd')
+            H5.H5Dread_double(dsId, HDF5Constants.H5T_NATIVE_DOUBLE, HDF5Constants.H5S_ALL, HDF5Constants.H5S_ALL, HDF5Constants.H5P_DEFAULT, times)
+            if metrics is not None:
+                metrics.addBytes(path, nt * 8)
+        finally:
+            H5.H5Sclose(spaceId)
+    finally:
+        H5.H5Dclose(dsId)
+
+    startMinutes = datetime2minutes(str2datetime(readStringRows(fid, "/Results/Subdomains/Time Date Stamp", [0], metrics)[0]))
+    minutes = [startMinutes + int(round((t - times[0]) * 1440.)) for t in times]
+    timeAxis = TimeAxis(minutes)
+    # An updated file replaces any stale axis for the same path
+    for oldKey in timeAxisCache.keys():
+        if oldKey[0] == fullPath:
+            del timeAxisCache[oldKey]
+    timeAxisCache[key] = timeAxis
+    return timeAxis
+
+
+# Read selected time rows of a 2D (time x layer) dataset, e.g. a reservoir temperature
+# or cell volume record. Each row is pulled with a hyperslab selection into a memory space
+# of one profile, so only nz values are held per requested row instead of nt * nz.
+# Returns a list of profiles (jarrays of nz doubles) in the order of rowIndices.
+def readProfileRows(fid, path, rowIndices, metrics=None):
+    dsId = H5.H5Dopen(fid, path, HDF5Constants.H5P_DEFAULT)
+    profiles = []
     try:
-        readError = H5.H5Dread_double(dsId, HDF5Constants.H5T_NATIVE_DOUBLE, HDF5Constants.H5S_ALL, HDF5Constants.H5S_ALL, HDF5Constants.H5P_DEFAULT, times)
-    except Exception as e:
-        H5.H5Sclose(spaceId)
+        spaceId = H5.H5Dget_space(dsId)
+        try:
+            dsDims = zeros(2, 'l')
+            maxDims = zeros(2, 'l')
+            H5.H5Sget_simple_extent_dims(spaceId, dsDims, maxDims)
+            nt = dsDims[0]
+            nz = dsDims[1]
+            memDims = zeros(1, 'l')
+            memDims[0] = nz
+            memspaceId = H5.H5Screate_simple(1, memDims, memDims)
+            try:
+                start = zeros(2, 'l')
+                count = zeros(2, 'l')
+                count[0] = 1
+                count[1] = nz
+                for rowIdx in rowIndices:
+                    if rowIdx < 0 or rowIdx > nt-1:
+                        raise IndexError("Row %d is outside of dataset %s (%d rows)" % (rowIdx, path, nt))
+                    start[0] = rowIdx
+                    H5.H5Sselect_hyperslab(spaceId, HDF5Constants.H5S_SELECT_SET, start, None, count, None)
+                    profile = zeros(nz, 'd')
+                    H5.H5Dread_double(dsId, HDF5Constants.H5T_NATIVE_DOUBLE, memspaceId, spaceId, HDF5Constants.H5P_DEFAULT, profile)
+                    profiles.append(profile)
+                    if metrics is not None:
+                        metrics.addBytes(path, nz * 8)
+            finally:
+                H5.H5Sclose(memspaceId)
+        finally:
+            H5.H5Sclose(spaceId)
+    finally:
         H5.H5Dclose(dsId)
-        H5.H5Fclose(fid)
-        return ("Error: Unable to read dataset at path: " + path + ", File: " + hdfFilenameFull)
-    print("First time", times[0])
-    H5.H5Sclose(spaceId)
-    H5.H5Dclose(dsId)
+    return profiles
+
+
+# Read-only memory map of a contiguous, uncompressed 2D (time x layer) dataset of little-endian doubles
+# Rows are sliced straight out of the mapped file pages, so only the pages of the requested rows are
+# touched. Use openMappedDataset to create one; close it when done. close() does not unmap the file:
+# the mapping lasts until the buffer is garbage collected, which keeps the file locked on Windows.
+class MappedDataset(object):
+    def __init__(self, filename, offset, nt, nz):
+        self.nt = nt
+        self.nz = nz
+        self.raf = java.io.RandomAccessFile(filename, "r")
+        try:
+            mapped = self.raf.getChannel().map(FileChannel.MapMode.READ_ONLY, offset, nt * nz * 8)
+        except:
+            self.raf.close()
+            raise
+        self.doubles = mapped.order(ByteOrder.LITTLE_ENDIAN).asDoubleBuffer()
     
-    delta_t_hrs = int(round((times[1] - times[0]) * 24., 0))
-    delta_t = dt.timedelta(hours=delta_t_hrs)
+    # Same result as readProfileRows: a list of jarrays of nz doubles, in the order of rowIndices
+    def readRows(self, rowIndices):
+        profiles = []
+        view = self.doubles.duplicate()  # own position, so readers don't interfere
+        for rowIdx in rowIndices:
+            if rowIdx < 0 or rowIdx > self.nt-1:
+                raise IndexError("Row %d is outside of mapped dataset (%d rows)" % (rowIdx, self.nt))
+            profile = zeros(self.nz, 'd')
+            view.position(rowIdx * self.nz)
+            view.get(profile)
+            profiles.append(profile)
+        return profiles
     
-    # Open and read the datetime dataset
-    path = "/Results/Subdomains/Time Date Stamp"
+    def close(self):
+        self.doubles = None
+        self.raf.close()
+
+# Memory map a dataset of an open HDF5 file if its storage allows it, otherwise return None
+# The dataset must be 2D, contiguous, unfiltered, allocated, stored as little-endian 64 bit
+# floats and smaller than 2 GB. H5Dget_offset is only in newer HDF-Java releases.
+def openMappedDataset(fid, hdfFilenameFull, path):
+    getOffset = getattr(H5, 'H5Dget_offset', None)
+    if getOffset is None:
+        return None
     dsId = H5.H5Dopen(fid, path, HDF5Constants.H5P_DEFAULT)
-    print("Dataset id", dsId)
-    typeId = H5.H5Dget_type(dsId)
-    print("Type id", typeId)
-    typeSize = H5.H5Tget_size(typeId)
-    spaceId = H5.H5Dget_space(dsId)
-    print("Space id", spaceId)
-    H5.H5Sget_simple_extent_dims(spaceId, dsDims1, maxDims1)
-    
-    memoryType = H5.H5Tcopy(HDF5Constants.H5T_FORTRAN_S1)
-    H5.H5Tset_size(memoryType, typeSize)
-    memspaceId = H5.H5Screate_simple(1, dsDims1, maxDims1)
-    print("Memory Space id", memspaceId)
-    strings = Array.newInstance(java.lang.String, dsDims1[0])
-    H5.H5Dread_string(dsId, memoryType, memspaceId, spaceId, HDF5Constants.H5P_DEFAULT, strings)
-    H5.H5Sclose(memspaceId)
-    H5.H5Sclose(spaceId)
-    H5.H5Tclose(typeId)
-    H5.H5Dclose(dsId)
-    
-    startTime = str2datetime(strings[0])
-    print(startTime)
-    endTime = str2datetime(strings[-1])
-    print(endTime)
-    
-    # Find Oct 1 00:00 index
-    oct1 = dt.datetime(startTime.year, 10, 1)
-    idx = int(round((oct1 - startTime).total_seconds() / delta_t.total_seconds()))
-    rtnMsg = ""
-    if idx > nt-1:
-        idx = nt-1
-        if currentIteration == 1:
-            rtnMsg = ("Warning: Simulation does not go until the end of September." + "\n" +
-                      "Storages will be reported for the last model time step.")
-    tstr = strings[idx]
-    print("Oct 1", tstr)
-    print("idx", idx)
-    
-    # Read temperature record for Shasta
-    path = "/Results/Subdomains/Shasta Lake/Water Temperature"
     try:
-        dsId = H5.H5Dopen(fid, path, HDF5Constants.H5P_DEFAULT)
-    except Exception as e:
-        H5.H5Fclose(fid)
-        return ("Error: Unable to open dataset at path: " + path + ", File: " + hdfFilenameFull)
-    print("Dataset id", dsId)
-    # Get dimensions
-    spaceId = H5.H5Dget_space(dsId)
-    print("Dataspace id", spaceId)
-    dsDims2 = zeros(2, 'l')
-    maxDims2 = zeros(2, 'l')
-    H5.H5Sget_simple_extent_dims(spaceId, dsDims2, maxDims2)
-    nz = dsDims2[1]
-    print("Number of vertical layers", nz)
-    nvals = nt * nz
-    temps = zeros(nvals, 'd')
-    # Read data
-    try:
-        readError = H5.H5Dread_double(dsId, HDF5Constants.H5T_NATIVE_DOUBLE, HDF5Constants.H5S_ALL, HDF5Constants.H5S_ALL, HDF5Constants.H5P_DEFAULT, temps)
-    except Exception as e:
-        H5.H5Sclose(spaceId)
+        plistId = H5.H5Dget_create_plist(dsId)
+        try:
+            if H5.H5Pget_layout(plistId) != HDF5Constants.H5D_CONTIGUOUS or H5.H5Pget_nfilters(plistId) != 0:
+                return None
+        finally:
+            H5.H5Pclose(plistId)
+        typeId = H5.H5Dget_type(dsId)
+        try:
+            if not H5.H5Tequal(typeId, HDF5Constants.H5T_IEEE_F64LE):
+                return None
+        finally:
+            H5.H5Tclose(typeId)
+        spaceId = H5.H5Dget_space(dsId)
+        try:
+            if H5.H5Sget_simple_extent_ndims(spaceId) != 2:
+                return None
+            dsDims = zeros(2, 'l')
+            maxDims = zeros(2, 'l')
+            H5.H5Sget_simple_extent_dims(spaceId, dsDims, maxDims)
+        finally:
+            H5.H5Sclose(spaceId)
+        nt = dsDims[0]
+        nz = dsDims[1]
+        nbytes = nt * nz * 8
+        if nbytes > java.lang.Integer.MAX_VALUE or H5.H5Dget_storage_size(dsId) < nbytes:
+            return None
+        offset = getOffset(dsId)
+        if offset < 0:  # HADDR_UNDEF, storage not allocated
+            return None
+    finally:
         H5.H5Dclose(dsId)
-        H5.H5Fclose(fid)
-        return ("Error: Unable to read dataset at path: " + path + ", File: " + hdfFilenameFull)
-    H5.H5Sclose(spaceId)
-    H5.H5Dclose(dsId)
-    
-    # Read volume record for Shasta
-    path = "/Results/Subdomains/Shasta Lake/Cell volume"
+    return MappedDataset(hdfFilenameFull, offset, nt, nz)
+
+# readProfileRows through a memory map when the dataset layout allows it and useMapped is set,
+# falling back to hyperslab reads for chunked or compressed datasets
+def readProfileRowsFast(fid, hdfFilenameFull, path, rowIndices, metrics=None, useMapped=False):
+    mapped = None
+    if useMapped:
+        try:
+            mapped = openMappedDataset(fid, hdfFilenameFull, path)
+        except Exception as e:
+            print("Memory map of", path, "unavailable:", str(e))
+    if mapped is None:
+        return readProfileRows(fid, path, rowIndices, metrics)
     try:
-        dsId = H5.H5Dopen(fid, path, HDF5Constants.H5P_DEFAULT)
-    except Exception as e:
-        H5.H5Fclose(fid)
-        return ("Error: Unable to open dataset at path: " + path + ", File: " + hdfFilenameFull)
-    print("Dataset id", dsId)
-    # Assume same dimensions as temperature
-    vols = zeros(nvals, 'd')
-    # Read data
+        profiles = mapped.readRows(rowIndices)
+    finally:
+        mapped.close()
+    if metrics is not None:
+        metrics.addBytes(path, len(rowIndices) * mapped.nz * 8)
+    return profiles
+
+
+# Cold water pool and total pool storage for every output time of a reservoir.
+# The temperature and cell volume datasets are walked in blocks of chunkRows time rows, so
+# peak memory is 2 * chunkRows * nz doubles no matter how long the simulation is.
+# Returns two jarrays of nt values (ac-ft): (cold water pool, total pool storage), followed by the
+# temperature and volume profiles (jarrays of nz values) at time row profileRow, copied from the block
+# that holds it (None if profileRow is not given).
+# With metrics, the block reads are timed as phase cwpSeriesRead and the summation as cwpReduction.
+def coldWaterPoolSeries(fid, tempPath, volPath, coldWaterPoolCutoffC, chunkRows=512, metrics=None, profileRow=None):
+    tempId = H5.H5Dopen(fid, tempPath, HDF5Constants.H5P_DEFAULT)
     try:
-        readError = H5.H5Dread_double(dsId, HDF5Constants.H5T_NATIVE_DOUBLE, HDF5Constants.H5S_ALL, HDF5Constants.H5S_ALL, HDF5Constants.H5P_DEFAULT, vols)
-    except Exception as e:
-        H5.H5Dclose(dsId)
-        H5.H5Fclose(fid)
-        return ("Error: Unable to read dataset at path: " + path + ", File: " + hdfFilenameFull)
-    H5.H5Dclose(dsId)
-    
-    # Close file
-    H5.H5Fclose(fid)
-    
-    startIdx = idx * nz
-    endIdx = (idx + 1) * nz
-    print("Temperature profile", temps[startIdx:endIdx])
-    tempOct1 = temps[startIdx:endIdx]
-    volOct1 = vols[startIdx:endIdx]
-    
-    coldWaterPoolCutoffC = (coldWaterPoolCutoffF - 32.) * 5. / 9.
-    cwp = 0.
-    poolVol = 0.
-    for j in range(nz):
-        poolVol += volOct1[j]
-        if tempOct1[j] < coldWaterPoolCutoffC:
-            cwp += volOct1[j]
-    cwp = cwp / 43560.  # convert to ac-ft
-    poolVol = poolVol / 43560.
-    print("Cold Water Pool (ac-ft)", cwp)
-    print("Total Pool Stor (ac-ft)", poolVol)
+        volId = H5.H5Dopen(fid, volPath, HDF5Constants.H5P_DEFAULT)
+        try:
+            tempSpaceId = H5.H5Dget_space(tempId)
+            volSpaceId = H5.H5Dget_space(volId)
+            try:
+                dsDims = zeros(2, 'l')
+                maxDims = zeros(2, 'l')
+                H5.H5Sget_simple_extent_dims(tempSpaceId, dsDims, maxDims)
+                nt = dsDims[0]
+                nz = dsDims[1]
+                if profileRow is not None and (profileRow < 0 or profileRow > nt-1):
+                    raise IndexError("Row %d is outside of dataset %s (%d rows)" % (profileRow, tempPath, nt))
+                cwpSeries = zeros(nt, 'd')
+                poolSeries = zeros(nt, 'd')
+                tempProfile = volProfile = None
+                start = zeros(2, 'l')
+                count = zeros(2, 'l')
+                count[1] = nz
+                memDims = zeros(1, 'l')
+                temps = vols = None
+                t0 = 0
+                while t0 < nt:
+                    nRows = min(chunkRows, nt - t0)
+                    if temps is None or len(temps) != nRows * nz:
+                        temps = zeros(nRows * nz, 'd')
+                        vols = zeros(nRows * nz, 'd')
+                    start[0] = t0
+                    count[0] = nRows
+                    memDims[0] = nRows * nz
+                    tRead = System.nanoTime()
+                    memspaceId = H5.H5Screate_simple(1, memDims, memDims)
+                    try:
+                        H5.H5Sselect_hyperslab(tempSpaceId, HDF5Constants.H5S_SELECT_SET, start, None, count, None)
+                        H5.H5Dread_double(tempId, HDF5Constants.H5T_NATIVE_DOUBLE, memspaceId, tempSpaceId, HDF5Constants.H5P_DEFAULT, temps)
+                        H5.H5Sselect_hyperslab(volSpaceId, HDF5Constants.H5S_SELECT_SET, start, None, count, None)
+                        H5.H5Dread_double(volId, HDF5Constants.H5T_NATIVE_DOUBLE, memspaceId, volSpaceId, HDF5Constants.H5P_DEFAULT, vols)
+                    finally:
+                        H5.H5Sclose(memspaceId)
+                    if profileRow is not None and t0 <= profileRow < t0 + nRows:
+                        tempProfile = zeros(nz, 'd')
+                        volProfile = zeros(nz, 'd')
+                        System.arraycopy(temps, (profileRow - t0) * nz, tempProfile, 0, nz)
+                        System.arraycopy(vols, (profileRow - t0) * nz, volProfile, 0, nz)
+                    tReduce = System.nanoTime()
+                    k = 0
+                    for i in range(t0, t0 + nRows):
+                        cwp = 0.
+                        poolVol = 0.
+                        for j in range(nz):
+                            poolVol += vols[k]
+                            if temps[k] < coldWaterPoolCutoffC:
+                                cwp += vols[k]
+                            k += 1
+                        cwpSeries[i] = cwp / 43560.  # convert to ac-ft
+                        poolSeries[i] = poolVol / 43560.
+                    if metrics is not None:
+                        metrics.addTime("cwpSeriesRead", (tReduce - tRead) / 1e9)
+                        metrics.addTime("cwpReduction", (System.nanoTime() - tReduce) / 1e9)
+                        metrics.addBytes(tempPath, nRows * nz * 8)
+                        metrics.addBytes(volPath, nRows * nz * 8)
+                    t0 += nRows
+            finally:
+                H5.H5Sclose(volSpaceId)
+                H5.H5Sclose(tempSpaceId)
+        finally:
+            H5.H5Dclose(volId)
+    finally:
+        H5.H5Dclose(tempId)
+    return cwpSeries, poolSeries, tempProfile, volProfile
+
+# Cold water pool volume (ac-ft) below each of several cutoff temperatures for one profile
+# Layers are sorted by temperature once and their volumes accumulated, so every cutoff is a
+# binary search into the cumulative volumes: O(nz log nz) for the whole curve.
+# Returns (list of volumes in the order of cutoffsC, total pool volume)
+def coldWaterPoolCurve(temps, vols, cutoffsC):
+    order = sorted(range(len(temps)), key=lambda j: temps[j])
+    sortedTemps = [temps[j] for j in order]
+    cumVol = [0.]
+    for j in order:
+        cumVol.append(cumVol[-1] + vols[j])
+    curve = [cumVol[bisect.bisect_left(sortedTemps, cutoffC)] / 43560. for cutoffC in cutoffsC]  # convert to ac-ft
+    return curve, cumVol[-1] / 43560.
+
+# DSS C parts of the gate records in the iteration results file
+# side and lower currently read the same record
+gateRecordParameters = {"side": "TOTAL_TCDL_GATES_FORECAST", "lower": "TOTAL_TCDL_GATES_FORECAST"}
+
+# Side gate usage from the side and lower gate records of an iteration, starting at startIdx
+# The value arrays are scanned once: first use (side > 0), first exclusive use (side > 0 while
+# lower == 0), hours of use and of exclusive use, and the number of steps at each side gate level.
+# Indices of the first uses are -1 if the gates are never used.
+def analyzeGateEvents(tsContainerSide, tsContainerLower, startIdx=0):
+    sideValues = tsContainerSide.values
+    lowerValues = tsContainerLower.values
+    n = min(tsContainerSide.numberValues, tsContainerLower.numberValues)
+    undefined = Const.UNDEFINED_DOUBLE
+    idxFirst = -1
+    idxExclusive = -1
+    nUsed = 0
+    nExclusive = 0
+    levelCounts = {}
+    for j in xrange(startIdx, n):
+        side = sideValues[j]
+        if side == undefined:
+            continue
+        level = int(round(side))
+        levelCounts[level] = levelCounts.get(level, 0) + 1
+        if side > 0:
+            nUsed += 1
+            if idxFirst < 0:
+                idxFirst = j
+            if lowerValues[j] == 0:
+                nExclusive += 1
+                if idxExclusive < 0:
+                    idxExclusive = j
+    stepHours = 1.
+    if tsContainerSide.interval > 0:
+        stepHours = tsContainerSide.interval / 60.
+    return {'idxFirst': idxFirst, 'idxExclusive': idxExclusive, 'hoursUsed': nUsed * stepHours,
+            'hoursExclusive': nExclusive * stepHours, 'levelCounts': levelCounts}
+
+# DSS E part for the output interval of a time axis
+def intervalLabel(timeAxis):
+    if not timeAxis.isRegular:
+        return "IR-YEAR"
+    labels = {15: "15MIN", 30: "30MIN", 60: "1HOUR", 120: "2HOUR", 180: "3HOUR", 360: "6HOUR", 720: "12HOUR", 1440: "1DAY"}
+    return labels.get(timeAxis.deltaMinutes, "IR-YEAR")
+
+# Time series container for a series of values on a time axis
+def makeTimeSeriesContainer(timeAxis, values, location, parameter, Fpart, units, dataType):
+    tsc = TimeSeriesContainer()
+    eLabel = intervalLabel(timeAxis)
+    tsc.fullName = "//%s/%s//%s/%s/" % (location, parameter, eLabel, Fpart)
+    tsc.location = location
+    tsc.parameter = parameter
+    tsc.version = Fpart
+    tsc.units = units
+    tsc.type = dataType
+    tsc.times = array(timeAxis.minutes, 'i')
+    tsc.values = values
+    tsc.numberValues = timeAxis.nt
+    tsc.startTime = timeAxis.minutes[0]
+    tsc.endTime = timeAxis.minutes[-1]
+    if timeAxis.isRegular:
+        tsc.interval = timeAxis.deltaMinutes
+    return tsc
+
+
+# Fingerprint of the inputs to an iteration's post-processing: size and mtime of the HDF5 output,
+# content hashes of the DSS gate records and the processing parameters
+def iterationFingerprint(hdfFilenameFull, gateContainers, parameters):
+    parts = [os.path.abspath(hdfFilenameFull), str(os.path.getsize(hdfFilenameFull)), repr(os.path.getmtime(hdfFilenameFull))]
+    for tsc in gateContainers:
+        parts.append("%s:%d:%d:%d" % (tsc.fullName, tsc.numberValues, Arrays.hashCode(tsc.times), Arrays.hashCode(tsc.values)))
+    parts.append(repr(parameters))
+    return hashlib.md5("|".join(parts)).hexdigest()
+
+
+dssFilename = "iterationResults.dss"
+outputFilename = 'SRTTG_reporting.csv'
+outputHeader = 'Iteration,EOS CWP Stor (ac-ft),EOS Total Pool Stor (ac-ft),Date First Side Gate Use,Date First Exclusive Side Gate Use\n'
+# End of September cold water pool volume is also reported for each of these cutoffs (deg F)
+defaultColdWaterPoolCutoffsF = [48., 50., 52., 54., 56., 58.]
+curveFilename = 'SRTTG_cwp_curve.csv'
+# Slice profile rows from memory maps of contiguous datasets (falls back to HDF5 reads otherwise).
+# Off by default: a mapped region is only released when it is garbage collected, and on Windows a
+# mapped .h5 file cannot be overwritten by the next iteration's ResSim compute.
+useMappedProfileReads = False
+# Per-phase timings and bytes read, one JSON record per line
+metricsFilename = 'SRTTG_metrics.jsonl'
+metricsLock = threading.Lock()
+
+
+def formatResultLine(result):
+    return "{0:d},{1:0.2f},{2:0.2f},{3:s},{4:s}\n".format(result['iteration'], result['cwp'], result['poolVol'],
+                                                          result['dateFirst'], result['dateExclusive'])
+
+
+def formatCurveHeader(cutoffsF):
+    return "Iteration," + ",".join(["EOS CWP Stor < {0:g}F (ac-ft)".format(cutoffF) for cutoffF in cutoffsF]) + "\n"
+
+
+def formatCurveLine(result):
+    return "{0:d},".format(result['iteration']) + ",".join(["{0:0.2f}".format(vol) for vol in result['cwpCurve']]) + "\n"
+
+
+# Move a finished temporary file over its destination in one step, so readers never see a partial file
+def replaceFile(tmpFilename, filename):
+    source = java.io.File(tmpFilename).toPath()
+    target = java.io.File(filename).toPath()
+    try:
+        Files.move(source, target, StandardCopyOption.REPLACE_EXISTING, StandardCopyOption.ATOMIC_MOVE)
+    except AtomicMoveNotSupportedException:
+        Files.move(source, target, StandardCopyOption.REPLACE_EXISTING)
+
+def tmpFilenameFor(filename):
+    return "%s.%s.tmp" % (filename, uuid.uuid4().hex)
+
+
+# Append metrics records to simDrct/SRTTG_metrics.jsonl, each stamped with runId (see ResultsStore)
+# The file is never truncated: iterations of a run may finish in any order, so records of a run
+# are selected by their runId.
+def writeMetrics(simDrct, records, runId=None):
+    metricsLock.acquire()
+    try:
+        with open(os.path.join(simDrct, metricsFilename), 'a') as outFid:
+            for record in records:
+                record = dict(record, runId=runId)
+                outFid.write(json.dumps(record, sort_keys=True) + "\n")
+    finally:
+        metricsLock.release()
+
+
+# Post-processing results of a simulation, one JSON shard per iteration in simDrct/SRTTG_results
+# Each iteration writes only its own shard (atomically), so iterations may finish out of order or
+# in parallel, and re-running an iteration replaces its earlier result. SRTTG_reporting.csv and
+# SRTTG_cwp_curve.csv are export views rebuilt from the shards of the current run: startRun() begins
+# a run and publish() adds an iteration to it once its result is computed or reused, so shards kept
+# from an earlier run are only exported after their iteration is checked again.
+# current_run.json holds the id of the current run and each published iteration has its own marker
+# file stamped with that id, so stores in other threads or scripts never rewrite a shared list.
+class ResultsStore(object):
+    def __init__(self, simDrct, storeDirname='SRTTG_results'):
+        self.simDrct = simDrct
+        self.storeDrct = os.path.join(simDrct, storeDirname)
+        if not os.path.isdir(self.storeDrct):
+            try:
+                os.makedirs(self.storeDrct)
+            except OSError:
+                if not os.path.isdir(self.storeDrct):  # another writer may have just made it
+                    raise
+        # shard contents already read, keyed by iteration: (mtime, result)
+        self.loaded = {}
+        self.runFilename = os.path.join(self.storeDrct, "current_run.json")
+    
+    def shardFilename(self, iteration):
+        return os.path.join(self.storeDrct, "iteration_{0:0>6d}.json".format(iteration))
+    
+    def markerFilename(self, iteration):
+        return os.path.join(self.storeDrct, "run_{0:0>6d}.json".format(iteration))
+    
+    # Insert or replace the result of an iteration
+    def put(self, result):
+        filename = self.shardFilename(result['iteration'])
+        tmpFilename = tmpFilenameFor(filename)
+        with open(tmpFilename, 'w') as outFid:
+            json.dump(result, outFid)
+        replaceFile(tmpFilename, filename)
+    
+    def get(self, iteration):
+        filename = self.shardFilename(iteration)
+        try:
+            mtime = os.path.getmtime(filename)
+        except OSError:
+            return None
+        cached = self.loaded.get(iteration)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with open(filename) as inFid:
+            result = json.load(inFid)
+        self.loaded[iteration] = (mtime, result)
+        return result
+    
+    def iterations(self):
+        rv = []
+        for name in os.listdir(self.storeDrct):
+            if name.startswith("iteration_") and name.endswith(".json"):
+                rv.append(int(name[len("iteration_"):-len(".json")]))
+        return sorted(rv)
+    
+    # Id of the current run, None if no run has been started
+    def runId(self):
+        try:
+            with open(self.runFilename) as inFid:
+                return json.load(inFid)['runId']
+        except (IOError, ValueError, KeyError):
+            return None
+    
+    # Iterations published in the current run
+    def runIterations(self):
+        runId = self.runId()
+        if runId is None:
+            return []
+        rv = []
+        for name in os.listdir(self.storeDrct):
+            if not (name.startswith("run_") and name.endswith(".json")):
+                continue
+            try:
+                with open(os.path.join(self.storeDrct, name)) as inFid:
+                    if json.load(inFid).get('runId') != runId:
+                        continue
+            except (IOError, ValueError):
+                continue  # removed or replaced while listing
+            rv.append(int(name[len("run_"):-len(".json")]))
+        return sorted(rv)
+    
+    # Begin a new run with no iterations published (stored shards are kept for reuse)
+    # Returns the id of the new run.
+    def startRun(self):
+        runId = uuid.uuid4().hex
+        tmpFilename = tmpFilenameFor(self.runFilename)
+        with open(tmpFilename, 'w') as outFid:
+            json.dump({'runId': runId}, outFid)
+        replaceFile(tmpFilename, self.runFilename)
+        return runId
+    
+    # Id of the current run, starting one if there is none. When several stores start it at
+    # once, the first run file written is kept and the others are discarded.
+    def currentRunId(self):
+        runId = self.runId()
+        if runId is not None:
+            return runId
+        tmpFilename = tmpFilenameFor(self.runFilename)
+        with open(tmpFilename, 'w') as outFid:
+            json.dump({'runId': uuid.uuid4().hex}, outFid)
+        try:
+            Files.move(java.io.File(tmpFilename).toPath(), java.io.File(self.runFilename).toPath())
+        except FileAlreadyExistsException:
+            os.remove(tmpFilename)
+        return self.runId()
+    
+    # Add an iteration whose stored result belongs to the current run (starting a run if there is none)
+    def publish(self, iteration):
+        runId = self.currentRunId()
+        filename = self.markerFilename(iteration)
+        tmpFilename = tmpFilenameFor(filename)
+        with open(tmpFilename, 'w') as outFid:
+            json.dump({'runId': runId}, outFid)
+        replaceFile(tmpFilename, filename)
+    
+    # Leave an iteration out of the current run until it is published again
+    def withdraw(self, iteration):
+        try:
+            os.remove(self.markerFilename(iteration))
+        except OSError:
+            pass
+    
+    # Stored results of the current run, in iteration order
+    def results(self):
+        rv = []
+        for iteration in self.runIterations():
+            result = self.get(iteration)
+            if result is not None:
+                rv.append(result)
+        return rv
+    
+    # One result field for every iteration of the current run: list of (iteration, value)
+    def column(self, name):
+        return [(result['iteration'], result.get(name)) for result in self.results()]
+    
+    # Remove stored results of iterations after lastIteration (all results by default)
+    def clear(self, lastIteration=0):
+        for iteration in self.iterations():
+            if iteration <= lastIteration:
+                continue
+            for filename in [self.shardFilename(iteration), self.markerFilename(iteration)]:
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+            self.loaded.pop(iteration, None)
+    
+    # Rewrite the CSV views from the stored results
+    def exportCsv(self):
+        results = self.results()
+        filename = os.path.join(self.simDrct, outputFilename)
+        tmpFilename = tmpFilenameFor(filename)
+        with open(tmpFilename, 'w') as outFid:
+            outFid.write(outputHeader)
+            for result in results:
+                outFid.write(formatResultLine(result))
+        replaceFile(tmpFilename, filename)
+        if results:
+            filename = os.path.join(self.simDrct, curveFilename)
+            tmpFilename = tmpFilenameFor(filename)
+            with open(tmpFilename, 'w') as outFid:
+                outFid.write(formatCurveHeader(results[0]['cwpCutoffsF']))
+                for result in results:
+                    outFid.write(formatCurveLine(result))
+            replaceFile(tmpFilename, filename)
+
+
+# Process hdf5 file to get cold water pool volume at the end of September
+# And process DSS gate records to get dates of first side gate usage
+# dssFile is an open HecDss handle to the iteration results file; dssLock (optional)
+# serializes reads when the handle is shared between threads.
+# Returns a dictionary of results for the iteration. Raises IOError if an input can't be read.
+# With useMappedReads, the Oct 1 profiles are sliced from memory maps of the datasets when their
+# storage is contiguous and uncompressed (see openMappedDataset). The maps hold the file open until
+# they are garbage collected, so only enable this when the .h5 file is not rewritten afterwards.
+# With writeCwpSeries the profiles come from the full series pass instead and no maps are made.
+# Phase timings and bytes read are accumulated in metrics (an IterationMetrics), if given.
+# With a resultsStore, the stored result for the iteration is returned without reading the HDF5 file
+# when its fingerprint (see iterationFingerprint) still matches the inputs.
+# With writeCwpSeries, the cold water pool and total pool storage for every output time are
+# also written to the iteration's DSS collection member (SHASTA LAKE STORAGE-CWP and STORAGE).
+# The end of September temperature-volume curve is evaluated at coldWaterPoolCutoffsF (defaults to the
+# module list); the primary cutoff coldWaterPoolCutoffF is always included in it.
+def processIteration(hdfFilenameFull, dssFile, FpartBaseName, currentIteration, coldWaterPoolCutoffF=56., dssLock=None,
+                     writeCwpSeries=True, coldWaterPoolCutoffsF=None, resultsStore=None,
+                     metrics=None, useMappedReads=False):
+    
+    # Script assumes English units for watershed (ft3 volume output)
+    
+    if metrics is None:
+        metrics = IterationMetrics(currentIteration)
+    if coldWaterPoolCutoffsF is None:
+        coldWaterPoolCutoffsF = defaultColdWaterPoolCutoffsF
+    cutoffsF = sorted(set(list(coldWaterPoolCutoffsF) + [coldWaterPoolCutoffF]))
     
     # DSS file processing
-    try:
-        dssFile = HecDss.open(os.path.join(simDrct, dssFilename))
-    except Exception as e:
-        return ("Error: Unable to open DSS file: " + dssFilename)
     collectionId = "{0:0>6d}".format(currentIteration)
     Fpart = "C:" + collectionId + "|" + FpartBaseName
-    # Side gates
-    # TODO: script the 1HOUR part of this
-    recordParts = ["", "", "TOTAL_TCDL_GATES_FORECAST", "GATE", "*", "1HOUR", Fpart, ""]
-    recordName = "/".join(recordParts)
+    if dssLock is not None:
+        dssLock.acquire()
     try:
-        dssTSMathSide = dssFile.read(recordName)
-    except Exception as e:
-        return ("Error: Unable to read DSS path: " + recordName + ", File: " + dssFilename)
-        
-    tsContainerSide = dssTSMathSide.getContainer()
-    # Lower gates
-    recordParts = ["", "", "TOTAL_TCDL_GATES_FORECAST", "GATE", "*", "1HOUR", Fpart, ""]
-    recordName = "/".join(recordParts)
+        # Gate records, each distinct record read once
+        gateContainers = {}
+        with metrics.phase("gateRead"):
+            for parameter in set(gateRecordParameters.values()):
+                # TODO: script the 1HOUR part of this
+                recordName = "/".join(["", "", parameter, "GATE", "*", "1HOUR", Fpart, ""])
+                try:
+                    gateContainers[parameter] = dssFile.read(recordName).getContainer()
+                except Exception as e:
+                    raise IOError("Error: Unable to read DSS path: " + recordName + ", File: " + dssFilename)
+                # values (double) and times (int)
+                metrics.addBytes(recordName, gateContainers[parameter].numberValues * 12)
+        tsContainerSide = gateContainers[gateRecordParameters["side"]]
+        tsContainerLower = gateContainers[gateRecordParameters["lower"]]
+    finally:
+        if dssLock is not None:
+            dssLock.release()
+    
+    # Reuse the stored result if none of the inputs have changed
+    fingerprint = iterationFingerprint(hdfFilenameFull, [gateContainers[key] for key in sorted(gateContainers.keys())],
+                                       [coldWaterPoolCutoffF] + cutoffsF + [writeCwpSeries])
+    if resultsStore is not None:
+        stored = resultsStore.get(currentIteration)
+        if stored is not None and stored.get('fingerprint') == fingerprint:
+            print("Inputs unchanged, reusing stored results for iteration", currentIteration)
+            metrics.reused = True
+            return stored
+    
+    # Open hdf file
+    with metrics.phase("hdf5Open"):
+        fid = H5.H5Fopen(hdfFilenameFull, HDF5Constants.H5F_ACC_RDONLY, HDF5Constants.H5P_DEFAULT)
+    if fid < 0:
+        raise IOError("Error: Unable to open Water Quality Output file: " + hdfFilenameFull)
+    print("File id", fid)
+    
     try:
-        dssTSMathLower = dssFile.read(recordName)
-    except Exception as e:
-        return ("Error: Unable to read DSS path: " + recordName + ", File: " + dssFilename)
-    tsContainerLower = dssTSMathLower.getContainer()
+        # Time axis (cached between iterations when the file has not changed)
+        try:
+            with metrics.phase("timeAxisRead"):
+                timeAxis = readTimeAxis(fid, hdfFilenameFull, metrics)
+        except Exception as e:
+            raise IOError("Error: Unable to read time datasets from File: " + hdfFilenameFull)
+        nt = timeAxis.nt
+        print("Number of output times", nt)
+        if not timeAxis.isRegular:
+            print("Irregular output time steps")
+        
+        startTime = timeAxis.startTime()
+        print(startTime)
+        endTime = timeAxis.endTime()
+        print(endTime)
+        
+        # Find Oct 1 00:00 index
+        oct1 = dt.datetime(startTime.year, 10, 1)
+        idx = timeAxis.nearestIndex(oct1)
+        rtnMsg = ""
+        if oct1 > endTime and currentIteration == 1:
+            rtnMsg = ("Warning: Simulation does not go until the end of September." + "\n" +
+                      "Storages will be reported for the last model time step.")
+        print("Oct 1", timeAxis.datetimeAt(idx))
+        print("idx", idx)
+        
+        # Read the Oct 1 temperature and volume profiles for Shasta
+        # The full series pass already reads every row, so the Oct 1 profiles are taken from it.
+        # Otherwise only the row at idx is read from each dataset, not the full nt x nz record.
+        tempPath = "/Results/Subdomains/Shasta Lake/Water Temperature"
+        # Volume record is assumed to have the same dimensions as temperature
+        volPath = "/Results/Subdomains/Shasta Lake/Cell volume"
+        if writeCwpSeries:
+            try:
+                cwpSeries, poolSeries, tempOct1, volOct1 = coldWaterPoolSeries(fid, tempPath, volPath,
+                    (coldWaterPoolCutoffF - 32.) * 5. / 9., metrics=metrics, profileRow=idx)
+            except Exception as e:
+                raise IOError("Error: Unable to read Shasta Lake temperature and volume datasets, File: " + hdfFilenameFull)
+        else:
+            try:
+                with metrics.phase("profileRead"):
+                    tempOct1 = readProfileRowsFast(fid, hdfFilenameFull, tempPath, [idx], metrics, useMappedReads)[0]
+            except Exception as e:
+                raise IOError("Error: Unable to read dataset at path: " + tempPath + ", File: " + hdfFilenameFull)
+            try:
+                with metrics.phase("profileRead"):
+                    volOct1 = readProfileRowsFast(fid, hdfFilenameFull, volPath, [idx], metrics, useMappedReads)[0]
+            except Exception as e:
+                raise IOError("Error: Unable to read dataset at path: " + volPath + ", File: " + hdfFilenameFull)
+        print("Number of vertical layers", len(tempOct1))
+    finally:
+        # Close file
+        H5.H5Fclose(fid)
+    
+    print("Temperature profile", tempOct1)
+    
+    with metrics.phase("cwpReduction"):
+        cwpCurve, poolVol = coldWaterPoolCurve(tempOct1, volOct1, [(cutoffF - 32.) * 5. / 9. for cutoffF in cutoffsF])
+    cwp = cwpCurve[cutoffsF.index(coldWaterPoolCutoffF)]
+    print("Cold Water Pool (ac-ft)", cwp)
+    print("Cold Water Pool curve (deg F, ac-ft)", zip(cutoffsF, cwpCurve))
+    print("Total Pool Stor (ac-ft)", poolVol)
+    
+    if writeCwpSeries:
+        if dssLock is not None:
+            dssLock.acquire()
+        try:
+            with metrics.phase("dssWrite"):
+                dssFile.put(makeTimeSeriesContainer(timeAxis, cwpSeries, "SHASTA LAKE", "STORAGE-CWP", Fpart, "AC-FT", "INST-VAL"))
+                dssFile.put(makeTimeSeriesContainer(timeAxis, poolSeries, "SHASTA LAKE", "STORAGE", Fpart, "AC-FT", "INST-VAL"))
+        finally:
+            if dssLock is not None:
+                dssLock.release()
     
     # Find May 1 00:00 index
+    # Binary search on the DSS record's own times (they need not share the HDF5 time step)
     dssStartTime = hecTime2datetime(tsContainerSide.getStartTime())
     may1 = dt.datetime(dssStartTime.year, 5, 1)
-    mayIdx = int(round((may1 - dssStartTime).total_seconds() / delta_t.total_seconds()))
-    mayIdx = max(mayIdx, 0)  # in case simulation is starting after May 1
     n = tsContainerSide.getNumberValues()
-    if mayIdx > n-1:  # if simulation doesn't go past May 1, start at first day of simulation
+    mayIdx = nearestTimeIndex(tsContainerSide.times, datetime2minutes(may1))  # 0 if simulation starts after May 1
+    if datetime2minutes(may1) > tsContainerSide.times[n-1]:  # if simulation doesn't go past May 1, start at first day of simulation
         mayIdx = 0
     
-    foundFirst = False
-    foundExclusive = False
-    idxFirst = -1
-    idxExclusive = -1
-    for j in range(mayIdx, n):
-        if tsContainerSide.getValue(j) > 0 and not foundFirst:
-            foundFirst = True
-            idxFirst = j
-        if tsContainerSide.getValue(j) > 0 and tsContainerLower.getValue(j) == 0:
-            foundExclusive = True
-            idxExclusive = j
-            break
-    if foundFirst:
-        dateFirst = (tsContainerSide.getHecTime(idxFirst)).toString().replace(',','')
+    with metrics.phase("gateScan"):
+        gateEvents = analyzeGateEvents(tsContainerSide, tsContainerLower, mayIdx)
+    if gateEvents['idxFirst'] >= 0:
+        dateFirst = (tsContainerSide.getHecTime(gateEvents['idxFirst'])).toString().replace(',','')
     else:
         dateFirst = "***"
-    if foundExclusive:
-        dateExclusive = (tsContainerSide.getHecTime(idxExclusive)).toString().replace(',','')
+    if gateEvents['idxExclusive'] >= 0:
+        dateExclusive = (tsContainerSide.getHecTime(gateEvents['idxExclusive'])).toString().replace(',','')
     else:
         dateExclusive = "***"
   
     print("First side gate usage", dateFirst)
     print("First exclusive side gate usage", dateExclusive)
+    print("Side gate use (hrs)", gateEvents['hoursUsed'], "exclusive (hrs)", gateEvents['hoursExclusive'])
+    print("Side gate level counts", gateEvents['levelCounts'])
+    
+    return {'iteration': currentIteration, 'cwp': cwp, 'poolVol': poolVol, 'cwpCutoffsF': cutoffsF, 'cwpCurve': cwpCurve,
+            'dateFirst': dateFirst, 'dateExclusive': dateExclusive, 'gateEvents': gateEvents, 'message': rtnMsg,
+            'fingerprint': fingerprint}
+
+
+def runIteration(modelAlternative, currentIteration, maxIteration):
     
-    # Append results to csv file
-    with open(os.path.join(simDrct, outputFilename), 'a') as outFid:
-        outFid.write("{0:d},{1:0.2f},{2:0.2f},{3:s},{4:s}\n".format(currentIteration, cwp, poolVol, dateFirst, dateExclusive))
+    scriptStartTime = time.time()
+    
+    print("Current iteration", currentIteration)
+    print("Model Alternative", modelAlternative.getName())
+    print("Simulation Name", modelAlternative.getSimulationName())
+    print("Program", modelAlternative.getProgram())
+    print("DSS Filename", modelAlternative.getDssFilename())
+    print("Fpart", modelAlternative.getFpart())
+    print("Variant Name", modelAlternative.getVariantName())
+    print("Run directory", modelAlternative.getRunDirectory())
+    
+    simulationName = modelAlternative.getSimulationName().encode('ascii', 'ignore')
+    rssRunName = modelAlternative.getFpart().encode('ascii', 'ignore')
+    
+    workspace = Project.getCurrentProject().getWorkspacePath()
+    print(workspace)
+    simDrct = os.path.join(workspace, "runs", simulationName)
+    hdfFilename = rssRunName.replace(":", "_") + ".h5"
+    FpartBaseName = rssRunName.upper()
+    
+    # Results of earlier iterations are kept for reuse when their inputs haven't changed
+    # Iterations may run in any order, so none of them starts a new run: each one leaves the
+    # current run until its result is published again, and iterations past maxIteration are removed.
+    resultsStore = ResultsStore(simDrct)
+    resultsStore.withdraw(currentIteration)
+    if currentIteration == 1:
+        resultsStore.clear(maxIteration)
+    metrics = IterationMetrics(currentIteration)
+    
+    try:
+        with metrics.phase("dssOpen"):
+            dssFile = HecDss.open(os.path.join(simDrct, dssFilename))
+    except Exception as e:
+        return ("Error: Unable to open DSS file: " + dssFilename)
+    
+    try:
+        result = processIteration(os.path.join(simDrct, 'rss', hdfFilename), dssFile, FpartBaseName, currentIteration,
+                                  resultsStore=resultsStore, metrics=metrics, useMappedReads=useMappedProfileReads)
+    except IOError as e:
+        return str(e)
+    finally:
+        dssFile.done()
+    
+    # Store results and refresh the csv files
+    with metrics.phase("csvWrite"):
+        resultsStore.put(result)
+        resultsStore.publish(currentIteration)
+        resultsStore.exportCsv()
     
     scriptEndTime = time.time()
     elapsedTime = scriptEndTime - scriptStartTime
     print("Elapsed time", elapsedTime)
+    metrics.addTime("total", elapsedTime)
+    writeMetrics(simDrct, [metrics.record()], runId=resultsStore.runId())
     
     #raise ValueError
     #return rtnMsg
     return True
-            
\ No newline at end of file
+
+
+# One iteration of a batch run, for the java thread pool in runBatch
+class IterationTask(Callable):
+    def __init__(self, hdfFilenameFull, dssFile, dssLock, FpartBaseName, iteration, resultsStore):
+        self.hdfFilenameFull = hdfFilenameFull
+        self.dssFile = dssFile
+        self.dssLock = dssLock
+        self.FpartBaseName = FpartBaseName
+        self.iteration = iteration
+        self.resultsStore = resultsStore
+        self.metrics = IterationMetrics(iteration)
+    
+    def call(self):
+        try:
+            result = processIteration(self.hdfFilenameFull, self.dssFile, self.FpartBaseName, self.iteration,
+                                      dssLock=self.dssLock, resultsStore=self.resultsStore, metrics=self.metrics,
+                                      useMappedReads=useMappedProfileReads)
+            with self.metrics.phase("resultWrite"):
+                self.resultsStore.put(result)
+                self.resultsStore.publish(self.iteration)
+            return result
+        except Exception as e:
+            return "Iteration %d: %s" % (self.iteration, str(e))
+
+
+# Post-process iterations firstIteration..lastIteration of a forecast simulation on a pool of
+# maxWorkers threads. Iterations whose inputs are unchanged reuse their stored results. Each result
+# is stored as it finishes (replacing any earlier result for the iteration) and published to the
+# current run, then SRTTG_reporting.csv and SRTTG_cwp_curve.csv are exported for the iterations of
+# the run, in iteration order. The iterations of the batch leave the run until they succeed again;
+# other iterations already in the run stay in the report unless newRun starts a new run.
+# hdfTemplate is the per-iteration RSS output file relative to simDrct. It is formatted with
+# iteration, collectionId (six digit, as in the DSS F part) and hdfFilename (the RSS run file
+# name), e.g. os.path.join('rss', '{collectionId}', '{hdfFilename}'). It must give each iteration
+# its own file: the single file runIteration reads only holds whichever iteration wrote it last.
+# The HDF5 library serializes its own calls, so the overlap comes from DSS and python work.
+# Metrics of each iteration, then a batch record (iteration None) with the DSS open, CSV export
+# and total times, are appended to SRTTG_metrics.jsonl with the id of the run.
+def runBatch(simDrct, rssRunName, firstIteration, lastIteration, hdfTemplate, maxWorkers=4, newRun=False):
+    
+    scriptStartTime = time.time()
+    
+    hdfFilename = rssRunName.replace(":", "_") + ".h5"
+    FpartBaseName = rssRunName.upper()
+    iterations = range(firstIteration, lastIteration + 1)
+    hdfFilenames = [os.path.join(simDrct, hdfTemplate.format(
+        iteration=iteration, collectionId="{0:0>6d}".format(iteration), hdfFilename=hdfFilename))
+        for iteration in iterations]
+    if len(set(hdfFilenames)) < len(hdfFilenames):
+        return ("Error: hdfTemplate " + hdfTemplate + " maps several iterations to the same file")
+    
+    batchMetrics = IterationMetrics(None)
+    try:
+        with batchMetrics.phase("dssOpen"):
+            dssFile = HecDss.open(os.path.join(simDrct, dssFilename))
+    except Exception as e:
+        return ("Error: Unable to open DSS file: " + dssFilename)
+    dssLock = threading.Lock()
+    resultsStore = ResultsStore(simDrct)
+    if newRun:
+        resultsStore.startRun()
+    for iteration in iterations:
+        resultsStore.withdraw(iteration)
+    
+    pool = Executors.newFixedThreadPool(max(1, min(maxWorkers, len(iterations))))
+    try:
+        tasks = []
+        futures = []
+        for iteration, hdfFilenameFull in zip(iterations, hdfFilenames):
+            tasks.append(IterationTask(hdfFilenameFull, dssFile, dssLock, FpartBaseName, iteration, resultsStore))
+            futures.append(pool.submit(tasks[-1]))
+        results = [future.get() for future in futures]
+    finally:
+        pool.shutdown()
+        dssFile.done()
+    
+    errors = [result for result in results if not isinstance(result, dict)]
+    for error in errors:
+        print(error)
+    with batchMetrics.phase("csvWrite"):
+        resultsStore.exportCsv()
+    
+    scriptEndTime = time.time()
+    elapsedTime = scriptEndTime - scriptStartTime
+    print("Elapsed time", elapsedTime)
+    batchMetrics.addTime("total", elapsedTime)
+    writeMetrics(simDrct, [task.metrics.record() for task in tasks] + [batchMetrics.record()], runId=resultsStore.runId())
+    
+    if errors:
+        return "\n".join(errors)
+    return True